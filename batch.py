@@ -11,8 +11,11 @@ import subprocess
 from Bio import Phylo
 
 import covizu
-from covizu.utils import gisaid_utils
+from covizu import minimap2, features
+from covizu.utils import gisaid_utils, pipeline_utils
 from covizu.utils.progress_utils import Callback
+from covizu.utils.db_utils import FeatureStore
+from covizu.utils.lineage_utils import LineageView
 from covizu.utils.batch_utils import (unpack_records, build_timetree, parse_alias,
                                       make_beadplots, get_mutations)
 from covizu.utils.seq_utils import SC2Locator
@@ -55,6 +58,11 @@ def parse_args():
         "download xz file from GISAID provision feed.")
     parser.add_argument("--outdir", type=str, default='data/',
                         help="option, path to write output files")
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="option, convert provision file into a block-compressed, seekable "
+        "copy with an accession index, reused by later steps and runs")
 
     parser.add_argument(
         '--minlen',
@@ -75,11 +83,61 @@ def parse_args():
         'quantile of Poisson distribution (molecular clock).  Default 0.001 '
         'corresponds to 99.9%% cutoff.')
 
+    parser.add_argument(
+        '--nworkers',
+        type=int,
+        default=1,
+        help='option, number of processes to decode provision JSON (default 1)')
+    parser.add_argument(
+        '--parser',
+        type=str,
+        default='auto',
+        choices=['auto', 'json', 'scan', 'orjson'],
+        help="option, provision record parser (default 'auto' uses orjson if "
+             "installed, otherwise json; 'scan' is a pure-Python field scanner)")
+
+    parser.add_argument(
+        '--checkpoint',
+        type=str,
+        default=None,
+        help="option, path to write checkpoints of feature extraction; "
+             "defaults to <outdir>/checkpoint.pickle with --resume")
+    parser.add_argument(
+        '--checkpoint-interval',
+        type=int,
+        default=10,
+        help='option, number of minimap2 batches between checkpoints (default 10)')
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help="option, resume feature extraction from last checkpoint of an "
+             "interrupted run on the same input file")
+
     parser.add_argument(
         '--batchsize',
         type=int,
         default=2000,
         help='option, number of records to batch process with minimap2')
+    parser.add_argument(
+        '--sort-budget',
+        type=int,
+        default=0,
+        help='option, memory budget (MB) for records sorted by lineage, above '
+             'which lineages are spilled to disk under --outdir (default 0, '
+             'keep all records in memory)')
+    parser.add_argument(
+        '--dedup',
+        action='store_true',
+        help='option, align each distinct genome sequence only once, copying '
+             'features to records with identical sequences.  Duplicates within '
+             'a batch are output after their first copy, so records are not in '
+             'input order')
+    parser.add_argument(
+        '--dedup-size',
+        type=int,
+        default=100000,
+        help='option, maximum number of aligned sequences kept for --dedup, '
+             'least recently seen are forgotten first (default 100000)')
     parser.add_argument(
         '--max-variants',
         type=int,
@@ -97,6 +155,25 @@ def parse_args():
                         help="option, path to minimap2 binary executable")
     parser.add_argument('-mmt', "--mmthreads", type=int, default=16,
                         help="option, number of threads for minimap2.")
+    parser.add_argument('--mmworkers', type=int, default=1,
+                        help="option, number of worker threads aligning batches "
+                             "in-process with a shared minimap2 index (requires "
+                             "mappy); if 1 (default), --mmbin is run for each batch")
+    parser.add_argument('--fast-diffs', action='store_true',
+                        help="option, call differences of genomes near-identical to the "
+                             "reference directly, aligning only the remaining "
+                             "genomes with minimap2")
+    parser.add_argument('--mpi-features', action='store_true',
+                        help="option, align genomes and extract features across "
+                             "MPI processes in --machine_file (requires mpi4py); "
+                             "--checkpoint, --dedup and --pipeline are ignored")
+    parser.add_argument('--fused-filter', action='store_true',
+                        help="option, exclude problematic sites, and genomes with excess "
+                             "divergence or missing sites, while decoding minimap2 "
+                             "output; saved features exclude problematic sites")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="option, run decoding, alignment and filtering of "
+                             "genomes concurrently in separate threads")
 
     parser.add_argument(
         '--misstol',
@@ -149,9 +226,21 @@ def parse_args():
 
     parser.add_argument('--binpath', type=str, default='rapidnj',
                         help='option, path to RapidNJ binary executable')
+    parser.add_argument('--nj-backend', type=str, default='rapidnj',
+                        choices=['rapidnj', 'builtin'],
+                        help='option, reconstruct bootstrap trees with RapidNJ, or with '
+                             'built-in neighbor-joining without a subprocess')
+    parser.add_argument('--nj-stream', action='store_true',
+                        help='option, stream distance matrices to RapidNJ through a pipe '
+                             'instead of temporary files, if RapidNJ can read them '
+                             'from /dev/stdin')
+    parser.add_argument('--nj-workers', type=int, default=1,
+                        help='option, if >1, number of local processes to reconstruct '
+                             'bootstrap trees, in place of MPI')
     parser.add_argument('--mincount', type=int, default=5000,
                         help='option, minimum number of variants in lineage '
-                             'above which MPI processing will be used.')
+                             'above which its replicates are split across local '
+                             'workers (--nj-workers); MPI jobs schedule by cost.')
     parser.add_argument('--machine_file', type=str, default='mfile',
                         help='option, path to machine file for MPI.')
     parser.add_argument("-n", "--nboot", type=int, default=100,
@@ -168,6 +257,12 @@ def parse_args():
         '--use-db',
         action="store_true",
         help="Use a database to store and retrieve features for sequences")
+    parser.add_argument(
+        '--feature-store',
+        type=str,
+        default=None,
+        help="option, path to SQLite file to store and retrieve features for "
+        "sequences without a PostgreSQL database (ignored with --use-db)")
     parser.add_argument(
         '--dbname',
         type=str,
@@ -267,24 +362,90 @@ def process_feed(input_args, input_cur, callback=None):
     """ Process feed data """
     if callback:
         callback("Processing GISAID feed data")
+    store = None
+    if input_args.feature_store and input_cur is None:
+        store = FeatureStore(input_args.feature_store)
+        if callback:
+            callback(f"Loaded feature store with {len(store)} genomes")
+
+    ckpt_file, state = gisaid_utils.open_checkpoint(input_args, callback=callback)
+    progress = {'offset': state['offset']}
+    dedup = gisaid_utils.SequenceDedup(
+        maxsize=input_args.dedup_size) if input_args.dedup else None
     loader = gisaid_utils.load_gisaid(
         input_args.infile,
         minlen=input_args.minlen,
-        mindate=input_args.mindate)
-    batcher = gisaid_utils.batch_fasta(loader, input_cur, size=input_args.batchsize)
+        mindate=input_args.mindate,
+        callback=callback,
+        nworkers=input_args.nworkers,
+        parser=input_args.parser,
+        start=state['offset'],
+        progress=progress)
+    batcher = gisaid_utils.batch_fasta(
+        loader, input_cur, size=input_args.batchsize, store=store,
+        dedup=dedup)
+    checkpoint = None
+    if ckpt_file:
+        checkpoint = gisaid_utils.Checkpointer(
+            progress, state, ckpt_file,
+            interval=input_args.checkpoint_interval, callback=callback)
+        batcher = checkpoint.track(batcher)
+    pipeline = input_args.pipeline
+    if pipeline and input_cur is not None:
+        # database cursor cannot be shared between threads
+        if callback:
+            callback("--pipeline is not supported with --use-db", level='WARN')
+        pipeline = False
+    stages = []
+    if pipeline:
+        batcher = pipeline_utils.Stage('decode', batcher, maxsize=2)
+        stages.append(batcher)
+    pool = None
+    if input_args.mmworkers > 1:
+        pool = minimap2.Minimap2Pool(
+            input_args.ref, nthread=input_args.mmthreads,
+            nworkers=input_args.mmworkers, minlen=input_args.minlen)
+    caller = minimap2.AnchoredCaller(input_args.ref) if input_args.fast_diffs else None
+    record_filter = gisaid_utils.RecordFilter(
+        vcf_file=input_args.vcf, cutoff=input_args.poisson_cutoff,
+        fused=input_args.fused_filter)
     aligned = gisaid_utils.extract_features(
         batcher,
         ref_file=input_args.ref,
         cur=input_cur,
         binpath=input_args.mmbin,
         nthread=input_args.mmthreads,
-        minlen=input_args.minlen)
-    filtered = gisaid_utils.filter_problematic(
-        aligned,
-        vcf_file=input_args.vcf,
-        cutoff=input_args.poisson_cutoff,
-        callback=callback)
-    return gisaid_utils.sort_by_lineage(filtered, callback=callback)
+        minlen=input_args.minlen,
+        store=store,
+        dedup=dedup,
+        pool=pool,
+        checkpoint=checkpoint,
+        caller=caller,
+        record_filter=record_filter)
+    if stages:
+        aligned = pipeline_utils.Stage('align', aligned, maxsize=1000)
+        stages.append(aligned)
+    by_lineage = gisaid_utils.sort_by_lineage(
+        aligned, callback=callback, result=state['by_lineage'])
+    if callback:
+        record_filter.report(callback)
+    if stages and callback:
+        for stage in stages:
+            callback(stage.report())
+    if pool:
+        pool.close()
+        if callback:
+            callback(pool.summary())
+    if caller and callback:
+        callback(caller.summary())
+    if dedup and callback:
+        callback(f"Skipped alignment of {dedup.ndups} of {dedup.nrecords} genomes "
+                 f"with duplicate sequences ({dedup.ratio():.1%})")
+    if store:
+        store.close()
+    if ckpt_file and os.path.exists(ckpt_file):
+        os.remove(ckpt_file)  # run completed
+    return by_lineage
 
 
 if __name__ == "__main__":
@@ -368,10 +529,27 @@ if __name__ == "__main__":
     if args.infile is None:
         cb.callback("No input specified, downloading data from GISAID feed...")
         args.infile = gisaid_utils.download_feed(
-            args.url, args.user, args.password)
+            args.url, args.user, args.password, cache=args.cache, callback=cb.callback)
+
+    if args.cache and not gisaid_utils.is_cache(args.infile):
+        cached = gisaid_utils.cache_path(args.infile)
+        if gisaid_utils.is_current(cached, args.infile):
+            cb.callback(f"Using block-compressed provision {cached}")
+            args.infile = cached
+        else:
+            if gisaid_utils.is_cache(cached):
+                cb.callback(f"{args.infile} has changed since {cached} was written")
+            cb.callback("Converting provision to block-compressed format")
+            args.infile = gisaid_utils.convert_provision(args.infile, callback=cb.callback)
 
     # filter data, align genomes, extract features, sort by lineage
-    by_lineage = process_feed(args, CUR, cb.callback)
+    if args.mpi_features and CUR is not None:
+        cb.callback("--mpi-features is not supported with --use-db", level='WARN')
+    if args.mpi_features and CUR is None:
+        by_lineage = features.process_feed_mpi(
+            args, cb.callback, initial_time=cb.initial_time.timestamp())
+    else:
+        by_lineage = process_feed(args, CUR, cb.callback)
 
     # separate XBB and other recombinant lineages
     aliases = parse_alias(args.alias)
@@ -387,27 +565,31 @@ if __name__ == "__main__":
                 "XBB") else 'non-recombinant', 'fullname': truename}})
 
     # use results to partition by_lineage database
-    non_recomb = {}
-    XBB = {}
-    other_recomb = {}
-    for lineage, ldata in by_lineage.items():
+    non_recomb = []
+    XBB = []
+    other_recomb = []
+    for lineage in by_lineage:
         # Put unassigned lineages in non-recombinant category
         if lineage.lower() == "unassigned":
-            non_recomb.update({lineage: ldata})
+            non_recomb.append(lineage)
             continue
 
         prefix = lineage.split('.')[0]
         category = designation[prefix]['type']
         if category == 'non-recombinant':
-            non_recomb.update({lineage: ldata})
+            non_recomb.append(lineage)
         elif category == 'XBB':
-            XBB.update({lineage: ldata})
+            XBB.append(lineage)
         else:
-            other_recomb.update({lineage: ldata})
+            other_recomb.append(lineage)
 
+    # views on by_lineage, to avoid loading spilled lineages all at once
+    non_recomb = LineageView(by_lineage, non_recomb)
     if len(XBB) < 2:
-        other_recomb.update(XBB)
+        other_recomb.extend(XBB)
         XBB = None  # no point in building a tree
+    else:
+        XBB = LineageView(by_lineage, XBB)
 
     # reconstruct time-scaled trees
     timetree, residuals = build_timetree(
@@ -480,10 +662,10 @@ if __name__ == "__main__":
     # get mutation info
     locator = SC2Locator()
     mutations = {}
-    for lineage, features in get_mutations(by_lineage).items():
+    for lineage, muts in get_mutations(by_lineage).items():
         annots = {
             locator.parse_mutation(f): freq for f,
-            freq in features.items()}
+            freq in muts.items()}
         mutations.update(
             {lineage: {a: freq for a, freq in annots.items() if a is not None}})
 
@@ -551,6 +733,8 @@ if __name__ == "__main__":
     if args.use_db:
         conn.commit()
         conn.close()
+    if hasattr(by_lineage, 'close'):
+        by_lineage.close()  # remove lineages spilled to disk
 
     # upload output files to webserver, requires SSH key credentials
     if not args.dry_run:
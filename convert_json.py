@@ -9,7 +9,8 @@ from covizu.utils.gisaid_utils import convert_json
 parser = argparse.ArgumentParser(description="Convert JSON from main branch to epicov formats.")
 parser.add_argument('json', type=argparse.FileType('r'),
                     help='input, cluster JSON file to convert')
-parser.add_argument('xz', type=str, help='input, path to xz-compressed provisioning file')
+parser.add_argument('xz', type=str, help='input, path to xz-compressed provisioning file, '
+                                          'or block-compressed copy from convert_provision()')
 parser.add_argument('outfile', type=argparse.FileType('w'),
                     help='output, path to write converted JSON')
 args = parser.parse_args()
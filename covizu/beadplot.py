@@ -129,11 +129,13 @@ def annotate_tree(input_tree, tree_label_dict, minlen=0.5, callback=None):
     return input_tree
 
 
-def serialize_tree(tree):
+def serialize_tree(tree, registry=None):
     """
     Convert annotated tree object to JSON
     TODO: label nodes with features (genetic differences)
     :param tree:  Phylo.BaseTree object from annotate_tree()
+    :param registry:  utils.sample_utils.SampleRegistry, required if nodes are
+                      labelled with sample IDs from recode_features()
     :return:  dict, containing 'nodes' and 'edges'
     """
     obj = {'nodes': {}, 'edges': []}
@@ -145,8 +147,11 @@ def serialize_tree(tree):
     for node in tree.find_clades(order='level'):
         if node.labels:
             # sort samples by [coldate, accession, label]
-            intermed = sorted([label.split('|')[::-1]
-                              for label in node.labels])
+            if registry is not None:
+                intermed = sorted([registry.row(sid) for sid in node.labels])
+            else:
+                intermed = sorted([label.split('|')[::-1]
+                                  for label in node.labels])
             # use accession of earliest sample to ID variant
             variant = intermed[0][1]
 
@@ -7,34 +7,48 @@ import subprocess
 from io import StringIO
 import sys
 import os
+import time
+import multiprocessing
+from collections import deque
+from multiprocessing import shared_memory
+from functools import lru_cache
 
+import numpy as np
+from scipy import sparse
 from Bio import Phylo
 from Bio.Phylo.BaseTree import Clade
 
 from covizu.utils.progress_utils import Callback
+from covizu.utils.mutation_utils import key_codes
+from covizu.utils.nj_utils import NJTree, neighbor_joining
 
 
 sys.setrecursionlimit(20000)  # fix for issue #127, default limit 1000
 
 
-def recode_features(records, callback=None, limit=10000):
+def recode_features(records, callback=None, limit=10000, registry=None):
     """
     Recode feature vectors with integer indices based on set union.
     Pass results to bootstrap() to reconstruct trees by neighbor-joining method.
 
-    :param records:  dict, samples keyed by unique mutation set
+    :param records:  dict, samples keyed by unique mutation set, see
+                     mutation_utils.pack_key()
     :param callback:  optional, function for progress monitoring
     :param limit:  int, maximum number of variants to prevent memory allocation crashes
-    :return:  dict, key-value pairs of all features indexed by integers
+    :param registry:  utils.sample_utils.SampleRegistry, optional; if given,
+                      samples are registered and labelled by integer ID
+    :return:  dict, integer indices keyed by mutation codes of all features
               dict, lists of labels by variant (identical feature vectors), keyed by index
               list, sets of feature vectors encoded by integers, by variant
     """
     # compress genomes with identical feature vectors
     fvecs = {}
-    for muts, variant in records.items():
-        key = tuple(tuple(x.split('|')) for x in muts.split(','))
+    for key, variant in records.items():
         if key not in fvecs:
             fvecs.update({key: []})
+        if registry is not None:
+            fvecs[key].extend(registry.add_record(sample) for sample in variant)
+            continue
         for sample in variant:
             label = (f"{sample['covv_virus_name']}|{sample['covv_location']}|"
                     f"{sample['covv_accession_id']}|{sample['covv_collection_date']}")
@@ -42,8 +56,12 @@ def recode_features(records, callback=None, limit=10000):
             fvecs[key].append(label)
 
     # limit to N most recently-sampled feature vectors
-    intermed = [(max(label.split('|')[-1] for label in labels), key)
-                for key, labels in fvecs.items()]
+    if registry is not None:
+        intermed = [(max(registry.date(sid) for sid in labels), key)
+                    for key, labels in fvecs.items()]
+    else:
+        intermed = [(max(label.split('|')[-1] for label in labels), key)
+                    for key, labels in fvecs.items()]
     intermed.sort(reverse=True)
 
     # generate union of all features
@@ -57,6 +75,7 @@ def recode_features(records, callback=None, limit=10000):
         fvec = item[1]
         labels.update({str(count): fvecs[fvec]})
         if count < limit:
+            fvec = key_codes(fvec).tolist()
             for feat in fvec:
                 if feat not in union:
                     union.update({feat: len(union)})
@@ -66,52 +85,606 @@ def recode_features(records, callback=None, limit=10000):
     return union, labels, indexed
 
 
-def bootstrap(input_union, idxed, binpath='rapidnj', callback=None, callfreq=1000):
+def incidence_matrix(indexed, nfeat):
+    """
+    :param indexed:  list, sets of feature indices by variant, from recode_features()
+    :param nfeat:  int, number of features in set union
+    :return:  scipy.sparse.csr_matrix, variants (rows) by features (columns),
+              1 where the variant carries the feature
+    """
+    sizes = [len(fvec) for fvec in indexed]
+    rows = np.repeat(np.arange(len(indexed)), sizes)
+    cols = np.fromiter((feat for fvec in indexed for feat in fvec),
+                       dtype=np.int64, count=sum(sizes))
+    values = np.ones(len(cols), dtype=np.int64)
+    return sparse.csr_matrix((values, (rows, cols)), shape=(len(indexed), nfeat))
+
+
+def distance_blocks(incidence, weights, blocksize=500):
+    """
+    Weighted symmetric differences between all pairs of feature vectors,
+    i.e., the summed weights of features carried by one variant but not the
+    other:  d(i, j) = w.x_i + w.x_j - 2 (w * x_i).x_j
+
+    :param incidence:  scipy.sparse.csr_matrix, from incidence_matrix()
+    :param weights:  numpy.ndarray, integer weight of each feature
+    :param blocksize:  int, number of rows of distance matrix per block, to
+                       bound memory use to <blocksize> x <variants> integers
+    :yield:  int, numpy.ndarray; index of first row in block, and rows of
+             the distance matrix
+    """
+    weights = np.asarray(weights, dtype=np.int64)
+    totals = incidence @ weights
+    transposed = incidence.T.tocsc()
+    for start in range(0, incidence.shape[0], blocksize):
+        block = incidence[start:(start + blocksize)]
+        shared = (block.multiply(weights).tocsr() @ transposed).toarray()
+        dists = totals[start:(start + blocksize), None] + totals[None, :] - 2 * shared
+        yield start, dists
+
+
+def format_block(dists, start):
+    """
+    Format rows of a distance matrix in PHYLIP format, with each distance
+    right-aligned to at least two digits, i.e., f' {d:>2}', without
+    formatting integers one at a time.
+
+    :param dists:  numpy.ndarray, non-negative integer distances by row
+    :param start:  int, index of first row, used as row label
+    :return:  bytes, ASCII text of rows
+    """
+    dists = np.asarray(dists)
+    maxval = int(dists.max()) if dists.size else 0
+    chars, keep = _format_table(max(maxval, 99))
+    cells = chars[dists]  # (rows, columns, characters per distance)
+
+    if maxval < 100:
+        body = cells.reshape(len(dists), -1)  # every distance has 3 characters
+        rows = [body[i].tobytes() for i in range(len(dists))]
+    else:
+        # drop padding of distances shorter than the widest
+        lengths = keep[dists].sum(axis=(1, 2))
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        flat = cells[keep[dists]].tobytes()
+        rows = [flat[offsets[i]:offsets[i + 1]] for i in range(len(dists))]
+
+    pieces = []
+    for i, row in enumerate(rows, start):
+        pieces.extend([b'%d' % i, row, b'\n'])
+    return b''.join(pieces)
+
+
+@lru_cache(maxsize=8)
+def _format_table(maxval):
+    """
+    :param maxval:  int, largest distance to format
+    :return:  numpy.ndarray, characters of ' {d:>2}' for every distance d up
+              to <maxval>, right-aligned to width of <maxval>;
+              numpy.ndarray, bool mask of characters without extra padding
+    """
+    width = len(str(maxval)) + 1
+    text = ''.join(f'{f" {d:>2}":>{width}}' for d in range(maxval + 1))
+    chars = np.frombuffer(text.encode('ascii'), dtype=np.uint8).reshape(-1, width)
+    lengths = np.array([len(f' {d:>2}') for d in range(maxval + 1)])
+    keep = np.arange(width)[None, :] >= (width - lengths)[:, None]
+    return chars, keep
+
+
+def write_distances(handle, indexed, weights, callback=None, callfreq=1000):
+    """
+    Write distance matrix of weighted symmetric differences between feature
+    vectors in PHYLIP format, as input for RapidNJ.
+
+    :param handle:  file object, open in binary mode for writing
+    :param indexed:  list, sets of feature indices by variant, from
+                     recode_features(); or their incidence_matrix()
+    :param weights:  numpy.ndarray, integer weight of each feature
+    :param callback:  function, optional for progress monitoring
+    :param callfreq:  int, sampling interval for callback
+    :return:  int, number of bytes written
+    """
+    incidence = indexed
+    if not sparse.issparse(indexed):
+        incidence = incidence_matrix(indexed, len(weights))
+    num_vec = incidence.shape[0]
+    nbytes = handle.write(f'{num_vec:>5}\n'.encode('ascii'))
+    for start, dists in distance_blocks(incidence, weights):
+        if callback:
+            for i in range(start + (-start) % callfreq, start + len(dists), callfreq):
+                callback(f"  row {i} of {num_vec}", level='DEBUG')
+        nbytes += handle.write(format_block(dists, start))
+    return nbytes
+
+
+def rapidnj(idxed, weights, binpath='rapidnj', stream=False, callback=None, callfreq=1000):
+    """
+    Reconstruct a neighbor-joining tree with RapidNJ from the distance matrix
+    of feature vectors.  The matrix is written to a temporary file first or,
+    if <stream> is True, streamed to RapidNJ through a pipe (/dev/stdin)
+    while it is computed; see stream_rapidnj().
+
+    :param idxed:  list, sets of feature indices by variant; or their
+                   incidence_matrix()
+    :param weights:  numpy.ndarray, integer weight of each feature
+    :param binpath:  str, path to RapidNJ binary executable
+    :param stream:  bool, pass matrix to RapidNJ through a pipe
+    :param callback:  function, optional for progress monitoring
+    :param callfreq:  int, sampling interval for callback
+    :return:  str, Newick tree string
+    """
+    if not stream:
+        with tempfile.NamedTemporaryFile('wb', prefix="cvz_boot_") as temp_out:
+            write_distances(temp_out, idxed, weights, callback=callback, callfreq=callfreq)
+            temp_out.flush()
+            stdout = subprocess.check_output([
+                binpath, temp_out.name, '-i', 'pd', '--no-negative-length'],
+                stderr=subprocess.DEVNULL)
+        return stdout.decode('utf-8')
+
+    cmd = [binpath, '/dev/stdin', '-i', 'pd', '--no-negative-length']
+    with subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL) as proc:
+        try:
+            write_distances(proc.stdin, idxed, weights, callback=callback,
+                            callfreq=callfreq)
+        except BrokenPipeError:
+            pass  # RapidNJ exited early, reported below
+        stdout, _ = proc.communicate()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return stdout.decode('utf-8')
+
+
+def stream_rapidnj(args, callback=None):
+    """
+    Decide whether to stream distance matrices to RapidNJ through a pipe,
+    once per process, by running RapidNJ on a small matrix.  Streaming is
+    opt-in (--nj-stream), as reading PHYLIP input from /dev/stdin has not
+    been verified with every build of RapidNJ.
+
+    :param args:  Namespace, with nj_stream, nj_backend and binpath
+    :param callback:  function, optional for progress monitoring
+    :return:  bool, pass as <stream> to replicate() and bootstrap()
+    """
+    if not getattr(args, 'nj_stream', False) or args.nj_backend != 'rapidnj':
+        return False
+    try:
+        newick = rapidnj([set(), {0}, {1}], np.ones(2, dtype=np.int64), args.binpath,
+                         stream=True)
+    except (OSError, subprocess.CalledProcessError):
+        newick = None
+    if newick and newick.strip():
+        return True
+    if callback:
+        callback("RapidNJ failed to read distance matrix from pipe, "
+                 "writing to temporary files instead", level='WARN')
+    return False
+
+
+def replicate(incidence, binpath='rapidnj', callback=None, callfreq=1000,
+              backend='rapidnj', stream=False):
+    """
+    Reconstruct one bootstrap tree, weighting features by sampling them at
+    random with replacement.
+
+    :param incidence:  scipy.sparse.csr_matrix, from incidence_matrix()
+    :param binpath:  str, path to RapidNJ binary executable
+    :param callback:  function, optional for progress monitoring
+    :param callfreq:  int, sampling interval for callback
+    :param backend:  str, 'rapidnj' or 'builtin' for in-process neighbor-joining
+    :param stream:  bool, stream distance matrix to RapidNJ, see stream_rapidnj()
+    :return:  str, Newick tree string from RapidNJ; or nj_utils.NJTree if
+              backend is 'builtin'
+    """
+    nfeat = incidence.shape[1]
+    sample = [int(nfeat * random.random()) for _ in range(nfeat)]
+    weights = np.bincount(sample, minlength=nfeat)
+
+    if backend == 'builtin':
+        num_vec = incidence.shape[0]
+        dists = np.empty((num_vec, num_vec), dtype=np.float32)
+        for start, block in distance_blocks(incidence, weights):
+            dists[start:(start + len(block))] = block
+        return neighbor_joining(dists)
+
+    return rapidnj(incidence, weights, binpath, stream=stream, callback=callback,
+                   callfreq=callfreq)
+
+
+def bootstrap(input_union, idxed, binpath='rapidnj', callback=None, callfreq=1000,
+              backend='rapidnj', stream=False):
     """
     Sample features from set union at random with replacement.  We use the
     result to weight the symmetric differences when calculating pairwise
     distances.  Pass the resulting distance matrix to RapidNJ to reconstruct
-    a tree.
+    a tree, or reconstruct it in-process with nj_utils.neighbor_joining().
 
     :param union:  set, all observed genetic differences from reference (features)
     :param indexed:  list, feature vectors encoded as integers
     :param binpath:  str, path to RapidNJ binary executable
     :param callback:  function, optional for progress monitoring
     :param callfreq:  int, sampling interval for callback
+    :param backend:  str, 'rapidnj' or 'builtin' for in-process neighbor-joining
+    :param stream:  bool, stream distance matrix to RapidNJ, see stream_rapidnj()
 
-    :return:  Bio.Phylo.BaseTree object
+    :return:  Bio.Phylo.BaseTree object, or nj_utils.NJTree if backend is 'builtin'
     """
-    sample = [int(len(input_union) * random.random()) for _ in range(len(input_union))]
-    weights = {y: sample.count(y) for y in sample}
-    num_vec = len(idxed)
+    tree = replicate(incidence_matrix(idxed, len(input_union)), binpath, callback=callback,
+                     callfreq=callfreq, backend=backend, stream=stream)
+    if isinstance(tree, NJTree):
+        return tree
+    return Phylo.read(StringIO(tree), 'newick')
 
-    # TODO: this is the slowest step - port to C? cache results to traverse
-    # half matrix?
-    with tempfile.NamedTemporaryFile('w', prefix="cvz_boot_") as temp_out:
-        temp_out.write(f'{num_vec:>5}\n')
-        for i in range(num_vec):
-            if callback and i % callfreq == 0:
-                callback(f"  row {i} of {num_vec}", level='DEBUG')
-            temp_out.write(f'{i}')
-            for j in range(num_vec):
-                if i == j:
-                    temp_out.write(f' {0:>2}')
-                else:
-                    sym_diff = idxed[i] ^ idxed[j]  # symmetric difference
-                    difference = sum(weights.get(y, 0) for y in sym_diff)
-                    temp_out.write(f' {difference:>2}')
-            temp_out.write('\n')
-        temp_out.flush()
 
-        # call RapidNJ on temp file
+class SharedLineages:
+    """
+    Feature vectors of lineages, recoded by recode_features(), in a block of
+    shared memory.  Only the layout of the block is pickled, e.g., to pass
+    to worker processes, which attach to the block by name and read the
+    vectors of each lineage as an incidence matrix.
+    """
+
+    def __init__(self, recoded):
+        """
+        :param recoded:  dict, with 'union' and 'indexed' entries by lineage,
+                         as serialized to recoded.json
+        """
+        self.layout = {}  # lineage: first offset, variants, first feature, features
+        nrows = nfeats = 0
+        for lineage, rdata in recoded.items():
+            nvar = len(rdata['indexed'])
+            self.layout[lineage] = (nrows + len(self.layout), nvar, nfeats,
+                                    len(rdata['union']))
+            nrows += nvar
+            nfeats += sum(len(fvec) for fvec in rdata['indexed'])
+        self.noffsets = nrows + len(self.layout)
+        self.nfeats = nfeats
+
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=max(1, 8 * self.noffsets + 4 * nfeats))
+        offsets, features = self.arrays()
+        for lineage, rdata in recoded.items():
+            first, nvar, start, _ = self.layout[lineage]
+            sizes = [len(fvec) for fvec in rdata['indexed']]
+            offsets[first] = start
+            offsets[(first + 1):(first + nvar + 1)] = start + np.cumsum(sizes)
+            features[start:(start + sum(sizes))] = np.fromiter(
+                (feat for fvec in rdata['indexed'] for feat in sorted(fvec)),
+                dtype=np.int32, count=sum(sizes))
+
+    def __getstate__(self):
+        return dict(self.__dict__, shm=self.shm.name)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=state['shm'])
+
+    def arrays(self):
+        """ :return:  numpy.ndarray, row offsets and features in shared memory """
+        offsets = np.ndarray(self.noffsets, dtype=np.int64, buffer=self.shm.buf)
+        features = np.ndarray(self.nfeats, dtype=np.int32, buffer=self.shm.buf,
+                              offset=8 * self.noffsets)
+        return offsets, features
+
+    def incidence(self, lineage):
+        """
+        :param lineage:  str, lineage name
+        :return:  scipy.sparse.csr_matrix, as returned by incidence_matrix()
+        """
+        first, nvar, start, nfeat = self.layout[lineage]
+        offsets, features = self.arrays()
+        rows = offsets[first:(first + nvar + 1)] - start
+        cols = features[start:(start + rows[-1])]
+        values = np.ones(len(cols), dtype=np.int64)
+        return sparse.csr_matrix((values, cols, rows), shape=(nvar, nfeat))
+
+    def close(self):
+        """ Release shared memory """
+        self.shm.close()
+        self.shm.unlink()
 
-        stdout = subprocess.check_output([
-            binpath, temp_out.name, '-i', 'pd', '--no-negative-length'],
-            stderr=subprocess.DEVNULL)
-        out_handle = StringIO(stdout.decode('utf-8'))
 
+_shared = None  # lineages in shared memory, attached by worker process
 
-    return Phylo.read(out_handle, 'newick')
+
+def _attach_worker(shared):
+    """ Process pool initializer, keep lineages attached on unpickling """
+    global _shared
+    random.seed()  # forked workers would otherwise draw identical replicates
+    _shared = shared
+
+
+def _replicate_task(lineage, nreps, binpath, backend, stream):
+    """ :return:  list, <nreps> bootstrap trees of lineage, from replicate() """
+    incidence = _shared.incidence(lineage)
+    return [replicate(incidence, binpath, backend=backend, stream=stream)
+            for _ in range(nreps)]
+
+
+def pool_trees(recoded, nboot, nworkers, binpath='rapidnj', backend='rapidnj',
+               deep=(), callback=None, stream=False):
+    """
+    Reconstruct bootstrap trees of lineages with a pool of local processes,
+    in place of MPI.  Replicates of each lineage in <deep> are split across
+    workers; other lineages are processed by a single worker each.  Tasks
+    are started in decreasing order of the squared number of variants.
+
+    :param recoded:  dict, with 'union' and 'indexed' entries by lineage
+    :param nboot:  int, number of bootstrap replicates per lineage
+    :param nworkers:  int, number of worker processes
+    :param binpath:  str, path to RapidNJ binary executable
+    :param backend:  str, 'rapidnj' or 'builtin' for in-process neighbor-joining
+    :param deep:  iterable, names of lineages to split across workers
+    :param callback:  function, optional for progress monitoring
+    :param stream:  bool, stream distance matrices to RapidNJ, see stream_rapidnj()
+    :yield:  str, list; lineage and its bootstrap trees (Newick strings, or
+             nj_utils.NJTree objects), as lineages are completed
+    """
+    deep = set(deep)
+    tasks = []
+    for lineage, rdata in recoded.items():
+        nvar = len(rdata['indexed'])
+        nsplit = min(nworkers, nboot) if lineage in deep else 1
+        for i in range(nsplit):
+            nreps = nboot // nsplit + (i < nboot % nsplit)
+            tasks.append((nvar * nvar * nreps, lineage, nreps))
+    tasks.sort(reverse=True)
+
+    shared = SharedLineages(recoded)
+    try:
+        with multiprocessing.Pool(nworkers, initializer=_attach_worker,
+                                  initargs=(shared, )) as pool:
+            pending = {lineage: [] for lineage in recoded}
+            for _, lineage, nreps in tasks:
+                pending[lineage].append(pool.apply_async(
+                    _replicate_task, (lineage, nreps, binpath, backend, stream)))
+            for lineage, results in pending.items():
+                trees = [tree for result in results for tree in result.get()]
+                if callback:
+                    callback(f"reconstructed {len(trees)} trees of {lineage}")
+                yield lineage, trees
+    finally:
+        shared.close()
+
+
+def newick_string(tree):
+    """
+    :param tree:  str or nj_utils.NJTree, as returned by replicate()
+    :return:  str, Newick tree string without trailing newline
+    """
+    if isinstance(tree, NJTree):
+        tree = tree.to_phylo().format('newick')
+    return tree.strip()
+
+
+def write_newick(outdir, lineage, trees):
+    """
+    Write trees of lineage to <outdir>/<lineage>.nwk, one tree per line
+
+    :param outdir:  str, path to directory to write files
+    :param lineage:  str, lineage name
+    :param trees:  list, Newick tree strings or nj_utils.NJTree objects
+    """
+    lineage_name = lineage.replace('/', '_')  # issue #297
+    with open(os.path.join(outdir, f'{lineage_name}.nwk'), 'w', encoding='utf-8') as handle:
+        for tree in trees:
+            handle.write(newick_string(tree) + '\n')
+
+
+def single_variant_tree(rdata):
+    """
+    :param rdata:  dict, recoded data of lineage with a single variant
+    :return:  str, Newick string of tree with one tip, no meaningful tree
+    """
+    return f"({rdata['labels']['0'][0]}:0);"
+
+
+def write_trees(recoded, lineages, outdir, args, deep=(), callback=None):
+    """
+    Write bootstrap trees of lineages to Newick files in <outdir>, one file
+    per lineage, as clustering.py does under MPI.
+
+    :param recoded:  dict, with 'union', 'labels' and 'indexed' entries by lineage
+    :param lineages:  iterable, names of lineages to process
+    :param outdir:  str, path to directory to write files
+    :param args:  Namespace, with nboot, nj_workers, binpath, nj_backend and
+                  optionally nj_stream
+    :param deep:  iterable, names of lineages to split across workers
+    :param callback:  function, optional for progress monitoring
+    """
+    multi = {}
+    for lineage in lineages:
+        rdata = recoded[lineage]
+        if len(rdata['indexed']) == 1:
+            write_newick(outdir, lineage, [single_variant_tree(rdata)])
+        else:
+            multi.update({lineage: rdata})
+
+    stream = stream_rapidnj(args, callback=callback)
+    for lineage, trees in pool_trees(multi, args.nboot, args.nj_workers, args.binpath,
+                                     backend=args.nj_backend, deep=deep,
+                                     callback=callback, stream=stream):
+        write_newick(outdir, lineage, trees)
+
+
+def schedule_units(recoded, lineages, nboot, nworkers, split=4):
+    """
+    Divide bootstrap replicates of lineages into work units for TreeScheduler.
+    The cost of a replicate is estimated by the squared number of variants.
+    Replicates of costly lineages are split into ranges, such that no unit
+    exceeds 1/(<split> x <nworkers>) of the total cost, and units are ordered
+    by decreasing cost so that the largest are started first.
+
+    :param recoded:  dict, with 'indexed' entries by lineage
+    :param lineages:  iterable, names of lineages with more than one variant
+    :param nboot:  int, number of bootstrap replicates per lineage
+    :param nworkers:  int, number of worker ranks
+    :param split:  int, number of units per worker to aim for, at most
+    :return:  list, (cost, lineage, first replicate, number of replicates) tuples
+    """
+    costs = {lineage: len(recoded[lineage]['indexed']) ** 2 for lineage in lineages}
+    target = sum(costs.values()) * nboot / (split * max(nworkers, 1))
+    units = []
+    for lineage, cost in costs.items():
+        nunits = min(nboot, max(1, int(np.ceil(cost * nboot / target)))) if target else 1
+        first = 0
+        for i in range(nunits):
+            nreps = nboot // nunits + (i < nboot % nunits)
+            units.append((cost * nreps, lineage, first, nreps))
+            first += nreps
+    units.sort(key=lambda unit: (-unit[0], unit[1], unit[2]))
+    return units
+
+
+class TreeScheduler:
+    """
+    Head rank of a single MPI job that reconstructs bootstrap trees of all
+    lineages.  Work units from schedule_units() are handed to worker ranks
+    (see schedule_worker()) as they become idle, and the trees of each
+    lineage are written to file once all of its replicates are returned.
+    """
+
+    def __init__(self, comm, units, nboot, outdir, any_source=None, callback=None):
+        """
+        :param comm:  mpi4py.MPI.Comm, communicator
+        :param units:  list, from schedule_units()
+        :param nboot:  int, number of bootstrap replicates per lineage
+        :param outdir:  str, path to directory to write trees
+        :param any_source:  int, MPI.ANY_SOURCE
+        :param callback:  function, optional for progress monitoring
+        """
+        self.comm = comm
+        self.units = list(units)
+        self.nboot = nboot
+        self.outdir = outdir
+        self.any_source = any_source
+        self.callback = callback
+        self.trees = {}  # replicates returned so far, keyed by first index, by lineage
+        self.stats = {}  # units, busy and elapsed time by rank
+
+    def run(self):
+        """ Serve work units until all worker ranks have been stopped """
+        start = time.perf_counter()
+        nworkers = self.comm.Get_size() - 1
+        pending = deque(self.units)
+        while nworkers > 0:
+            message = self.comm.recv(source=self.any_source)
+            rank = message[1]
+            stats = self.stats.setdefault(rank, {'units': 0, 'busy': 0., 'elapsed': 0.})
+            if message[0] == 'result':
+                _, _, lineage, first, trees, busy = message
+                stats['units'] += 1
+                stats['busy'] += busy
+                self.collect(lineage, first, trees)
+
+            if pending:
+                _, lineage, first, nreps = pending.popleft()
+                self.comm.send((lineage, first, nreps), dest=rank)
+            else:
+                self.comm.send(None, dest=rank)
+                stats['elapsed'] = time.perf_counter() - start
+                nworkers -= 1
+
+        if self.callback:
+            for line in self.report(time.perf_counter() - start):
+                self.callback(line)
+
+    def run_local(self, recoded, binpath='rapidnj', backend='rapidnj', stream=False):
+        """
+        Process all work units on the head rank, for a job without worker
+        ranks.  Arguments as schedule_worker().
+        """
+        start = time.perf_counter()
+        stats = self.stats.setdefault(0, {'units': 0, 'busy': 0., 'elapsed': 0.})
+        incidence = {}
+        for _, lineage, first, nreps in self.units:
+            trees = _unit_trees(recoded, incidence, lineage, nreps, binpath,
+                                backend=backend, callback=self.callback, stream=stream)
+            stats['units'] += 1
+            self.collect(lineage, first, trees)
+        stats['elapsed'] = stats['busy'] = time.perf_counter() - start
+
+        if self.callback:
+            for line in self.report(time.perf_counter() - start):
+                self.callback(line)
+
+    def collect(self, lineage, first, trees):
+        """ Store replicates of lineage, and write trees once complete """
+        received = self.trees.setdefault(lineage, {})
+        received[first] = trees
+        if sum(map(len, received.values())) < self.nboot:
+            return
+        del self.trees[lineage]
+        write_newick(self.outdir, lineage,
+                     [tree for key in sorted(received) for tree in received[key]])
+        if self.callback:
+            self.callback(f"wrote {self.nboot} trees of {lineage}", level='DEBUG')
+
+    def report(self, elapsed):
+        """
+        :param elapsed:  float, run time of head rank in seconds
+        :return:  list, str summaries of utilisation by worker rank
+        """
+        lines = []
+        total = 0.
+        for rank in sorted(self.stats):
+            stats = self.stats[rank]
+            total += stats['busy']
+            util = stats['busy'] / elapsed if elapsed > 0 else 0.
+            lines.append(f"rank {rank}: {stats['units']} units, {stats['busy']:.1f}s busy, "
+                         f"idle after {stats['elapsed']:.1f}s, {util:.0%} utilisation")
+        if self.stats and elapsed > 0:
+            lines.append(f"{len(self.units)} units in {elapsed:.1f}s, "
+                         f"{total / (elapsed * len(self.stats)):.0%} mean utilisation")
+        return lines
+
+
+def _unit_trees(recoded, incidence, lineage, nreps, binpath='rapidnj', backend='rapidnj',
+                callback=None, stream=False):
+    """
+    Reconstruct bootstrap replicates of one work unit from schedule_units()
+
+    :param incidence:  dict, incidence matrix of the last lineage, as units of
+                       a lineage often follow; replaced for a new lineage
+    :param lineage:  str, lineage name
+    :param nreps:  int, number of replicates
+    :return:  list, Newick tree strings
+    """
+    if lineage not in incidence:
+        rdata = recoded[lineage]
+        incidence.clear()
+        incidence[lineage] = incidence_matrix(rdata['indexed'], len(rdata['union']))
+    return [newick_string(replicate(incidence[lineage], binpath, callback=callback,
+                                    backend=backend, stream=stream))
+            for _ in range(nreps)]
+
+
+def schedule_worker(comm, recoded, binpath='rapidnj', backend='rapidnj', callback=None,
+                    stream=False):
+    """
+    Worker rank of TreeScheduler, reconstruct bootstrap replicates of the
+    work units it is sent until it receives None.
+
+    :param comm:  mpi4py.MPI.Comm, communicator
+    :param recoded:  dict, with 'union' and 'indexed' entries by lineage
+    :param binpath:  str, path to RapidNJ binary executable
+    :param backend:  str, 'rapidnj' or 'builtin' for in-process neighbor-joining
+    :param callback:  function, optional for progress monitoring
+    :param stream:  bool, stream distance matrices to RapidNJ, see stream_rapidnj()
+    """
+    rank = comm.Get_rank()
+    incidence = {}  # of the last lineage, as units of a lineage often follow
+    comm.send(('ready', rank), dest=0)
+    while True:
+        unit = comm.recv(source=0)
+        if unit is None:
+            return
+        lineage, first, nreps = unit
+        start = time.perf_counter()
+        trees = _unit_trees(recoded, incidence, lineage, nreps, binpath, backend=backend,
+                            callback=callback, stream=stream)
+        comm.send(('result', rank, lineage, first, trees, time.perf_counter() - start),
+                  dest=0)
 
 
 def label_nodes(tree, tip_index):
@@ -134,11 +707,33 @@ def label_nodes(tree, tip_index):
     return tree
 
 
+def tree_terminals(tree):
+    """
+    :param tree:  Phylo.BaseTree or nj_utils.NJTree object
+    :return:  iterable, (label, branch length) of each tip
+    """
+    if isinstance(tree, NJTree):
+        return tree.terminals()
+    return ((tip.name, tip.branch_length) for tip in tree.get_terminals())
+
+
+def tree_splits(tree, tip_index):
+    """
+    :param tree:  Phylo.BaseTree or nj_utils.NJTree object
+    :param tip_index:  dict, integer indices keyed by tip name
+    :return:  iterable, (sorted tip indices, branch length) of each internal node
+    """
+    if isinstance(tree, NJTree):
+        return tree.splits(tip_index)
+    tree = label_nodes(tree, tip_index)  # aggregates tip indices down tree
+    return ((node.tip_index, node.branch_length) for node in tree.get_nonterminals())
+
+
 def consensus(input_trees, cutoff=0.5, callback=None):
     """
     Generate a consensus tree by counting splits and using the splits with
     frequencies above the cutoff to resolve a star tree.
-    :param input_trees:  iterable containing Phylo.BaseTree objects
+    :param input_trees:  iterable containing Phylo.BaseTree or nj_utils.NJTree objects
     :param cutoff:  float, bootstrap threshold (default 0.5)
     :param callback:  function, optional callback
     :return:  Phylo.BaseTree
@@ -148,8 +743,8 @@ def consensus(input_trees, cutoff=0.5, callback=None):
 
     # store terminal labels and branch lengths
     tip_index = {}
-    for i, tip in enumerate(tree.get_terminals()):
-        tip_index.update({tip.name: i})
+    for i, (name, _) in enumerate(tree_terminals(tree)):
+        tip_index.update({name: i})
 
 
     if callback:
@@ -159,19 +754,18 @@ def consensus(input_trees, cutoff=0.5, callback=None):
 
     while True:
         # record terminal branch lengths
-        for tip in tree.get_terminals():
-            terminals[tip.name] += tip.branch_length
+        for name, branch_length in tree_terminals(tree):
+            terminals[name] += branch_length
 
         # record splits in tree
-        tree = label_nodes(tree, tip_index)  # aggregates tip indices down tree
-        for node in tree.get_nonterminals():
-            key = ','.join(map(str, node.tip_index))
+        for tips, branch_length in tree_splits(tree, tip_index):
+            key = ','.join(map(str, tips))
             if key not in splits:
                 splits.update({key: {'sum': 0., 'count': 0}})
 
-            if node.branch_length is not None:
+            if branch_length is not None:
                 # None interpreted as zero length (e.g., root branch)
-                splits[key]['sum'] += node.branch_length
+                splits[key]['sum'] += branch_length
             splits[key]['count'] += 1
         try:
             tree = next(input_trees)
@@ -230,7 +824,18 @@ def build_trees(records, input_args, callback=None):
     if len(idxed) == 1:
         # only one variant, no meaningful tree
         return None, recode_labels
-    out_trees = [bootstrap(recode_union, idxed, input_args.binpath, callback=callback)
+    stream = stream_rapidnj(input_args, callback=callback)
+    if input_args.nj_workers > 1:
+        # split replicates across local processes
+        recoded = {'': {'union': recode_union, 'indexed': idxed}}
+        _, out_trees = next(pool_trees(
+            recoded, input_args.nboot, input_args.nj_workers, input_args.binpath,
+            backend=input_args.nj_backend, deep=recoded, stream=stream))
+        out_trees = [Phylo.read(StringIO(tree), 'newick') if isinstance(tree, str) else tree
+                     for tree in out_trees]
+        return out_trees, recode_labels
+    out_trees = [bootstrap(recode_union, idxed, input_args.binpath, callback=callback,
+                           backend=input_args.nj_backend, stream=stream)
             for _ in range(input_args.nboot)]
     return out_trees, recode_labels
 
@@ -247,7 +852,7 @@ def parse_args():
         "lineage",
         type=str,
         help="input, name of lineage to process ('deep' mode) or path to "
-        "text file of minor lineage names ('flat' mode)")
+        "text file of lineage names ('flat' and 'schedule' modes)")
 
     parser.add_argument(
         "--mode",
@@ -255,7 +860,10 @@ def parse_args():
         default='deep',
         help="'flat' mode distributes many lineages across MPI nodes, whereas"
         "'deep' mode distributes bootstrap replicates for a single lineage "
-        "across MPI nodes.  Defaults to 'deep'.")
+        "across MPI nodes.  'schedule' mode hands out ranges of replicates "
+        "of all lineages from a head rank to idle worker ranks, or processes "
+        "them on the head rank if it is the only one.  Defaults "
+        "to 'deep'.")
 
     parser.add_argument(
         "-o",
@@ -268,6 +876,17 @@ def parse_args():
                         help="Number of bootstrap samples, default 100.")
     parser.add_argument("--binpath", type=str, default='rapidnj',
                         help="Path to RapidNJ binary executable.")
+    parser.add_argument("--nj-backend", type=str, default='rapidnj',
+                        choices=['rapidnj', 'builtin'],
+                        help="option, reconstruct trees with RapidNJ or with "
+                             "built-in neighbor-joining, default 'rapidnj'")
+    parser.add_argument("--nj-workers", type=int, default=1,
+                        help="option, if >1, reconstruct trees with this many "
+                             "local processes instead of MPI")
+    parser.add_argument("--nj-stream", action='store_true',
+                        help="option, stream distance matrices to RapidNJ through "
+                             "a pipe instead of temporary files, if RapidNJ can read "
+                             "them from /dev/stdin")
     parser.add_argument("--timestamp", type=float, default=None,
                         help="option, timestamp to set callback function")
     parser.add_argument(
@@ -293,16 +912,8 @@ def unpack_recoded(input_recoded, input_lineage, callback=None):
             callback(f"ERROR: JSON did not contain lineage {args.lineage}")
         sys.exit()
 
-    union1 = rdata['union']  # unpack JSON data
-    union2 = {}
-    for feat, idx in union1.items():
-        typ, pos, length = feat.split('|')
-        if typ == '-':
-            # length of deletion is an integer
-            key = tuple([typ, int(pos), int(length)])
-        else:
-            key = tuple([typ, int(pos), length])
-        union2.update({key: idx})
+    # unpack JSON data, mutation codes are serialized as str keys
+    union2 = {int(code): idx for code, idx in rdata['union'].items()}
 
     recoded_indexed = [set(l) for l in rdata['indexed']]  # see #335
     return union2, rdata['labels'], recoded_indexed
@@ -310,6 +921,27 @@ def unpack_recoded(input_recoded, input_lineage, callback=None):
 #   Called by batch.py via subprocess to handle lineages with excessive
 #   numbers of genomes, to process via MPI
 if __name__ == "__main__":
+    # command-line execution
+    args = parse_args()
+
+    if args.nj_workers > 1:
+        # process pool on this node, without MPI
+        cb = Callback(initial_time=args.timestamp)
+        with open(args.json, encoding='utf-8') as handle:
+            recoded = json.load(handle)
+        if args.mode == 'deep':
+            write_trees(recoded, [args.lineage], args.outdir, args, deep=[args.lineage],
+                        callback=cb.callback)
+        elif args.mode in ('flat', 'schedule'):
+            with open(args.lineage, encoding='utf-8') as handle:
+                minor_lineages = [line.strip() for line in handle]
+            deep = minor_lineages if args.mode == 'schedule' else ()
+            write_trees(recoded, minor_lineages, args.outdir, args, deep=deep,
+                        callback=cb.callback)
+        else:
+            cb.callback(f"Unexpected mode argument {args.mode} in clustering.py")
+        sys.exit()
+
     try:
         from mpi4py import MPI
     except ModuleNotFoundError:
@@ -319,10 +951,8 @@ if __name__ == "__main__":
     comm = MPI.COMM_WORLD
     my_rank = comm.Get_rank()
     nprocs = comm.Get_size()
-
-    # command-line execution
-    args = parse_args()
     cb = Callback(initial_time=args.timestamp, my_rank=my_rank, nprocs=nprocs)
+    stream = stream_rapidnj(args, callback=cb.callback)
 
     # import lineage data from file
     with open(args.json, encoding='utf-8') as handle:
@@ -347,7 +977,10 @@ if __name__ == "__main__":
             for bn in range(args.nboot):
                 if bn % nprocs == my_rank:
                     phy = bootstrap(
-                        union, indexed, args.binpath, callback=cb.callback)
+                        union, indexed, args.binpath, callback=cb.callback,
+                        backend=args.nj_backend, stream=stream)
+                    if isinstance(phy, NJTree):
+                        phy = phy.to_phylo()
                     trees.append(phy)
             comm.Barrier()  # wait for other processes to finish
             result = comm.gather(trees, root=0)
@@ -384,9 +1017,37 @@ if __name__ == "__main__":
                         union,
                         indexed,
                         args.binpath,
-                        callback=cb.callback) for _ in range(
+                        callback=cb.callback,
+                        backend=args.nj_backend,
+                        stream=stream) for _ in range(
                         args.nboot)]
+                trees = [phy.to_phylo() if isinstance(phy, NJTree) else phy
+                         for phy in trees]
                 Phylo.write(trees, file=outfile, format='newick')
+
+    elif args.mode == 'schedule':
+        if my_rank == 0:
+            with open(args.lineage, encoding='utf-8') as handle:
+                lineages = [line.strip() for line in handle if line.strip()]
+            multi = []
+            for lineage in lineages:
+                if len(recoded[lineage]['indexed']) == 1:
+                    write_newick(args.outdir, lineage, [single_variant_tree(recoded[lineage])])
+                else:
+                    multi.append(lineage)
+            units = schedule_units(recoded, multi, args.nboot, nprocs - 1)
+            cb.callback(f"scheduling {len(units)} units of {len(multi)} lineages")
+            scheduler = TreeScheduler(comm, units, args.nboot, args.outdir,
+                                      any_source=MPI.ANY_SOURCE, callback=cb.callback)
+            if nprocs < 2:
+                # no worker ranks, e.g. single slot in machine file
+                scheduler.run_local(recoded, args.binpath, backend=args.nj_backend,
+                                    stream=stream)
+            else:
+                scheduler.run()
+        else:
+            schedule_worker(comm, recoded, args.binpath, backend=args.nj_backend,
+                            callback=cb.callback, stream=stream)
     else:
         cb.callback(f"Unexpected mode argument {args.mode} in clustering.py")
         sys.exit()
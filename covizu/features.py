@@ -0,0 +1,242 @@
+"""distributed feature extraction across MPI ranks"""
+import argparse
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+from collections import deque
+
+from covizu import minimap2
+from covizu.utils import gisaid_utils
+from covizu.utils.db_utils import FeatureStore
+from covizu.utils.progress_utils import Callback
+
+try:
+    from mpi4py import MPI
+except ModuleNotFoundError:
+    MPI = None
+
+
+class FeatureCollector:
+    """
+    Stands in for a FeatureStore on worker ranks, keeping copies of newly
+    extracted features to be inserted into the store by the head rank.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def insert(self, record):
+        """ :param record:  dict, with 'diffs' and 'missing' entries """
+        # missing sites are immutable PackedIntervals
+        self.records.append(dict(record, diffs=list(record['diffs'])))
+
+    def commit(self):
+        """ Nothing to commit on worker ranks """
+
+
+class BatchExchange:
+    """
+    Worker side of the exchange of batches with the head rank.  Batches are
+    requested as they are consumed by extract_features(), and the records of
+    each batch are returned to the head rank, sorted by lineage, once
+    extract_features() reports the batch as complete.
+    """
+
+    def __init__(self, comm, collector=None):
+        """
+        :param comm:  mpi4py.MPI.Comm, communicator
+        :param collector:  FeatureCollector, optional; new features are
+                           returned with each batch
+        """
+        self.comm = comm
+        self.collector = collector
+        self.indices = deque()  # batches received and not yet returned
+        self.records = []  # filtered records of oldest pending batch
+        self.nbatches = 0
+
+    def batches(self):
+        """ :yield:  str, list; FASTA and records of batch, from batch_fasta() """
+        while True:
+            self.comm.send(('ready', ), dest=0)
+            item = self.comm.recv(source=0)
+            if item is None:
+                return
+            index, batch = item
+            self.indices.append(index)
+            yield batch
+
+    def batch_done(self):
+        """ Return records of oldest pending batch to head rank """
+        features = []
+        if self.collector is not None:
+            features, self.collector.records = self.collector.records, []
+        partial = gisaid_utils.sort_by_lineage(self.records)
+        self.comm.send(('result', self.indices.popleft(), partial, features), dest=0)
+        self.records = []
+        self.nbatches += 1
+
+
+def worker(args, comm, callback=None):
+    """
+    Align batches received from the head rank, and return features of
+    genomes that pass filtering, sorted by lineage.
+
+    :param args:  Namespace, arguments of batch.py
+    :param comm:  mpi4py.MPI.Comm, communicator
+    :param callback:  function, optional callback function
+    """
+    collector = FeatureCollector() if args.feature_store else None
+    exchange = BatchExchange(comm, collector=collector)
+    pool = None
+    if args.mmworkers > 1:
+        pool = minimap2.Minimap2Pool(
+            args.ref, nthread=args.mmthreads, nworkers=args.mmworkers,
+            minlen=args.minlen)
+    caller = minimap2.AnchoredCaller(args.ref) if args.fast_diffs else None
+    record_filter = gisaid_utils.RecordFilter(
+        vcf_file=args.vcf, cutoff=args.poisson_cutoff, fused=args.fused_filter)
+    aligned = gisaid_utils.extract_features(
+        exchange.batches(),
+        ref_file=args.ref,
+        binpath=args.mmbin,
+        nthread=args.mmthreads,
+        minlen=args.minlen,
+        store=collector,
+        pool=pool,
+        checkpoint=exchange,
+        caller=caller,
+        record_filter=record_filter)
+    for record in aligned:
+        exchange.records.append(record)
+    if callback:
+        record_filter.report(callback)
+    if pool:
+        pool.close()
+    if callback:
+        callback(f"aligned {exchange.nbatches} batches")
+
+
+def head(args, comm, callback=None):
+    """
+    Distribute batches of records to worker ranks, and merge their results
+    in input order.
+
+    :param args:  Namespace, arguments of batch.py
+    :param comm:  mpi4py.MPI.Comm, communicator
+    :param callback:  function, optional callback function
+    :return:  dict or SpilledLineages, as returned by sort_by_lineage()
+    """
+    store = None
+    if args.feature_store:
+        store = FeatureStore(args.feature_store)
+    result = gisaid_utils.new_by_lineage(args)
+
+    loader = gisaid_utils.load_gisaid(
+        args.infile,
+        minlen=args.minlen,
+        mindate=args.mindate,
+        callback=callback,
+        nworkers=args.nworkers,
+        parser=args.parser)
+    batcher = gisaid_utils.batch_fasta(loader, size=args.batchsize, store=store)
+
+    pending = {}  # results of batches that arrived out of order
+    nsent = nmerged = 0
+    nworkers = comm.Get_size() - 1
+    status = MPI.Status()
+    while nworkers > 0 or nmerged < nsent:
+        message = comm.recv(source=MPI.ANY_SOURCE, status=status)
+        if message[0] == 'ready':
+            batch = next(batcher, None)
+            if batch is None:
+                comm.send(None, dest=status.Get_source())
+                nworkers -= 1
+            else:
+                comm.send((nsent, batch), dest=status.Get_source())
+                nsent += 1
+            continue
+
+        _, index, partial, features = message
+        pending[index] = partial
+        for record in features:
+            store.insert(record)
+        while nmerged in pending:
+            gisaid_utils.merge_lineages(result, pending.pop(nmerged))
+            nmerged += 1
+            if callback and nmerged % 10 == 0:
+                callback(f"merged {nmerged} of {nsent} batches")
+
+    if store:
+        store.close()
+    return result
+
+
+def process_feed_mpi(args, callback=None, initial_time=None):
+    """
+    Run feature extraction across MPI ranks listed in the machine file.  The
+    head rank reads and batches records, and worker ranks align and filter
+    them.  Called from batch.py in place of process_feed().
+
+    :param args:  Namespace, arguments of batch.py
+    :param callback:  function, optional callback function
+    :param initial_time:  float, timestamp to set callback function of MPI ranks
+    :return:  dict or SpilledLineages, as returned by sort_by_lineage()
+    """
+    with tempfile.TemporaryDirectory(dir=args.outdir) as tmpdir:
+        argsfile = os.path.join(tmpdir, 'args.pickle')
+        outfile = os.path.join(tmpdir, 'by_lineage.pickle')
+        with open(argsfile, 'wb') as handle:
+            pickle.dump(args, handle)
+
+        if callback:
+            callback("start MPI feature extraction")
+        cmd = ["mpirun", "--machinefile", args.machine_file, "python3", "covizu/features.py",
+               argsfile, outfile]  # positional arguments <args pickle>, <output pickle>
+        if initial_time:
+            cmd.extend(["--timestamp", str(initial_time)])
+        subprocess.check_call(cmd)
+
+        with open(outfile, 'rb') as handle:
+            return pickle.load(handle)
+
+
+def parse_args():
+    """ Command-line interface """
+    parser = argparse.ArgumentParser(
+        description="Align genomes and extract features across MPI ranks")
+    parser.add_argument("args", type=str,
+                        help="input, pickled arguments of batch.py")
+    parser.add_argument("outfile", type=str,
+                        help="output, path to write pickled records sorted by lineage")
+    parser.add_argument("--timestamp", type=float, default=None,
+                        help="option, timestamp to set callback function")
+    return parser.parse_args()
+
+
+#   Called by batch.py via subprocess to distribute alignment of genomes
+if __name__ == "__main__":
+    if MPI is None:
+        print("Script requires mpi4py - https://pypi.org/project/mpi4py/")
+        sys.exit()
+
+    comm = MPI.COMM_WORLD
+    my_rank = comm.Get_rank()
+    nprocs = comm.Get_size()
+
+    cli_args = parse_args()
+    cb = Callback(initial_time=cli_args.timestamp, my_rank=my_rank, nprocs=nprocs)
+    with open(cli_args.args, 'rb') as handle:
+        batch_args = pickle.load(handle)
+
+    if nprocs < 2:
+        cb.callback("MPI feature extraction requires at least 2 processes", level='ERROR')
+        sys.exit(1)
+
+    if my_rank == 0:
+        by_lineage = head(batch_args, comm, callback=cb.callback)
+        with open(cli_args.outfile, 'wb') as handle:
+            pickle.dump(by_lineage, handle)
+    else:
+        worker(batch_args, comm, callback=cb.callback)
@@ -5,9 +5,225 @@ import re
 import sys
 import os
 import json
+import pickle
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import pkg_resources
 import covizu
 from covizu.utils import gisaid_utils
+from covizu.utils.seq_utils import convert_fasta
+
+try:
+    import mappy
+except ModuleNotFoundError:
+    mappy = None
+
+MM_F_EQX = 0x4000000  # minimap2 flag for =/X CIGAR operators, as --eqx
+
+
+_CIGAR_PATTERN = re.compile(r'(?:\d+[MIDNSHPX=])*')
+_CIGAR_OPERATOR = re.compile(r'([MIDNSHPX=])')
+
+
+def parse_cigar(cigar):
+    """
+    Validate and decode a CIGAR string into operations.
+
+    :param cigar:  str, CIGAR string
+    :return:  list, (length, operator) tuples
+    """
+    if not _CIGAR_PATTERN.fullmatch(cigar):
+        raise RuntimeError(f'Invalid CIGAR string: {cigar!r}.')
+    # alternating lengths and operators, with empty string at end
+    tokens = _CIGAR_OPERATOR.split(cigar)
+    return list(zip(map(int, tokens[0:-1:2]), tokens[1::2]))
+
+
+def align_cigar(sequence, rpos, cigar, reflen=0):
+    """
+    Use CIGAR to pad sequence with gaps as required to align to reference.
+    Segments are collected and joined once, so that the cost is linear in
+    the length of the alignment.
+
+    :param sequence:  str, query sequence
+    :param rpos:  int, 0-index position of alignment start in reference
+    :param cigar:  str, CIGAR string
+    :param reflen:  int, length of reference genome to pad sequence on the
+                    right; defaults to no padding.
+    :return:  str, aligned sequence
+    """
+    segments = ['-' * rpos]
+    left, right = 0, rpos  # index for query, reference
+    for length, operator in parse_cigar(cigar):
+        if operator in 'M=X':
+            segments.append(sequence[left:(left + length)])
+            left += length
+            right += length
+        elif operator == 'D':
+            segments.append('-' * length)
+            right += length
+        elif operator in 'SI':
+            left += length  # soft clip
+    if right < reflen:
+        # pad on right
+        segments.append('-' * (reflen - right))
+    return ''.join(segments)
+
+
+def cigar_diffs(sequence, rpos, cigar, reflen, alphabet='ACGT'):
+    """
+    Use CIGAR to serialize differences of query sequence to reference genome,
+    which comprise nucleotide substitutions, in-frame indels, and locations
+    of missing data.  Requires =/X operators (minimap2 --eqx).
+
+    :param sequence:  str, query sequence
+    :param rpos:  int, 0-index position of alignment start in reference
+    :param cigar:  str, CIGAR string
+    :param reflen:  int, length of reference genome
+    :param alphabet:  str, nucleotides reported as substitutions; other
+                      mismatched characters are reported as missing
+    :return:  list, list; differences and missing intervals
+    """
+    differences = []
+    missing_data = []
+    if rpos > 0:
+        # incomplete on left
+        missing_data.append((0, rpos))
+
+    left, right = 0, rpos  # index for query, reference
+    for length, operator in parse_cigar(cigar):
+        if operator == '=':
+            # exact match
+            left += length
+            right += length
+        elif operator == 'X':
+            # each nucleotide is a separate diff
+            substr = sequence[left:(left + length)]
+            if len(substr) == 1 and substr in alphabet:
+                # most common case
+                differences.append(('~', right, substr))
+            elif 'N' in substr:
+                # for now, assume the whole substring is bs
+                missing_data.append((right, right + length))
+            else:
+                # assume adjacent mismatches are independent substitutions
+                for i, nucleotide in enumerate(substr):
+                    if nucleotide in alphabet:
+                        differences.append(('~', right + i, nucleotide))
+                    else:
+                        # skip ambiguous base calls, like "R"
+                        missing_data.append((right + i, right + i + 1))
+            left += length
+            right += length
+        elif operator == 'S':
+            # discard soft clip
+            left += length
+        elif operator == 'I':
+            # insertion relative to reference
+            differences.append(('+', right, sequence[left:(left + length)]))
+            left += length
+        elif operator == 'D':
+            # deletion relative to reference
+            differences.append(('-', right, length))
+            right += length
+        elif operator == 'H':
+            # hard clip, do nothing
+            pass
+        else:
+            raise RuntimeError(f'Unexpected CIGAR operator {operator!r} in {cigar!r}.')
+
+    # update missing if sequence incomplete on the right
+    if right < reflen:
+        missing_data.append((right, reflen))
+
+    return differences, missing_data
+
+
+def cigar_filtered(sequence, rpos, cigar, reflen, mask, alphabet='ACGT'):
+    """
+    As cigar_diffs(), with the exclusions of filter_problematic() applied as
+    the CIGAR is decoded: substitutions at problematic sites and insertions
+    with uncalled bases are skipped, and the numbers of skipped features and
+    of missing sites are counted, without a second pass over either list.
+
+    :param sequence:  str, query sequence
+    :param rpos:  int, 0-index position of alignment start in reference
+    :param cigar:  str, CIGAR string
+    :param reflen:  int, length of reference genome
+    :param mask:  seq_utils.ProblematicMask, problematic sites
+    :param alphabet:  str, nucleotides reported as substitutions
+    :return:  list, list, int, int; retained differences, missing intervals,
+              number of excluded features and number of missing sites
+    """
+    bits, size = mask.bits, len(mask.bits)
+    # bitmap codes of nucleotides in alphabet; others are checked against site
+    codes = {nt: code for nt, code in mask.codes.items() if nt in alphabet}
+    differences = []
+    missing_data = []
+    nmasked = 0
+    nmissing = rpos
+    if rpos > 0:
+        missing_data.append((0, rpos))
+
+    left, right = 0, rpos  # index for query, reference
+    for length, operator in parse_cigar(cigar):
+        if operator == '=':
+            left += length
+            right += length
+        elif operator == 'X':
+            substr = sequence[left:(left + length)]
+            code = codes.get(substr, None) if length == 1 else None
+            if code is not None:
+                # most common case
+                if right < size and bits[right] & code:
+                    nmasked += 1
+                else:
+                    differences.append(('~', right, substr))
+            elif 'N' in substr:
+                missing_data.append((right, right + length))
+                nmissing += length
+            else:
+                for i, nucleotide in enumerate(substr):
+                    if nucleotide not in alphabet:
+                        missing_data.append((right + i, right + i + 1))
+                        nmissing += 1
+                        continue
+                    pos = right + i
+                    code = codes.get(nucleotide, None)
+                    if code is None:
+                        masked = mask._masked(pos, nucleotide)  # pylint: disable=protected-access
+                    else:
+                        masked = pos < size and bits[pos] & code
+                    if masked:
+                        nmasked += 1
+                    else:
+                        differences.append(('~', pos, nucleotide))
+            left += length
+            right += length
+        elif operator == 'S':
+            left += length
+        elif operator == 'I':
+            insert = sequence[left:(left + length)]
+            if 'N' in insert:
+                nmasked += 1
+            else:
+                differences.append(('+', right, insert))
+            left += length
+        elif operator == 'D':
+            differences.append(('-', right, length))
+            right += length
+        elif operator == 'H':
+            pass
+        else:
+            raise RuntimeError(f'Unexpected CIGAR operator {operator!r} in {cigar!r}.')
+
+    if right < reflen:
+        missing_data.append((right, reflen))
+        nmissing += reflen - right
+
+    return differences, missing_data, nmasked, nmissing
 
 
 def apply_cigar(sequence, rpos, cigar):
@@ -15,24 +231,32 @@ def apply_cigar(sequence, rpos, cigar):
     Use CIGAR to pad sequence with gaps as required to
     align to reference.  Adapted from http://github.com/cfe-lab/MiCall
     """
-    is_valid = re.match(r'^((\d+)([MIDNSHPX=]))*$', cigar)
+    return align_cigar(sequence, rpos, cigar)
 
-    if not is_valid:
-        raise RuntimeError(f'Invalid CIGAR string: {cigar!r}.')
-    tokens = re.findall(r'  (\d+)([MIDNSHPX=])', cigar, re.VERBOSE)
-    aligned = '-' * rpos
-    left = 0
-    for length, operation in tokens:
-        length = int(length)
-        if operation in 'M=X':
-            aligned += sequence[left:(left + length)]
-            left += length
-        elif operation == 'D':
-            aligned += '-' * length
-        elif operation in 'SI':
-            left += length  # soft clip
 
-    return aligned
+def _feed_stdin(stdin, infile, errors):
+    """
+    Write FASTA input to minimap2 from a separate thread, so that stdout can
+    be consumed while input is still being written.
+
+    :param stdin:  file object, stdin of minimap2 process
+    :param infile:  str, or iterable of str chunks of FASTA-formatted text
+    :param errors:  list, collects exception raised while writing
+    """
+    try:
+        if isinstance(infile, str):
+            infile = [infile]
+        for chunk in infile:
+            stdin.write(chunk)
+    except BrokenPipeError:
+        pass  # minimap2 exited early, reported by reader
+    except Exception as err:  # pylint: disable=broad-except
+        errors.append(err)
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
 
 
 def minimap2(
@@ -45,9 +269,13 @@ def minimap2(
     """
     Wrapper function for minimap2.
 
-    :param infile:  file object or StringIO
+    :param infile:  file object or StringIO; or with <stream>, str or iterable
+                    of str chunks of FASTA-formatted text
     :param ref:  str, path to FASTA with reference sequence(s)
-    :param stream:  bool, if True then stream data from <infile> object via stdin
+    :param stream:  bool, if True then stream data from <infile> object via stdin.
+                    Input is written by a feeder thread while SAM output is
+                    parsed line by line, so memory use does not grow with
+                    the size of the output.
     :param path:  str, path to binary executable
     :param nthread:  int, number of threads for parallel execution of minimap2
     :param minlen:  int, filter genomes below minimum length; to accept all, set to 0.
@@ -56,13 +284,25 @@ def minimap2(
              sequence
     """
     if stream:
-        # input from StringIO in memory
-        with subprocess.Popen(
+        # input from memory, written to stdin by feeder thread
+        process = subprocess.Popen(
             [path, '-t', str(nthread), '-a', '--eqx', ref, '-'], encoding='utf8',
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
-        ) as process:
-            output = process.communicate(infile)[0]
-            output = output.split('\n')
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        errors = []
+        feeder = threading.Thread(target=_feed_stdin, args=(process.stdin, infile, errors),
+                                  daemon=True)
+        feeder.start()
+        try:
+            yield from _parse_sam(process.stdout, minlen)
+        finally:
+            # consumer may stop early, unblock feeder before joining
+            if process.poll() is None:
+                process.kill()
+            feeder.join()
+            process.stdout.close()
+            process.wait()
+        if errors:
+            raise errors[0]
     else:
         # input read from file
         with subprocess.Popen(
@@ -70,10 +310,20 @@ def minimap2(
             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
         ) as process:
             output = map(lambda x: x.decode('utf-8'), process.stdout)
+            yield from _parse_sam(output, minlen)
+
 
+def _parse_sam(output, minlen):
+    """
+    Parse SAM lines from minimap2
+
+    :param output:  iterable, lines of SAM output
+    :param minlen:  int, filter genomes below minimum length
+    :yield:  query sequence name, reference index, CIGAR and original sequence
+    """
     for out_line in output:
-        if out_line == '' or out_line.startswith('@'):
-            # split on \n leaves empty line; @ prefix header lines
+        if out_line in ('', '\n') or out_line.startswith('@'):
+            # skip empty lines and @ prefix header lines
             continue
         q_name, flag, rname, rpos, _, cigar, _, _, _, sequence = \
             out_line.strip('\n').split('\t')[:10]
@@ -86,50 +336,154 @@ def minimap2(
             # reject sequence that is too short
             continue
 
-        # validate CIGAR string
-        if not re.match(r'^((\d+)([MIDNSHPX=]))*$', cigar):
-            raise RuntimeError(f'Invalid CIGAR string: {cigar!r}.')
-
+        # CIGAR string is validated when decoded by parse_cigar()
         rpos = int(rpos) - 1  # convert to 0-index
         yield q_name, rpos, cigar, sequence
 
 
+class Minimap2Pool:
+    """
+    In-process minimap2 aligner, via the mappy bindings, with a persistent
+    pool of worker threads.  The reference index is built once and shared by
+    all workers; mappy releases the GIL while mapping, so batches are aligned
+    concurrently.  Batches are dispatched to the pool and results are
+    returned in order of submission, in the same form as minimap2().
+    """
+
+    def __init__(self, ref, nthread=3, nworkers=2, minlen=29000):
+        """
+        :param ref:  str, path to FASTA with reference sequence(s)
+        :param nthread:  int, threads used by mappy to build the index
+        :param nworkers:  int, number of worker threads aligning batches
+        :param minlen:  int, filter genomes below minimum length
+        """
+        if mappy is None:
+            raise RuntimeError("Minimap2Pool requires mappy - "
+                               "https://pypi.org/project/mappy/")
+        self.aligner = mappy.Aligner(ref, n_threads=nthread, extra_flags=MM_F_EQX)
+        if not self.aligner:
+            raise RuntimeError(f"Failed to load or build index for {ref}")
+        self.minlen = minlen
+        self.nworkers = nworkers
+        self.latencies = []  # seconds from submission to completion, by batch
+        self.executor = ThreadPoolExecutor(max_workers=nworkers)
+        self.buffers = threading.local()  # one mappy.ThreadBuffer per worker
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def align(self, fasta):
+        """
+        Align all sequences in a batch
+
+        :param fasta:  str, FASTA-formatted text
+        :return:  list, tuples of query name, reference index, CIGAR and
+                  original sequence, as yielded by minimap2()
+        """
+        if not hasattr(self.buffers, 'buf'):
+            self.buffers.buf = mappy.ThreadBuffer()
+        result = []
+        for block in fasta.split('>')[1:]:
+            header, _, sequence = block.partition('\n')
+            sequence = sequence.replace('\n', '')
+            if len(sequence) < self.minlen:
+                continue
+            for hit in self.aligner.map(sequence, buf=self.buffers.buf):
+                if not hit.is_primary:
+                    continue
+                # soft clip unaligned ends, as in SAM output
+                seqlen = len(sequence)
+                if hit.strand < 0:
+                    sequence = mappy.revcomp(sequence)
+                    left, right = seqlen - hit.q_en, hit.q_st
+                else:
+                    left, right = hit.q_st, seqlen - hit.q_en
+                cigar = ((f'{left}S' if left else '') + hit.cigar_str +
+                         (f'{right}S' if right else ''))
+                # truncate name at whitespace, as minimap2 does
+                result.append((header.split()[0], hit.r_st, cigar, sequence))
+                break  # report first primary alignment only
+        return result
+
+    def _task(self, fasta, start):
+        result = self.align(fasta)
+        return result, time.perf_counter() - start
+
+    def submit(self, fasta):
+        """
+        Queue a batch for alignment
+
+        :param fasta:  str, FASTA-formatted text
+        :return:  concurrent.futures.Future, pass to result()
+        """
+        return self.executor.submit(self._task, fasta, time.perf_counter())
+
+    def result(self, future):
+        """
+        Wait for alignment of a batch
+
+        :param future:  returned by submit()
+        :return:  list, return value of align()
+        """
+        result, latency = future.result()
+        self.latencies.append(latency)
+        return result
+
+    def map(self, batches):
+        """
+        Align batches with up to two batches in flight per worker
+
+        :param batches:  iterable, tuples of FASTA-formatted text and any
+                         associated data
+        :yield:  tuple, associated data and list of alignments from align(),
+                 in input order; alignments are None for empty FASTA
+        """
+        pending = deque()
+        for fasta, data in batches:
+            pending.append((data, self.submit(fasta) if fasta else None))
+            if len(pending) < 2 * self.nworkers:
+                continue
+            data, future = pending.popleft()
+            yield data, None if future is None else self.result(future)
+        while pending:
+            data, future = pending.popleft()
+            yield data, None if future is None else self.result(future)
+
+    def summary(self):
+        """ :return:  str, summary of per-batch alignment latency """
+        if not self.latencies:
+            return f"{self.nworkers} minimap2 workers aligned no batches"
+        mean = sum(self.latencies) / len(self.latencies)
+        return (f"{self.nworkers} minimap2 workers aligned {len(self.latencies)} batches, "
+                f"latency mean {mean:.2f}s, max {max(self.latencies):.2f}s")
+
+    def close(self):
+        """ Shut down worker threads """
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
 # return aligned sequence?
 def output_fasta(iterable, outfile, reflen=0):
     """
     Stream output from minimap2 into FASTA file
-    of aligned sequences.  CIGAR parsing code adapted from
-    http://github.com/cfe-lab/MiCall
+    of aligned sequences.
 
     :param iter:  generator from minimap2()
     :param outfile:  open file stream in write mode
     :param reflen:  int, length of reference genome to pad sequences;
                     defaults to no padding.
     """
-    for q_name, rpos, cigar, sequence in iterable:
-        tokens = re.findall(r'  (\d+)([MIDNSHPX=])', cigar, re.VERBOSE)
-        aligned = '-' * rpos
-        left = 0
-        for length, operation in tokens:
-            length = int(length)
-            if operation in 'M=X':
-                aligned += sequence[left:(left + length)]
-                left += length
-            elif operation == 'D':
-                aligned += '-' * length
-            elif operation in 'SI':
-                left += length  # soft clip
-
-        # pad on right
-        aligned += '-' * (reflen - len(aligned))
+    for q_name, aligned in stream_fasta(iterable, reflen=reflen):
         outfile.write(f'>{q_name}\n{aligned}\n')
 
 
 def stream_fasta(iterable, reflen=0):
     """
     Stream output from minimap2 into list of tuples [(header, seq), ... , (header, seq)]
-    of aligned sequences.  CIGAR parsing code adapted from
-    http://github.com/cfe-lab/MiCall
+    of aligned sequences.
 
     :param iter:  generator from minimap2()
     :param reflen:  int, length of reference genome to pad sequences;
@@ -137,22 +491,7 @@ def stream_fasta(iterable, reflen=0):
     :yield:  tuple, header and aligned sequence
     """
     for q_name, rpos, cigar, sequence in iterable:
-        tokens = re.findall(r'  (\d+)([MIDNSHPX=])', cigar, re.VERBOSE)
-        aligned = '-' * rpos
-        left = 0
-        for length, operation in tokens:
-            length = int(length)
-            if operation in 'M=X':
-                aligned += sequence[left:(left + length)]
-                left += length
-            elif operation == 'D':
-                aligned += '-' * length
-            elif operation in 'SI':
-                left += length  # soft clip
-
-        # pad on right
-        aligned += '-' * (reflen - len(aligned))
-        yield q_name, aligned
+        yield q_name, align_cigar(sequence, rpos, cigar, reflen=reflen)
 
 
 def encode_diffs(iterable, reflen, alphabet='ACGT'):
@@ -166,64 +505,336 @@ def encode_diffs(iterable, reflen, alphabet='ACGT'):
     :param reflen:  length of reference genome
     """
     for q_name, rpos, cigar, sequence in iterable:
-        differences = []
-        missing_data = []
-        pos = [0, rpos] # [index for query (left), rpos]
-        if pos[1] > 0:
-            # incomplete on left
-            missing_data.append(tuple([0, pos[1]]))
-
-        for length, operator in re.findall(r'  (\d+)([MIDNSHPX=])', cigar, re.VERBOSE):
-            length = int(length)
-            substr = sequence[pos[0]:(pos[0] + length)]
-            if operator == 'X':
-                # each nucleotide is a separate diff
+        differences, missing_data = cigar_diffs(
+            sequence, rpos, cigar, reflen, alphabet=alphabet)
+        yield q_name, differences, missing_data
+
+
+def encode_filtered(iterable, reflen, mask, alphabet='ACGT'):
+    """
+    As encode_diffs(), excluding problematic features while decoding each
+    CIGAR, see cigar_filtered().
+
+    :param iterable:  generator from minimap2()
+    :param reflen:  int, length of reference genome
+    :param mask:  seq_utils.ProblematicMask, problematic sites
+    :yield:  query name, differences, missing intervals, number of excluded
+             features and number of missing sites
+    """
+    for q_name, rpos, cigar, sequence in iterable:
+        yield (q_name, *cigar_filtered(sequence, rpos, cigar, reflen, mask,
+                                       alphabet=alphabet))
+
+
+class AnchoredCaller:
+    """
+    Call differences of genomes that are near-identical to the reference
+    directly, without alignment by minimap2.  Query k-mers are looked up in
+    an index of unique reference k-mers to anchor the query.  Runs of
+    anchors on one diagonal are compared base by base, and an isolated
+    indel between runs is placed at its leftmost position, as minimap2 does.
+
+    Genomes with dense or end-proximal differences, long runs of N, large or
+    nearby indels, or inconsistent anchors are not called (None), and
+    should be aligned by minimap2 instead.  Called genomes yield the same
+    diffs and missing intervals as encode_diffs() on minimap2 output.
+    """
+
+    def __init__(self, ref, k=16, step=8, maxindel=30, maxdrop=300, flank=50,
+                 alphabet='ACGT'):
+        """
+        :param ref:  str, path to FASTA with reference sequence
+        :param k:  int, anchor length
+        :param step:  int, spacing of query k-mers looked up in the index
+        :param maxindel:  int, maximum length of an indel to call
+        :param maxdrop:  int, maximum drop in alignment score (match 2,
+                         mismatch -4, N -1) between two points of the genome;
+                         minimap2 clips the alignment at larger drops (Z-drop)
+        :param flank:  int, minimum distance of an indel from the ends of the
+                       alignment, and of a substitution from an indel
+        :param alphabet:  str, nucleotides reported as substitutions
+        """
+        with open(ref, encoding='utf-8') as handle:
+            self.refseq = convert_fasta(handle)[0][1].upper()
+        self.reflen = len(self.refseq)
+        self.k = k
+        self.step = step
+        self.maxindel = maxindel
+        self.maxdrop = maxdrop
+        self.flank = flank
+        self.alphabet = alphabet
+
+        counts = {}
+        for i in range(self.reflen - k + 1):
+            kmer = self.refseq[i:(i + k)]
+            counts[kmer] = counts.get(kmer, 0) + 1
+        self.index = {}
+        for i in range(self.reflen - k + 1):
+            kmer = self.refseq[i:(i + k)]
+            if counts[kmer] == 1:
+                self.index[kmer] = i
+
+        self.ncalled = 0
+        self.nfallback = 0
+
+    def _anchors(self, sequence, qstart, qend):
+        """
+        :return:  list, runs of anchors as [first query position,
+                  last query position, diagonal] with diagonal = rpos - qpos;
+                  or None if anchors are not colinear
+        """
+        runs = []
+        for qpos in range(qstart, qend - self.k + 1, self.step):
+            rpos = self.index.get(sequence[qpos:(qpos + self.k)], None)
+            if rpos is None:
+                continue
+            diag = rpos - qpos
+            if runs and runs[-1][2] == diag:
+                runs[-1][1] = qpos
+                continue
+            if runs and (rpos <= runs[-1][1] + runs[-1][2] or
+                         abs(diag - runs[-1][2]) > self.maxindel):
+                return None  # rearranged, or indel too large
+            runs.append([qpos, qpos, diag])
+        return runs
+
+    def _match_length(self, sequence, qpos, diag, limit, reverse=False):
+        """ Number of matching bases from qpos on diagonal, up to limit """
+        refseq = self.refseq
+        for i in range(limit):
+            q = qpos - i - 1 if reverse else qpos + i
+            if not 0 <= q + diag < self.reflen or sequence[q] != refseq[q + diag]:
+                return i
+        return limit
+
+    def _place_indel(self, sequence, left, right):
+        """
+        Place an indel between two runs of anchors at its leftmost position,
+        requiring exact matches elsewhere between the anchors.
+
+        :param left:  list, run of anchors before indel
+        :param right:  list, run of anchors after indel
+        :return:  int, query position of indel; or None if not resolved
+        """
+        start, end = left[1], right[0] + self.k  # region bounded by anchors
+        length = right[2] - left[2]  # deletion if positive, insertion if negative
+        if end - start > 2 * self.maxindel + 4 * self.k:
+            return None  # long region without anchors
+        prefix = self._match_length(sequence, start, left[2], end - start)
+        suffix = self._match_length(sequence, end, right[2], end - start, reverse=True)
+        inserted = max(0, -length)
+        qpos = max(start, end - suffix - inserted)
+        if qpos > min(start + prefix, end - inserted) or qpos == start:
+            return None  # mismatches near indel, or may shift past anchor
+        return qpos
+
+    def _mismatches(self, sequence, qstart, qend, diag):
+        """ :return:  list, query positions of mismatches on diagonal """
+        refseq = self.refseq
+        result = []
+        for chunk in range(qstart, qend, 64):
+            chunk_end = min(chunk + 64, qend)
+            if sequence[chunk:chunk_end] == refseq[(chunk + diag):(chunk_end + diag)]:
+                continue
+            result.extend(q for q in range(chunk, chunk_end)
+                          if sequence[q] != refseq[q + diag])
+        return result
+
+    def call(self, sequence):
+        """
+        Call differences of a genome from the reference
+
+        :param sequence:  str, genome sequence
+        :return:  tuple, lists of differences and missing intervals as
+                  returned by cigar_diffs(); or None if genome should be
+                  aligned by minimap2
+        """
+        result = self._call(sequence)
+        if result is None:
+            self.nfallback += 1
+        else:
+            self.ncalled += 1
+        return result
+
+    def _call(self, sequence):
+        # minimap2 soft clips runs of N at the ends
+        qstart = len(sequence) - len(sequence.lstrip('N'))
+        qend = len(sequence.rstrip('N'))
+        runs = self._anchors(sequence, qstart, qend)
+        if not runs:
+            return None
+
+        # query intervals aligned on each diagonal, with indels in between
+        blocks = []
+        indels = []
+        qpos = max(qstart, -runs[0][2])  # clip query before start of reference
+        for left, right in zip(runs, runs[1:]):
+            split = self._place_indel(sequence, left, right)
+            if split is None:
+                return None
+            length = right[2] - left[2]
+            blocks.append((qpos, split, left[2]))
+            rpos = split + left[2]
+            if length > 0:
+                indels.append((split, ('-', rpos, length)))
+                qpos = split
+            else:
+                indels.append((split, ('+', rpos, sequence[split:(split - length)])))
+                qpos = split - length
+        blocks.append((qpos, min(qend, self.reflen - runs[-1][2]), runs[-1][2]))
+
+        aln_start, aln_end = blocks[0][0], blocks[-1][1]
+        for split, _ in indels:
+            if split - aln_start < self.flank or aln_end - split < self.flank:
+                return None  # minimap2 may clip instead
+
+        # unanchored ends must match exactly
+        first, last = runs[0][0], runs[-1][1] + self.k
+        diffs = []
+        missing = []
+        rstart = aln_start + blocks[0][2]
+        if rstart > 0:
+            missing.append((0, rstart))  # incomplete on left
+
+        score, peak, qlast = 0, 0, aln_start
+        for i, (block_start, block_end, diag) in enumerate(blocks):
+            mismatches = self._mismatches(sequence, block_start, block_end, diag)
+            if mismatches and (mismatches[0] < first or mismatches[-1] >= last):
+                return None
+            near = [split for split, _ in indels[max(0, i - 1):(i + 1)]]
+            j = 0
+            while j < len(mismatches):
+                # collect run of adjacent mismatches, as minimap2 'X' operator
+                end = j
+                while end + 1 < len(mismatches) and mismatches[end + 1] == mismatches[end] + 1:
+                    end += 1
+                qpos = mismatches[j]
+                substr = sequence[qpos:(mismatches[end] + 1)]
+                rpos = qpos + diag
+                score += 2 * (qpos - qlast)
+                peak = max(peak, score)
+                score -= substr.count('N') + 4 * (len(substr) - substr.count('N'))
+                if peak - score > self.maxdrop:
+                    return None  # minimap2 may clip alignment
+                qlast = qpos + len(substr)
                 if 'N' in substr:
-                    # for now, assume the whole substring is bs
-                    missing_data.append(tuple([pos[1], pos[1] + length]))
+                    missing.append((rpos, rpos + len(substr)))
                 else:
-                    # assume adjacent mismatches are independent substitutions
-                    for i, nucleotide in enumerate(substr):
-                        if nucleotide in alphabet:
-                            differences.append(tuple(['~', pos[1] + i, nucleotide]))
+                    if len(substr) > 3 or any(abs(qpos - split) < self.flank
+                                              for split in near):
+                        return None  # may be aligned with gaps instead
+                    for n, nucleotide in enumerate(substr):
+                        if nucleotide in self.alphabet:
+                            diffs.append(('~', rpos + n, nucleotide))
                         else:
-                            # skip ambiguous base calls, like "R"
-                            missing_data.append(tuple([pos[1] + i, pos[1] + i + 1]))
+                            missing.append((rpos + n, rpos + n + 1))
+                j = end + 1
+            if i < len(indels):
+                diffs.append(indels[i][1])
+
+        rend = aln_end + blocks[-1][2]
+        if rend < self.reflen:
+            missing.append((rend, self.reflen))  # incomplete on right
+        return diffs, missing
+
+    def call_fasta(self, fasta, minlen=29000):
+        """
+        Call differences of genomes in a batch, leaving the rest for minimap2
+
+        :param fasta:  str, FASTA-formatted text, as yielded by batch_fasta()
+        :param minlen:  int, genomes below minimum length are discarded, as
+                        by minimap2()
+        :return:  str, list; FASTA-formatted text of genomes to align, and
+                  tuples of query name, diffs and missing intervals of called
+                  genomes, as yielded by encode_diffs()
+        """
+        remaining = []
+        called = []
+        for block in fasta.split('>')[1:]:
+            header, _, sequence = block.partition('\n')
+            sequence = sequence.replace('\n', '')
+            if len(sequence) < minlen:
+                continue
+            result = self.call(sequence)
+            if result is None:
+                remaining.append(f'>{header}\n{sequence}\n')
+            else:
+                called.append((header.split()[0], *result))
+        return ''.join(remaining), called
 
-                pos[0] += length
-                pos[1] += length
+    def summary(self):
+        """ :return:  str, fraction of genomes called without alignment """
+        total = self.ncalled + self.nfallback
+        return (f"called differences of {self.ncalled} of {total} genomes "
+                f"without minimap2 ({self.ncalled / total if total else 0:.1%})")
+
+
+FEATURE_FORMATS = ('json', 'ndjson', 'pickle')
+
+
+def write_features(iterable, outfile, fmt='json'):
+    """
+    Stream output from encode_diffs() to a file, writing each record as
+    soon as it is encoded so that memory use does not grow with the input.
+
+    :param iterable:  generator from encode_diffs()
+    :param outfile:  open file stream in write mode; binary for 'pickle'
+    :param fmt:  str, one of FEATURE_FORMATS -
+                 'json': list of {'name', 'diffs', 'missing'} objects,
+                         one per line;
+                 'ndjson': one {'name', 'diffs', 'missing'} object per line;
+                 'pickle': stream of (name, diffs, missing) tuples, compact
+                           and faster to read back with read_features()
+    :return:  int, number of records written
+    """
+    if fmt not in FEATURE_FORMATS:
+        raise ValueError(f"Unrecognized output format {fmt!r}")
+    count = 0
+    if fmt == 'json':
+        outfile.write('[')
+    for qname, diffs, missing in iterable:
+        if fmt == 'pickle':
+            pickle.dump((qname, diffs, missing), outfile,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            serial = json.dumps({'name': qname, 'diffs': diffs, 'missing': missing})
+            if fmt == 'ndjson':
+                outfile.write(serial + '\n')
             else:
-                interpret_operator(operator, substr, pos, length, differences)
+                outfile.write((',\n ' if count else '') + serial)
+        count += 1
+    if fmt == 'json':
+        outfile.write(']')
+    return count
 
-        # update missing if sequence incomplete on the right
-        if pos[1] < reflen:
-            missing_data.append(tuple([pos[1], reflen]))
 
-        yield q_name, differences, missing_data
+def read_features(infile, fmt='ndjson'):
+    """
+    Stream records written by write_features()
 
-def interpret_operator(operator, substr, pos, length, differences):
-    """interpret operator from encode_diff() to make pep8 compliance"""
-    if operator == 'S':
-        # discard soft clip
-        pos[0] += length
-    elif operator == 'I':
-        # insertion relative to reference
-        differences.append(tuple(['+', pos[1], substr]))
-        pos[0] += length
-    elif operator == 'D':
-        # deletion relative to reference
-        differences.append(tuple(['-', pos[1], length]))
-        pos[1] += length
-    elif operator == '=':
-        # exact match
-        pos[0] += length
-        pos[1] += length
-    elif operator == 'H':
-        # hard clip, do nothing
-        pass
+    :param infile:  open file stream in read mode; binary for 'pickle'
+    :param fmt:  str, one of FEATURE_FORMATS
+    :yield:  tuple, query name, diffs and missing intervals
+    """
+    if fmt == 'pickle':
+        while True:
+            try:
+                yield pickle.load(infile)
+            except EOFError:
+                break
+    elif fmt == 'ndjson':
+        for line in infile:
+            if line.strip():
+                record = json.loads(line)
+                yield (record['name'], list(map(tuple, record['diffs'])),
+                       list(map(tuple, record['missing'])))
+    elif fmt == 'json':
+        for record in json.load(infile):
+            yield (record['name'], list(map(tuple, record['diffs'])),
+                   list(map(tuple, record['missing'])))
     else:
-        print(f"ERROR: unexpected operator {operator}")
-        sys.exit()
+        raise ValueError(f"Unrecognized output format {fmt!r}")
+
 
 def parse_args():
     """parse input args"""
@@ -245,6 +856,11 @@ def parse_args():
                              "by minimap2")
     parser.add_argument('--filter', action='store_true',
                         help="<option> filter problematic sites")
+    parser.add_argument('--format', choices=FEATURE_FORMATS, default='json',
+                        help="<option> output format of feature vectors, "
+                             "ignored with --align.  'ndjson' writes one JSON "
+                             "object per line, 'pickle' a compact binary "
+                             "stream (default 'json')")
 
     path = covizu.__path__[0]
     if '.egg' in path:
@@ -308,9 +924,10 @@ if __name__ == '__main__':
         else:
             output_fasta(mm2, reflen=len_ref, outfile=args.outfile)
     else:
-        # serialize feature vectors as JSON
-        res = []
-        for qname, diffs, missing in encode_diffs(mm2, reflen=len_ref):
-            res.append({'name': qname, 'diffs': diffs, 'missing': missing})
-        serial = json.dumps(res).replace('},', '},\n')
-        args.outfile.write(serial)
+        # serialize feature vectors as they are encoded
+        outfile = args.outfile
+        if args.format == 'pickle':
+            outfile.flush()
+            outfile = outfile.buffer
+        write_features(encode_diffs(mm2, reflen=len_ref), outfile, fmt=args.format)
+        outfile.flush()
@@ -1,7 +1,6 @@
 """what treetime does"""
 import argparse
 from subprocess import Popen, PIPE, check_call
-import json
 from tempfile import NamedTemporaryFile
 import os
 import sys
@@ -15,6 +14,7 @@ import pkg_resources
 import covizu
 from covizu.utils.seq_utils import convert_fasta, apply_features
 from covizu.utils.progress_utils import Callback
+from covizu.utils.lineage_utils import load_json
 # from covizu.utils.batch_utils import unpack_records
 import covizu.utils.batch_utils
 
@@ -344,7 +344,7 @@ if __name__ == '__main__':
 
     cb.callback("Retrieving genomes")
     with open(args.json, encoding='utf-8') as handle:
-        by_lineage = json.load(handle)
+        by_lineage = load_json(handle)
 
     cb.callback("Parsing Pango lineage designations")
     with open(args.lineages, encoding='utf-8') as handle:
@@ -9,6 +9,8 @@ from tempfile import NamedTemporaryFile
 from datetime import datetime
 from Bio import Phylo
 from covizu import clustering, beadplot, treetime
+from covizu.utils.sample_utils import SampleRegistry
+from covizu.utils.mutation_utils import key_codes, unpack_key, decode_mutation
 from rpy2 import robjects
 from rpy2.robjects.packages import importr
 import covizu
@@ -17,9 +19,9 @@ import covizu
 def unpack_records(records):
     """
     by_lineage is a nested dict with the inner dicts keyed by serialized
-    mutation sets (diffs).  This function is used to reconstitute the mutations
-    as a list of tuples, restoring the diffs entry for each record, and to return
-    a list of dicts.
+    mutation sets (diffs, see mutation_utils.pack_key()).  This function is used
+    to reconstitute the mutations as a list of tuples, restoring the diffs entry
+    for each record, and to return a list of dicts.
     Used in:
     - treetime:retrieve_genomes()
     - get_mutations()
@@ -33,16 +35,7 @@ def unpack_records(records):
     unpacked = []
     for key, variant in records.items():
         # reconstitute the mutations defining this variant
-        diffs = []
-        for mutation in key.split(','):
-            try:
-                typ, pos, alt = mutation.split('|')
-            except ValueError:
-                # Handle case when there are no diffs
-                continue
-            if typ == '-':
-                alt = int(alt)  # number of nucleotides in indel
-            diffs.append(tuple([typ, int(pos), alt]))
+        diffs = unpack_key(key)
 
         for sample in variant:
             sample.update({'diffs': diffs})
@@ -337,13 +330,14 @@ def make_beadplots(
         txtfile='minor_lineages.txt',
         recode_file="recoded.json"):
     """
-    Wrapper for beadplot_serial - divert to clustering.py in MPI mode if
-    lineage has too many genomes.
+    Reconstruct bootstrap trees of all lineages with a single MPI job of
+    clustering.py in 'schedule' mode, or a local process pool if
+    args.nj_workers > 1, and summarize them as beadplots.
 
     :param by_lineage:  dict, feature vectors stratified by lineage
     :param args:  Namespace, from argparse.ArgumentParser()
     :param t0:  float, datetime.timestamp.
-    :param txtfile:  str, path to file to write minor lineage names
+    :param txtfile:  str, path to file to write lineage names
     :param recode_file:  str, path to JSON file to write recoded lineage data
 
     :return:  list, beadplot data by lineage
@@ -353,14 +347,15 @@ def make_beadplots(
     if callback:
         callback("Recoding features, compressing variants..")
     recoded = {}
+    registry = SampleRegistry()  # samples are labelled by integer ID
     for lineage, records in by_lineage.items():
         if updated_lineages is not None and lineage not in updated_lineages:
             continue
         union, labels, indexed = clustering.recode_features(
-            records, limit=args.max_variants)
+            records, limit=args.max_variants, registry=registry)
 
-        # serialize tuple keys (features of union), #335
-        union = {f"{feat[0]}|{feat[1]}|{feat[2]}": idx for feat, idx in union.items()}
+        # serialize integer keys (mutation codes of union), #335
+        union = {str(code): idx for code, idx in union.items()}
 
         # sets cannot be serialized to JSON, #335
         indexed = [list(s) for s in indexed]
@@ -380,44 +375,36 @@ def make_beadplots(
 
 
 
-    # export minor lineages to text file
+    major = [lineage for lineage in by_lineage if lineage not in minor and (
+        updated_lineages is None or lineage in updated_lineages)]
+
+    # export lineages to text file
     with open(txtfile, 'w', encoding='utf-8') as handle:
-        for lineage in minor:
+        for lineage in list(minor) + major:
             handle.write(f'{lineage}\n')
 
-    # launch MPI job across minor lineages
-    if callback:
-        callback("start MPI on minor lineages")
-    cmd = ["mpirun", "--machinefile", args.machine_file, "python3", "covizu/clustering.py",
-           recode_file, txtfile,  # positional arguments <JSON file>, <str>
-           "--mode", "flat",
-           "--max-variants", str(args.max_variants),
-           "--nboot", str(args.nboot),
-           "--outdir", args.outdir,
-           "--binpath", args.binpath  # RapidNJ
-           ]
-    if initial_time:
-        cmd.extend(["--timestamp", str(initial_time)])
-    subprocess.check_call(cmd)
-
-    # process major lineages
-    for lineage, features in by_lineage.items():
-        if lineage in minor or (
-                updated_lineages is not None and lineage not in updated_lineages):
-            continue
-
+    if args.nj_workers > 1:
+        # reconstruct trees with local process pool instead of MPI
         if callback:
-            callback(f'start {lineage}, {len(features)} entries')
-
-        cmd = [
-            "mpirun", "--machinefile", args.machine_file, "python3", "covizu/clustering.py",
-            recode_file, lineage,  # positional arguments <JSON file>, <str>
-            "--mode", "deep",
-            "--max-variants", str(args.max_variants),
-            "--nboot", str(args.nboot),
-            "--outdir", args.outdir,
-            "--binpath", args.binpath
-        ]
+            callback(f"start {args.nj_workers} local workers on all lineages")
+        clustering.write_trees(recoded, list(minor) + major, args.outdir, args,
+                               deep=major, callback=callback)
+    else:
+        # single MPI job, the head rank hands out ranges of replicates of
+        # all lineages to idle worker ranks, largest first
+        if callback:
+            callback("start MPI on all lineages")
+        cmd = ["mpirun", "--machinefile", args.machine_file, "python3", "covizu/clustering.py",
+               recode_file, txtfile,  # positional arguments <JSON file>, <str>
+               "--mode", "schedule",
+               "--max-variants", str(args.max_variants),
+               "--nboot", str(args.nboot),
+               "--outdir", args.outdir,
+               "--binpath", args.binpath,  # RapidNJ
+               "--nj-backend", args.nj_backend
+               ]
+        if getattr(args, 'nj_stream', False):
+            cmd.append("--nj-stream")
         if initial_time:
             cmd.extend(["--timestamp", str(initial_time)])
         subprocess.check_call(cmd)
@@ -469,8 +456,7 @@ def make_beadplots(
                 beaddict = {'nodes': {}, 'edges': []}
 
                 # use earliest sample as variant label
-                intermed = sorted([label.split('|')[::-1]
-                                for label in label_dict['0']])
+                intermed = sorted([registry.row(sid) for sid in label_dict['0']])
                 variant = intermed[0][1]
                 beaddict['nodes'].update({variant: []})
 
@@ -545,7 +531,7 @@ def make_beadplots(
                 inf_predict.update({lineage: predicted_infections})
 
                 ctree = beadplot.annotate_tree(ctree, label_dict)
-                beaddict = beadplot.serialize_tree(ctree)
+                beaddict = beadplot.serialize_tree(ctree, registry=registry)
 
         beaddict.update({'sampled_variants': len(label_dict)})
         beaddict.update({'lineage': lineage})
@@ -563,20 +549,17 @@ def get_mutations(by_lineage):
     """
     result = {}
     for lineage, records in by_lineage.items():
-        samples = unpack_records(records)
-
-        # enumerate features
+        # enumerate features by mutation code, weighted by number of samples
         counts = {}
-        for sample in samples:
-            for diff in sample['diffs']:
-                feat = tuple(diff)
-                if feat not in counts:
-                    counts.update({feat: 0})
-                counts[feat] += 1
+        nsamples = 0
+        for key, variant in records.items():
+            nsamples += len(variant)
+            for code in key_codes(key).tolist():
+                counts[code] = counts.get(code, 0) + len(variant)
 
         # filter for mutations that occur in at least half of samples
-        common = {feat: count / len(samples) for feat,
-                  count in counts.items() if count / len(samples) >= 0.5}
+        common = {decode_mutation(code): count / nsamples for code,
+                  count in counts.items() if count / nsamples >= 0.5}
         result.update({lineage: common})
 
     return result
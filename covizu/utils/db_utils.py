@@ -0,0 +1,89 @@
+"""embedded feature store for incremental runs without PostgreSQL"""
+import sqlite3
+import json
+import threading
+
+from covizu.utils.mutation_utils import dump_mutations
+from covizu.utils.seq_utils import PackedIntervals
+
+
+class FeatureStore:
+    """
+    File-backed store of genetic differences (diffs) and missing sites,
+    keyed by accession number.  Uses the same SEQUENCES table layout as the
+    PostgreSQL database (see batch.py:open_connection), so that rows
+    returned by lookup() can be handled in the same way as a cursor fetch.
+    The store can be shared by threads of a pipelined run.
+    """
+
+    def __init__(self, path, commit_interval=1000):
+        """
+        :param path:  str, path to SQLite database file, created if it does not exist
+        :param commit_interval:  int, number of inserts between commits
+        """
+        self.path = path
+        self.commit_interval = commit_interval
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute(
+            '''CREATE TABLE IF NOT EXISTS SEQUENCES (accession VARCHAR(255)
+            PRIMARY KEY, qname VARCHAR(255), lineage VARCHAR(255),
+            date VARCHAR(255), location VARCHAR(255),
+            diffs VARCHAR, missing VARCHAR)''')
+        self.conn.commit()
+        self.ninserts = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, accession):
+        return self.lookup(accession) is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM SEQUENCES").fetchone()[0]
+
+    def lookup(self, accession):
+        """
+        Retrieve stored features for a genome.
+
+        :param accession:  str, GISAID accession number
+        :return:  sqlite3.Row with 'diffs' (see mutation_utils.dump_mutations())
+                  and 'missing' (PackedIntervals deltas) as JSON strings,
+                  or None if the accession has not been stored
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT * FROM SEQUENCES WHERE accession = ?", (accession, )).fetchone()
+
+    def insert(self, record):
+        """
+        Store features for a genome aligned by extract_features().
+
+        :param record:  dict, GISAID record with 'diffs' and 'missing' entries
+        """
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO SEQUENCES VALUES(?, ?, ?, ?, ?, ?, ?)",
+                (record['covv_accession_id'], record['covv_virus_name'],
+                 record['covv_lineage'], record['covv_collection_date'],
+                 record['covv_location'], json.dumps(dump_mutations(record['diffs'])),
+                 json.dumps(PackedIntervals.pack(record['missing']).to_json())))
+            self.ninserts += 1
+            if self.ninserts % self.commit_interval == 0:
+                self.conn.commit()
+
+    def commit(self):
+        """ Flush pending inserts to disk """
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        """ Commit and close connection """
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
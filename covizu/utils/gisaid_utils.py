@@ -7,21 +7,39 @@ import os
 import sys
 import subprocess
 import getpass
+import time
+import pickle
+import hashlib
+import multiprocessing
+from collections import OrderedDict, deque
+from itertools import chain, islice
 
 import covizu
 from covizu import minimap2
 # from covizu.minimap2 import minimap2, encode_diffs
-from covizu.utils.seq_utils import fromisoformat, convert_fasta, QPois, load_vcf, total_missing
+from covizu.utils.seq_utils import (fromisoformat, convert_fasta, QPois, ProblematicMask,
+                                    total_missing, PackedIntervals)
 from covizu.utils.progress_utils import Callback
+from covizu.utils.lineage_utils import SpilledLineages, dump_json
+from covizu.utils.pipeline_utils import defer
+from covizu.utils.mutation_utils import pack_key, dump_mutations, decode_mutations
 
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
 
-def download_feed(url, user, password):
+
+def download_feed(url, user, password, cache=False, callback=None):
     """
     Download xz file from GISAID.  Note this requires confidential URL, user and password
     information that we are not distributing with the source code.
     :param url:  str, address to retrieve xz-compressed provisioning file
     :param user:  str, GISAID username
     :param password:  str, access credentials - if None, query user
+    :param cache:  bool, if True then convert download into a block-compressed,
+                   seekable provision with convert_provision()
+    :param callback:  function, optional callback function
     :return:  str, path to time-stamped download file
     """
     if url is None:
@@ -35,80 +53,736 @@ def download_feed(url, user, password):
     outfile = f"data/provision.{timestamp}.json.xz"
     subprocess.check_call(
         ["wget", "--user", user, "--password", password, "-O", outfile, url])
+    if cache:
+        outfile = convert_provision(outfile, callback=callback)
+    return outfile
+
+
+_decoder = json.JSONDecoder()
+
+
+def parse_json(line, fields):
+    """
+    Reference record parser: decode the entire JSON line and keep <fields>.
+
+    :param line:  bytes or str, one line of the provision file
+    :param fields:  tuple, fieldnames to keep
+    :return:  dict, projected record with newlines removed from sequence
+    """
+    record = json.loads(line)
+    record = {k: record[k] for k in fields}
+    if 'sequence' in record:
+        record['sequence'] = record['sequence'].replace('\n', '')
+    return record
+
+
+def parse_scan(line, fields):
+    """
+    Pure-Python field-projecting record parser.  Locates each top-level key
+    by byte search and decodes only its value, so the rest of the provision
+    line is never decoded or materialized as Python objects.  String values
+    without escape sequences are sliced out directly.
+
+    :param line:  bytes or str, one line of the provision file
+    :param fields:  tuple, fieldnames to keep
+    :return:  dict, projected record with newlines removed from sequence
+    """
+    if isinstance(line, str):
+        line = line.encode('utf-8')
+    record = {}
+    for field in fields:
+        key = f'"{field}"'.encode('utf-8')
+        idx = line.find(key)
+        while True:
+            if idx < 0:
+                raise KeyError(field)
+            # confirm match is a key and not part of a string value
+            idx += len(key)
+            while line[idx] in b' \t':
+                idx += 1
+            if line[idx] == 0x3A:  # ':'
+                break
+            idx = line.find(key, idx)
+        idx += 1
+        while line[idx] in b' \t':
+            idx += 1
+
+        if line[idx] == 0x22:  # '"', string value
+            # locate closing quote, skipping escaped quotes
+            right = line.find(b'"', idx + 1)
+            while line[right - 1] == 0x5C:  # '\\'
+                nslash = right - len(line[idx:right].rstrip(b'\\')) - idx
+                if nslash % 2 == 0:
+                    break
+                right = line.find(b'"', right + 1)
+            value = line[idx:right + 1]
+            if value.find(b'\\') < 0:
+                record[field] = value[1:-1].decode('utf-8')
+            else:
+                record[field] = json.loads(value)
+        else:
+            record[field], _ = _decoder.raw_decode(line[idx:].decode('utf-8'))
+
+    if 'sequence' in record:
+        record['sequence'] = record['sequence'].replace('\n', '')
+    return record
+
+
+def parse_orjson(line, fields):
+    """
+    Accelerated record parser using the optional orjson module
+    (https://github.com/ijl/orjson).
+
+    :param line:  bytes or str, one line of the provision file
+    :param fields:  tuple, fieldnames to keep
+    :return:  dict, projected record with newlines removed from sequence
+    """
+    record = orjson.loads(line)
+    record = {k: record[k] for k in fields}
+    if 'sequence' in record:
+        record['sequence'] = record['sequence'].replace('\n', '')
+    return record
+
+
+PARSERS = {'json': parse_json, 'scan': parse_scan, 'orjson': parse_orjson}
+
+
+def get_parser(name='auto'):
+    """
+    Retrieve record parser by name.  'auto' selects the orjson backend if
+    the module is installed, otherwise the standard json module.  The field
+    scanner ('scan') must be requested explicitly, as it matches fieldnames
+    anywhere in the line and is only faster for records with little metadata.
+
+    :param name:  str, one of 'auto', 'json', 'scan' or 'orjson'
+    :return:  function, parser taking (line, fields) arguments
+    """
+    if name == 'auto':
+        name = 'json' if orjson is None else 'orjson'
+    if name == 'orjson' and orjson is None:
+        raise ValueError("orjson parser requested but module is not installed")
+    if name not in PARSERS:
+        raise ValueError(f"Unrecognized record parser {name!r}")
+    return PARSERS[name]
+
+
+def cache_path(path):
+    """ Path of block-indexed cache for provision file at <path> """
+    if path.endswith('.json.xz'):
+        return path[:-len('.json.xz')] + '.blocked.json.xz'
+    return path + '.blocked.json.xz'
+
+
+def is_cache(path):
+    """ True if <path> is a block-indexed provision file with an index """
+    return os.path.exists(f'{path}.idx')
+
+
+def _source_stat(path):
+    """ :return:  dict, size and modification time of provision file """
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def is_current(cached, source):
+    """
+    Check that a block-compressed provision was converted from the present
+    version of its source file, e.g., not from a previous download to the
+    same path.
+
+    :param cached:  str, path to block-compressed provision
+    :param source:  str, path to provision file it was converted from
+    :return:  bool, True if size and modification time of <source> match
+              those recorded by convert_provision()
+    """
+    if not is_cache(cached):
+        return False
+    with open(f'{cached}.idx', encoding='utf-8') as handle:
+        index = json.load(handle)
+    return index.get('source', None) == _source_stat(source)
+
+
+def convert_provision(path, outfile=None, blocksize=10000, preset=6, callback=None):
+    """
+    One-time conversion of an xz-compressed provision file into a seekable,
+    block-compressed copy.  Every <blocksize> lines are compressed as an
+    independent xz stream, so the output remains a valid xz file that can be
+    read sequentially with lzma.open().  An index of block byte offsets and
+    accession numbers is written to <outfile>.idx as JSON, with the size and
+    modification time of <path> to detect a stale copy (see is_current()).
+
+    :param path:  str, path to xz-compressed provision file
+    :param outfile:  str, path to write block-compressed file; defaults to
+                     cache_path(path)
+    :param blocksize:  int, number of lines per block
+    :param preset:  int, xz compression preset for each block
+    :param callback:  function, optional callback function
+    :return:  str, path to block-compressed file
+    """
+    if outfile is None:
+        outfile = cache_path(path)
+
+    source = _source_stat(path)
+    blocks = []
+    accessions = {}
+    offset = 0
+
+    def flush(lines, handle):
+        nonlocal offset
+        data = lzma.compress(b''.join(lines), preset=preset)
+        handle.write(data)
+        blocks.append([offset, len(data), len(lines)])
+        offset += len(data)
+
+    with lzma.open(path, 'rb') as infile, open(outfile, 'wb') as handle:
+        lines = []
+        for line in infile:
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            accn = parse_scan(line, ('covv_accession_id', ))['covv_accession_id']
+            accessions[accn] = len(blocks)
+            lines.append(line)
+            if len(lines) == blocksize:
+                flush(lines, handle)
+                lines = []
+        if lines:
+            flush(lines, handle)
+
+    # write index last, so that an interrupted conversion is not used
+    with open(f'{outfile}.idx', 'w', encoding='utf-8') as handle:
+        json.dump({'version': 1, 'blocksize': blocksize, 'blocks': blocks,
+                   'accessions': accessions, 'source': source}, handle)
+
+    if callback:
+        callback(f"Wrote {len(accessions)} records in {len(blocks)} blocks to {outfile}")
     return outfile
 
 
+class ProvisionCache:
+    """
+    Random access to a block-compressed provision file written by
+    convert_provision(), by block index or by accession number.
+    """
+
+    def __init__(self, path):
+        """
+        :param path:  str, path to block-compressed provision file
+        """
+        self.path = path
+        with open(f'{path}.idx', encoding='utf-8') as handle:
+            index = json.load(handle)
+        self.blocks = index['blocks']
+        self.accessions = index['accessions']
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def read_block(self, block, handle=None):
+        """
+        Decompress one block of lines.
+
+        :param block:  int, block index
+        :param handle:  optional, file object opened on self.path in 'rb' mode
+        :return:  list, raw (bytes) JSON lines
+        """
+        offset, length, _ = self.blocks[block]
+        if handle is None:
+            with open(self.path, 'rb') as fh:
+                fh.seek(offset)
+                data = fh.read(length)
+        else:
+            handle.seek(offset)
+            data = handle.read(length)
+        return lzma.decompress(data).splitlines()
+
+    def iter_lines(self, start=0, stop=None):
+        """
+        Iterate over raw lines in a contiguous range of blocks.
+
+        :param start:  int, index of first block
+        :param stop:  int, index past last block; defaults to end of file
+        :yield:  bytes, raw JSON line
+        """
+        with open(self.path, 'rb') as handle:
+            for block in range(start, len(self.blocks) if stop is None else stop):
+                yield from self.read_block(block, handle)
+
+    def lookup(self, accessions, fields=None, parser='auto'):
+        """
+        Retrieve records by accession number, decompressing only the blocks
+        that contain them.
+
+        :param accessions:  iterable, accession numbers
+        :param fields:  tuple, fieldnames to keep; defaults to all fields
+        :param parser:  str, record parser if <fields> is specified
+        :return:  dict, records keyed by accession; missing accessions are omitted
+        """
+        wanted = {}
+        for accn in set(accessions):
+            block = self.accessions.get(accn, None)
+            if block is not None:
+                wanted.setdefault(block, set()).add(accn)
+
+        parse = get_parser(parser)
+        result = {}
+        with open(self.path, 'rb') as handle:
+            for block in sorted(wanted):
+                for line in self.read_block(block, handle):
+                    if fields is None:
+                        record = json.loads(line)
+                    else:
+                        record = parse(line, fields)
+                    accn = record['covv_accession_id']
+                    if accn in wanted[block]:
+                        result[accn] = record
+        return result
+
+
+def filter_record(record, minlen, mindate, rejects):
+    """
+    Apply basic filters to a GISAID record returned by a record parser.
+    Used by load_gisaid() in serial mode and by worker processes in parallel mode.
+
+    :param record:  dict, projected record from parse_json() or equivalent
+    :param minlen:  int, minimum genome length
+    :param mindate:  datetime.date, earliest reasonable sample collection date
+    :param rejects:  dict, counts of rejected records by reason, updated in place
+    :return:  dict, filtered record; or None if the record was rejected
+    """
+    qname = record['covv_virus_name'].strip().replace(
+        ',', '_').replace('|', '_')  # issue #206,#464
+    country = qname.split('/')[1]
+    if country == '' or country[0].islower():
+        # reject mangled labels and non-human isolates
+        rejects['nonhuman'] += 1
+        return None
+
+    record['covv_virus_name'] = qname  # in case we removed whitespace
+
+    if len(record['sequence']) < minlen:
+        # reject sequences that are too short
+        rejects['short'] += 1
+        return None
+
+    if record['covv_collection_date'].count('-') != 2:
+        # reject sequences without complete collection date
+        rejects['baddate'] += 1
+        return None
+    coldate = fromisoformat(record['covv_collection_date'])
+    if coldate is None or coldate < mindate or coldate > date.today():
+        # reject sequences with nonsense collection date
+        rejects['baddate'] += 1
+        return None
+
+    return record
+
+
+def _decode_chunk(chunk, first_line, start, minlen, mindate, fields, parser):
+    """
+    Worker task for load_gisaid() in parallel mode.  Decode and filter a
+    chunk of raw provision lines.
+
+    :param chunk:  list, raw (bytes) JSON lines; or tuple of path, byte offset
+                   and length of a block in a block-compressed provision file
+    :param first_line:  int, index of first line of chunk in provision file
+    :param start:  int, skip lines with index below this value
+    :param parser:  str, name of record parser passed to get_parser()
+    :return:  list of (line index, filtered record) tuples, dict of reject
+              counts, process ID, number of lines decoded and elapsed time (seconds)
+    """
+    begin = time.perf_counter()
+    if isinstance(chunk, tuple):
+        # read block directly from block-compressed provision
+        path, offset, length = chunk
+        with open(path, 'rb') as handle:
+            handle.seek(offset)
+            chunk = lzma.decompress(handle.read(length)).splitlines()
+
+    rejects = {'short': 0, 'baddate': 0, 'nonhuman': 0, 'nolineage': 0}
+    records = []
+    parse = get_parser(parser)
+    skip = max(0, start - first_line)
+    for line_num, line in enumerate(chunk[skip:], first_line + skip):
+        record = filter_record(parse(line, fields), minlen, mindate, rejects)
+        if record is not None:
+            records.append((line_num, record))
+    return records, rejects, os.getpid(), len(chunk) - skip, time.perf_counter() - begin
+
+
+def _iter_chunks(path, chunksize, debug=None, start=0):
+    """
+    Read raw lines from xz-compressed provision into lists of <chunksize> lines
+
+    :yield:  int, index of first line in chunk; and list of raw lines
+    """
+    chunk = []
+    first_line = start
+    with lzma.open(path, 'rb') as handle:
+        for line_num, line in enumerate(handle):
+            if debug and line_num > debug:
+                break
+            if line_num < start:
+                continue
+            chunk.append(line)
+            if len(chunk) == chunksize:
+                yield first_line, chunk
+                chunk = []
+                first_line = line_num + 1
+    if chunk:
+        yield first_line, chunk
+
+
+def _iter_blocks(path, start=0):
+    """
+    Locate blocks of a block-compressed provision for worker processes
+
+    :yield:  int, index of first line in block; and tuple of path, byte offset
+             and length of block
+    """
+    first_line = 0
+    for offset, length, nlines in ProvisionCache(path).blocks:
+        if first_line + nlines > start:
+            yield first_line, (path, offset, length)
+        first_line += nlines
+
+
 def load_gisaid(path, minlen=29000, mindate='2019-12-01', callback=None,
                 fields=("covv_accession_id", "covv_virus_name", "covv_lineage",
                         "covv_collection_date", "covv_location", "sequence"),
-                debug=None
+                debug=None, nworkers=1, chunksize=1000, parser='auto',
+                start=0, progress=None
                 ):
     """
     Read in GISAID feed as xz compressed JSON, applying some basic filters
 
-    :param path:  str, path to xz-compressed JSON
+    :param path:  str, path to xz-compressed JSON, or block-compressed
+                  provision from convert_provision()
     :param minlen:  int, minimum genome length
     :param mindate:  datetime.date, earliest reasonable sample collection date
     :param callback:  function, optional callback function
     :param fields:  tuple, fieldnames to keep
     :param debug:  int, if >0 then limits input JSON for debugging
+    :param nworkers:  int, number of processes to decode and filter JSON lines;
+                      if >1, a single reader distributes chunks of lines to
+                      worker processes and records are yielded in input order.
+                      Workers read blocks of a block-compressed provision
+                      directly from disk.
+    :param chunksize:  int, number of lines per chunk in parallel mode
+    :param parser:  str, record parser - 'scan' decodes only <fields>, 'json'
+                    and 'orjson' decode entire lines; see get_parser()
+    :param start:  int, index of first line to decode, e.g., to resume from
+                   a checkpoint
+    :param progress:  dict, optional; 'offset' is set to the index of the line
+                      following each record before it is yielded
 
     :yield:  dict, contents of each GISAID record
     """
     mindate = fromisoformat(mindate)
     rejects = {'short': 0, 'baddate': 0, 'nonhuman': 0, 'nolineage': 0}
-    with lzma.open(path, 'rb') as handle:
-        for line_num, line in enumerate(handle):
-            if debug and line_num > debug:
-                break
-            record = json.loads(line)
+    parse = get_parser(parser)  # fail early on unavailable parser
+
+    if nworkers > 1:
+        # bound number of chunks in flight to limit memory consumption
+        stats = {}
+        with multiprocessing.Pool(nworkers) as pool:
+            pending = deque()
+            if is_cache(path) and not debug:
+                chunks = _iter_blocks(path, start=start)
+            else:
+                chunks = _iter_chunks(path, chunksize, debug=debug, start=start)
+            for first_line, chunk in chunks:
+                pending.append(pool.apply_async(
+                    _decode_chunk,
+                    (chunk, first_line, start, minlen, mindate, fields, parser)))
+                if len(pending) < 2 * nworkers:
+                    continue
+                for line_num, record in _collect_chunk(pending.popleft().get(), rejects, stats):
+                    if progress is not None:
+                        progress['offset'] = line_num + 1
+                    yield record
+            while pending:
+                for line_num, record in _collect_chunk(pending.popleft().get(), rejects, stats):
+                    if progress is not None:
+                        progress['offset'] = line_num + 1
+                    yield record
+
+        if callback:
+            for pid, (nlines, elapsed) in stats.items():
+                callback(f"worker {pid} decoded {nlines} records in {elapsed:.1f}s "
+                         f"({nlines / max(elapsed, 1e-6):.0f} records/s)")
+    else:
+        with lzma.open(path, 'rb') as handle:
+            for line_num, line in enumerate(handle):
+                if debug and line_num > debug:
+                    break
+                if line_num < start:
+                    continue
+                record = filter_record(parse(line, fields), minlen, mindate, rejects)
+                if record is not None:
+                    if progress is not None:
+                        progress['offset'] = line_num + 1
+                    yield record
 
-            # remove unused data
-            record = {k: record[k] for k in fields}
+    if callback:
+        callback("Rejected {short} short genomes\n"
+                 "         {nolineage} with no lineage assignment\n"
+                 "         {baddate} records with bad dates\n"
+                 "         {nonhuman} non-human genomes".format(**rejects))
 
-            qname = record['covv_virus_name'].strip().replace(
-                ',', '_').replace('|', '_')  # issue #206,#464
-            country = qname.split('/')[1]
-            if country == '' or country[0].islower():
-                # reject mangled labels and non-human isolates
-                rejects['nonhuman'] += 1
-                continue
 
-            record['covv_virus_name'] = qname  # in case we removed whitespace
+def _collect_chunk(result, rejects, stats):
+    """ Merge result from _decode_chunk() into reject counts and worker stats """
+    records, chunk_rejects, pid, nlines, elapsed = result
+    for key, count in chunk_rejects.items():
+        rejects[key] += count
+    prev_lines, prev_time = stats.get(pid, (0, 0.))
+    stats[pid] = (prev_lines + nlines, prev_time + elapsed)
+    return records
 
-            seq = record['sequence'].replace('\n', '')
-            if len(seq) < minlen:
-                # reject sequences that are too short
-                rejects['short'] += 1
-                continue
-            record['sequence'] = seq
 
-            if record['covv_collection_date'].count('-') != 2:
-                # reject sequences without complete collection date
-                rejects['baddate'] += 1
-                continue
-            coldate = fromisoformat(record['covv_collection_date'])
-            if coldate is None or coldate < mindate or coldate > date.today():
-                # reject sequences with nonsense collection date
-                rejects['baddate'] += 1
-                continue
+def save_checkpoint(path, state):
+    """
+    Durably write pipeline state to a pickle file.  The file is replaced
+    atomically, so an interrupted write leaves the previous checkpoint intact.
 
-            yield record
+    :param path:  str, path to checkpoint file
+    :param state:  dict, picklable pipeline state
+    """
+    tmpfile = f'{path}.tmp'
+    with open(tmpfile, 'wb') as handle:
+        pickle.dump(state, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(tmpfile, path)
+
+
+def load_checkpoint(path):
+    """
+    Read pipeline state written by save_checkpoint()
+
+    :param path:  str, path to checkpoint file
+    :return:  dict, pipeline state; or None if there is no checkpoint
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as handle:
+        return pickle.load(handle)
+
+
+def open_checkpoint(args, callback=None):
+    """
+    Locate checkpoint file and initial pipeline state from command-line
+    arguments (--checkpoint, --checkpoint-interval, --resume).  A checkpoint
+    is only resumed if it was written for the same input file and filters.
+    With --sort-budget, a new run sorts records into SpilledLineages.
+
+    :param args:  argparse.Namespace, from batch.py or local.py
+    :param callback:  function, optional callback function
+    :return:  str, path to checkpoint file (None if checkpoints are disabled);
+              and dict, pipeline state with 'offset' and 'by_lineage' entries
+    """
+    path = args.checkpoint
+    if path is None and args.resume:
+        path = os.path.join(args.outdir, 'checkpoint.pickle')
+    if args.checkpoint_interval < 1:
+        path = None
+
+    state = {
+        'infile': os.path.abspath(args.infile),
+        'size': os.path.getsize(args.infile),
+        'params': (args.minlen, args.mindate, args.poisson_cutoff),
+        'offset': 0,
+        'by_lineage': {}
+    }
+    if path and args.resume:
+        prev = load_checkpoint(path)
+        if prev is None:
+            if callback:
+                callback(f"No checkpoint found at {path}, starting from beginning")
+        elif any(prev[key] != state[key] for key in ('infile', 'size', 'params')):
+            if callback:
+                callback(f"Checkpoint {path} does not match input file or filter "
+                         f"settings, starting from beginning", level='WARN')
+        else:
+            state = prev
+            if callback:
+                callback(f"Resuming from checkpoint at input offset {state['offset']} "
+                         f"with {len(state['by_lineage'])} lineages")
+
+    if state['offset'] == 0:
+        state['by_lineage'] = new_by_lineage(args)
+    return path, state
+
+
+def new_by_lineage(args):
+    """
+    Empty container for records sorted by lineage, see sort_by_lineage()
+
+    :param args:  argparse.Namespace, from batch.py or local.py
+    :return:  dict; or SpilledLineages with --sort-budget (MB)
+    """
+    if getattr(args, 'sort_budget', 0) > 0:
+        # spill records sorted by lineage to disk when over budget
+        return SpilledLineages(budget=args.sort_budget * 2**20, spill_dir=args.outdir)
+    return {}
 
-    if callback:
-        callback("Rejected {short} short genomes\n"
-                 "         {nolineage} with no lineage assignment\n"
-                 "         {baddate} records with bad dates\n"
-                 "         {nonhuman} non-human genomes".format(**rejects))
+
+class Checkpointer:
+    """
+    Save pipeline state every <interval> batches.  Batches are tracked as they
+    leave batch_fasta() with track(), and marked complete by extract_features()
+    with batch_done() once all of their records have been consumed downstream,
+    so that checkpoints remain consistent when batches are read ahead for
+    alignment.  In a pipelined run, saving is deferred until the batch has
+    passed through the remaining stages (see pipeline_utils.defer).
+    """
+
+    def __init__(self, progress, state, path, interval=10, callback=None):
+        """
+        :param progress:  dict, passed to load_gisaid() to track input offset
+        :param state:  dict, additional state to save - must include 'by_lineage',
+                       the partial result dict passed to sort_by_lineage()
+        :param path:  str, path to checkpoint file
+        :param interval:  int, number of batches between checkpoints
+        :param callback:  function, optional callback function
+        """
+        self.progress = progress
+        self.state = state
+        self.path = path
+        self.interval = interval
+        self.callback = callback
+        self.offsets = deque()  # input offset at end of each pending batch
+        self.count = 0
+
+    def track(self, batcher):
+        """
+        :param batcher:  generator, returned by batch_fasta()
+        :yield:  str, list; items from batch_fasta()
+        """
+        for item in batcher:
+            self.offsets.append(self.progress['offset'])
+            yield item
+
+    def batch_done(self):
+        """ Mark the oldest pending batch as complete """
+        offset = self.offsets.popleft()
+        self.count += 1
+        if self.count % self.interval == 0:
+            defer(lambda: self.save(offset))
+
+    def save(self, offset):
+        """ :param offset:  int, input offset at end of last completed batch """
+        save_checkpoint(self.path, dict(self.state, offset=offset))
+        if self.callback:
+            self.callback(f"saved checkpoint at input offset {offset}")
+
+
+class SequenceDedup:
+    """
+    Track byte-identical genome sequences within a run, so that each distinct
+    sequence is aligned by minimap2 only once.  Sequences are keyed by a
+    content hash, and features of aligned sequences are copied to every
+    other record with the same hash.  At most <maxsize> aligned sequences
+    are remembered, evicting the least recently seen; features still awaited
+    by duplicate records in flight are never evicted.
+    """
+
+    def __init__(self, maxsize=100000):
+        """
+        :param maxsize:  int, maximum number of aligned sequences to keep
+        """
+        self.maxsize = maxsize
+        self.first = {}  # hash: qname of first record with sequence, until aligned
+        self.reps = {}  # qname of first record: hash, until aligned
+        self.copies = {}  # qname of duplicate record: hash
+        self.pending = {}  # hash: number of duplicate records awaiting features
+        self.features = OrderedDict()  # hash: (diffs, PackedIntervals), oldest first
+        self.nrecords = 0
+        self.ndups = 0
+
+    @staticmethod
+    def digest(sequence):
+        """ Content hash of a sequence """
+        return hashlib.blake2b(sequence.encode('utf-8'), digest_size=16).digest()
+
+    def add(self, qname, seqhash):
+        """
+        Register a record that needs alignment
+
+        :param qname:  str, query name of record in FASTA batch
+        :param seqhash:  bytes, return value of digest()
+        :return:  bool, True if sequence is new and must be aligned
+        """
+        self.nrecords += 1
+        if seqhash in self.features or seqhash in self.first:
+            if seqhash in self.features:
+                self.features.move_to_end(seqhash)
+            self.copies[qname] = seqhash
+            self.pending[seqhash] = self.pending.get(seqhash, 0) + 1
+            self.ndups += 1
+            return False
+        self.first[seqhash] = qname
+        self.reps[qname] = seqhash
+        return True
+
+    def remember(self, seqhash, diffs, missing):
+        """
+        Keep features of an aligned sequence, evicting the least recently
+        seen sequences above <maxsize> that no duplicate record is awaiting.
+
+        :param seqhash:  bytes, return value of digest()
+        :param diffs:  list, differences from reference; copied
+        :param missing:  PackedIntervals, missing sites
+        """
+        self.first.pop(seqhash, None)
+        if seqhash in self.features:
+            self.features.move_to_end(seqhash)
+            return
+        self.features[seqhash] = (list(diffs), missing)
+        excess = len(self.features) - self.maxsize
+        if excess > 0:
+            oldest = islice(self.features, excess + len(self.pending))
+            for old in [h for h in oldest if h not in self.pending][:excess]:
+                del self.features[old]
+
+    def aligned(self, qname, diffs, missing):
+        """
+        Record features of a newly aligned record
+
+        :param qname:  str, query name of record in FASTA batch
+        :return:  bytes, hash of sequence if record was registered by add()
+        """
+        seqhash = self.reps.pop(qname, None)
+        if seqhash is not None:
+            self.remember(seqhash, diffs, missing)
+        return seqhash
+
+    def copy(self, seqhash):
+        """ :return:  dict, copies of features of an aligned sequence """
+        diffs, missing = self.features[seqhash]
+        count = self.pending.get(seqhash, 0) - 1
+        if count > 0:
+            self.pending[seqhash] = count
+        else:
+            self.pending.pop(seqhash, None)
+        return {'diffs': list(diffs), 'missing': missing}  # missing is immutable
+
+    def ratio(self):
+        """ Fraction of records that did not need to be aligned """
+        return self.ndups / self.nrecords if self.nrecords else 0.
 
 
-def batch_fasta(gen, cur=None, size=100):
+def batch_fasta(gen, cur=None, size=100, store=None, dedup=None):
     """
     Concatenate sequence records in stream into FASTA-formatted text in batches of
     <size> records.
     :param gen:  generator, return value of load_gisaid()
     :param cur: cursor for the PostgreSQL
     :param size:  int, number of records per batch
+    :param store:  db_utils.FeatureStore, optional embedded alternative to <cur>
+    :param dedup:  SequenceDedup, optional; only the first record with a given
+                   sequence is written to FASTA.  Must also be passed to
+                   extract_features().
     :yield:  str, list; FASTA-format string and list of records (dict) in batch
     """
     stdin = ''
@@ -126,15 +800,19 @@ def batch_fasta(gen, cur=None, size=100):
             cur.execute(
                 f"SELECT * FROM SEQUENCES WHERE accession = '{accession}'")
             result = cur.fetchone()
+        elif store:
+            result = store.lookup(accession)
 
         if result:
-            # reading old records from database
+            # reading old records from database, diffs stored as mutation codes
             # and handling list to tuple conversion
             record.update({
-                'diffs': list(map(tuple, json.loads(result["diffs"]))),
-                'missing': list(map(tuple, json.loads(result["missing"])))
+                'diffs': decode_mutations(json.loads(result["diffs"])),
+                'missing': PackedIntervals.from_json(json.loads(result["missing"]))
             })
-        else:
+            if dedup is not None:
+                dedup.remember(dedup.digest(sequence), record['diffs'], record['missing'])
+        elif dedup is None or dedup.add(qname, dedup.digest(sequence)):
             stdin += f'>{qname}\n{sequence}\n'
         batch.append(record)
         if i > 0 and i % size == 0:
@@ -152,7 +830,13 @@ def extract_features(
         cur=None,
         binpath='minimap2',
         nthread=3,
-        minlen=29000):
+        minlen=29000,
+        store=None,
+        dedup=None,
+        pool=None,
+        checkpoint=None,
+        caller=None,
+        record_filter=None):
     """
     Stream output from JSON.xz file via load_gisaid() into minimap2
     via subprocess.
@@ -163,49 +847,221 @@ def extract_features(
     :param binpath:  str, path to minimap2 binary executable
     :param nthread:  int, number of threads to run minimap2
     :param minlen:  int, minimum genome length
+    :param store:  db_utils.FeatureStore, optional embedded alternative to <cur>
+    :param dedup:  SequenceDedup, passed to batch_fasta(); features of each
+                   aligned sequence are copied to records with identical sequences
+    :param pool:  minimap2.Minimap2Pool, optional persistent minimap2 processes;
+                  otherwise a minimap2 process is started for each batch
+    :param checkpoint:  Checkpointer, optional; notified as each batch is completed
+    :param caller:  minimap2.AnchoredCaller, optional; differences of genomes
+                    near-identical to the reference are called directly, and
+                    only the remaining genomes are aligned by minimap2
+    :param record_filter:  RecordFilter, optional; apply the filters of
+                           filter_problematic() to each batch, so that only
+                           retained records are yielded at the end of the
+                           batch, before <checkpoint> is notified.  If
+                           record_filter.fused, problematic sites are excluded
+                           as minimap2 output is decoded, and features are
+                           saved to <cur> or <store> without them.
 
     :yield:  dict, record augmented with genetic differences and missing sites;
     """
     with open(ref_file, encoding='utf-8') as handle:
         reflen = len(convert_fasta(handle)[0][1])
 
-    for fasta, batch in in_batcher:
+    if caller is not None:
+        in_batcher = ((*caller.call_fasta(fasta, minlen=minlen), batch)
+                      for fasta, batch in in_batcher)
+    else:
+        in_batcher = ((fasta, [], batch) for fasta, batch in in_batcher)
+
+    if pool is not None:
+        aligned = pool.map((fasta, (called, batch)) for fasta, called, batch in in_batcher)
+    else:
+        aligned = (((called, batch), minimap2.minimap2(
+            fasta, ref_file, stream=True, path=binpath, nthread=nthread,
+            minlen=minlen) if fasta else None) for fasta, called, batch in in_batcher)
+
+    for (called, batch), mm2 in aligned:
         new_records = {}
+        copies = {}  # records waiting on alignment of identical sequence
+        held = []  # records and counts to filter at end of batch
         for record in batch:
             if 'diffs' in record:
-                yield record
+                if record_filter is None:
+                    yield record
+                else:
+                    held.append((record, None))
             else:
                 record_id = record['covv_virus_name'].replace("'", "''").replace(' ', '_')
                 record_id = f"{record_id}__accession__{record['covv_accession_id']}"
 
-                new_records[record_id] = record
-
-        # If fasta is empty, no need to run minimap2
-        if len(fasta) == 0:
-            continue
-
-        mm2 = minimap2.minimap2(
-            fasta,
-            ref_file,
-            stream=True,
-            path=binpath,
-            nthread=nthread,
-            minlen=minlen)
-        result = list(minimap2.encode_diffs(mm2, reflen=reflen))
-        for qname, diffs, missing in result:
+                seqhash = None if dedup is None else dedup.copies.pop(record_id, None)
+                if seqhash is None:
+                    new_records[record_id] = record
+                elif seqhash in dedup.features:
+                    # identical sequence was aligned in a previous batch
+                    record.update(dedup.copy(seqhash))
+                    _save_features(record, cur, store)
+                    if record_filter is None:
+                        yield record
+                    else:
+                        held.append((record, None))
+                else:
+                    copies.setdefault(dedup.first[seqhash], []).append(record)
+
+        encoded = called
+        # If fasta is empty, minimap2 was not run
+        if mm2 is not None:
+            # records are yielded while minimap2 is still processing the batch,
+            # unless they are held for record_filter
+            if record_filter is None or not record_filter.fused:
+                encoded = chain(called, minimap2.encode_diffs(mm2, reflen=reflen))
+            else:
+                encoded = chain(called, minimap2.encode_filtered(
+                    mm2, reflen=reflen, mask=record_filter.mask))
+        for qname, diffs, missing, *counts in encoded:
             # reconcile minimap2 output with GISAID record
             record = new_records[qname]
+            missing = PackedIntervals.pack(missing)
             record.update({'diffs': diffs, 'missing': missing})
+            # copy before downstream steps modify diffs
+            seqhash = None if dedup is None else dedup.aligned(qname, diffs, missing)
+            _save_features(record, cur, store)
+            if record_filter is None:
+                yield record
+            else:
+                held.append((record, counts))
+
+            for dup in copies.pop(qname, []):
+                dup.update(dedup.copy(seqhash))
+                _save_features(dup, cur, store)
+                if record_filter is None:
+                    yield dup
+                else:
+                    held.append((dup, counts))
+
+        if held:
+            yield from record_filter.apply_batch(held)
+        if checkpoint is not None:
+            checkpoint.batch_done()
+
+    if store:
+        store.commit()
+
+
+def _save_features(record, cur=None, store=None):
+    """ Insert aligned record into database or feature store, if any """
+    if cur:
+        # inserting diffs (as mutation codes, see dump_mutations) and missing (as
+        # packed deltas) as json strings
+        cur.execute("INSERT INTO SEQUENCES VALUES(%s, %s, %s, %s, %s, %s, %s)",
+            [json.dumps(dump_mutations(v)) if k == 'diffs' else
+             json.dumps(PackedIntervals.pack(v).to_json()) if k == 'missing' else v
+             for k, v in record.items()])
+        cur.execute("INSERT INTO NEW_RECORDS VALUES(%s, %s)",
+            [record['covv_accession_id'], record['covv_lineage']])
+    elif store:
+        store.insert(record)
+    return record
+
+
+class RecordFilter:
+    """
+    Exclusion criteria of filter_problematic().  Passed to extract_features()
+    to filter each batch of records before the batch is reported complete,
+    and if <fused>, to exclude problematic sites as minimap2 output is
+    decoded, see minimap2.encode_filtered().
+    """
 
-            _, accession = qname.split("__accession__")
+    def __init__(
+            self,
+            origin='2019-12-01',
+            rate=0.0655,
+            cutoff=0.005,
+            maxtime=1e3,
+            vcf_file='data/ProblematicSites_SARS-CoV2/problematic_sites_sarsCov2.vcf',
+            misstol=300,
+            fused=True):
+        """
+        See filter_problematic() for arguments
+
+        :param fused:  bool, if False then extract_features() decodes and saves
+                       features as without a filter, and applies the filter
+                       at the end of each batch
+        """
+        self.fused = fused
+        self.mask = ProblematicMask.from_vcf(vcf_file)
+        self.poisson = QPois(quantile=1 - cutoff, rate=rate, maxtime=maxtime, origin=origin)
+        self.misstol = misstol
+        self.n_sites = 0
+        self.n_outlier = 0
+        self.n_ambig = 0
+
+    def apply(self, record, counts=None):
+        """
+        Exclude problematic features from record, and decide whether to
+        retain the record.
+
+        :param record:  dict, with 'diffs', 'missing' and
+                        'covv_collection_date' entries
+        :param counts:  list, optional numbers of excluded features and of
+                        missing sites, from minimap2.encode_filtered(); if
+                        given, record['diffs'] are already filtered
+        :return:  bool, False if record should be excluded
+        """
+        return bool(self.apply_batch([(record, counts)]))
+
+    def apply_batch(self, batch):
+        """
+        Apply filters to a batch of records, as apply(), classifying the
+        divergence of all records from the reference in one call to
+        QPois.is_outlier_array().
+
+        :param batch:  list, (record, counts) tuples as arguments of apply()
+        :return:  list, records to retain in order of <batch>
+        """
+        ndiffs, nmissing = [], []
+        for record, counts in batch:
+            if counts:
+                nmasked, nmiss = counts
+            else:
+                # exclude problematic sites, and features with uncalled bases
+                diffs = self.mask.filter_diffs(record['diffs'])
+                nmasked = len(record['diffs']) - len(diffs)
+                nmiss = None
+                record['diffs'] = diffs
+            self.n_sites += nmasked
+            ndiffs.append(len(record['diffs']))
+            nmissing.append(nmiss)
+
+        # exclude genomes with excessive divergence from reference
+        days = [self.poisson.days(record['covv_collection_date']) for record, _ in batch]
+        outliers = self.poisson.is_outlier_array(days, ndiffs).tolist()
+
+        result = []
+        for (record, _), ndiff, nmiss, outlier in zip(batch, ndiffs, nmissing, outliers):
+            # Exclude sequences with no mutations. See issue #530
+            if ndiff == 0:
+                continue
+            if outlier:
+                self.n_outlier += 1
+                continue
+            # exclude genomes with too much missing data
+            if nmiss is None:
+                nmiss = total_missing(record)
+            if nmiss > self.misstol:
+                self.n_ambig += 1
+                continue
+            result.append(record)
+        return result
+
+    def report(self, callback):
+        """ :param callback:  function, print numbers of excluded features and genomes """
+        callback(f"filtered {self.n_sites} problematic features")
+        callback(f"         {self.n_ambig} genomes with excess missing sites")
+        callback(f"         {self.n_outlier} genomes with excess divergence")
 
-            if cur:
-                # inserting diffs and missing as json strings
-                cur.execute("INSERT INTO SEQUENCES VALUES(%s, %s, %s, %s, %s, %s, %s)",
-                    [json.dumps(v) if k in ['diffs', 'missing'] else v for k, v in record.items()])
-                cur.execute("INSERT INTO NEW_RECORDS VALUES(%s, %s)",
-                    [accession, record['covv_lineage']])
-            yield record
 
 def filter_problematic(
         records,
@@ -233,65 +1089,35 @@ def filter_problematic(
     :param encoded: bool, flag to indicate if records are from encode_diffs()
     :param misstol:  int, maximum tolerated number of uncalled bases
     :param callback:  function, option to print messages to console
-    :yield:  generator, revised records
+    :yield:  generator, revised records; to classify records a batch at a time,
+             pass a RecordFilter to extract_features() instead
     """
     # load resources
-    mask = load_vcf(vcf_file)
-    poisson = QPois(quantile=1 - cutoff, rate=rate, maxtime=maxtime, origin=origin)
+    record_filter = RecordFilter(origin=origin, rate=rate, cutoff=cutoff, maxtime=maxtime,
+                                 vcf_file=vcf_file, misstol=misstol)
+    mask = record_filter.mask
 
-    n_sites = 0
-    n_outlier = 0
-    n_ambig = 0
     for record in records:
-        if not isinstance(record, dict):
-            qname, diffs, missing = record  # unpack tuple
-        else:
-            diffs = record['diffs']
-
-        # exclude problematic sites
-        filter = []
-        for typ, pos, alt in diffs:
-            if typ == '~' and int(pos) in mask and alt in mask[pos]['alt']:
-                continue
-            if typ != '-' and 'N' in alt:
-                # drop substitutions and insertions with uncalled bases
-                continue
-            filter.append(tuple([typ, pos, alt]))
-
-        ndiffs = len(filter)
-        n_sites += len(diffs) - ndiffs
-
+        # one record at a time, so that no records are held back when
+        # extract_features() reports a batch as complete
         if not encoded:
-            record['diffs'] = filter
-
-            # Exclude sequences with no mutations. See issue #530
-            if len(record['diffs']) == 0:
-                continue
-
-            # exclude genomes with excessive divergence from reference
-            coldate = record['covv_collection_date']
-            if poisson.is_outlier(coldate, ndiffs):
-                n_outlier += 1
-                continue
+            if record_filter.apply(record):
+                yield record
+            continue
 
-            # exclude genomes with too much missing data
-            if total_missing(record) > misstol:
-                n_ambig += 1
-                continue
-            yield record
+        if isinstance(record, dict):
+            qname, diffs, missing = record['qname'], record['diffs'], record['missing']
         else:
-            if isinstance(record, dict):
-                qname, missing = record['qname'], record['missing']
-
-            yield [qname, filter, missing]
+            qname, diffs, missing = record  # unpack tuple
+        filter = mask.filter_diffs(diffs)
+        record_filter.n_sites += len(diffs) - len(filter)
+        yield [qname, filter, missing]
 
     if callback:
-        callback(f"filtered {n_sites} problematic features")
-        callback(f"         {n_ambig} genomes with excess missing sites")
-        callback(f"         {n_outlier} genomes with excess divergence")
+        record_filter.report(callback)
 
 
-def sort_by_lineage(records, callback=None, interval=10000):
+def sort_by_lineage(records, callback=None, interval=10000, result=None):
     """
     Resolve stream into a dictionary keyed by Pangolin lineage.
     Note: records yielded from generator accumulate in this function.
@@ -299,9 +1125,13 @@ def sort_by_lineage(records, callback=None, interval=10000):
     :param records:  generator, return value of extract_features()
     :param callback:  optional, progress monitoring
     :param interval:  int, frequency to report alignment progress (genomes)
-    :return:  dict, lists of records keyed by lineage
+    :param result:  dict, optional partial result to extend, e.g., from
+                    checkpoint; or SpilledLineages to bound memory consumption
+    :return:  dict, lists of records keyed by lineage and then by mutation
+              set, see mutation_utils.pack_key()
     """
-    result = {}
+    if result is None:
+        result = {}
 
     for i, record in enumerate(records):
         if callback and i % interval == 0:
@@ -309,14 +1139,15 @@ def sort_by_lineage(records, callback=None, interval=10000):
 
         lineage = record['covv_lineage']
         diffs = record.pop('diffs')  # REMOVE entry from record!
-        if diffs is not None:
-            diffs.sort()
-        key = ','.join(['|'.join(map(str, diff)) for diff in diffs])
+        key = pack_key(diffs)
 
         if str(lineage) == "None" or lineage == '':
             # discard uncategorized genomes, #324, #335
             continue
 
+        if isinstance(result, SpilledLineages):
+            result.add(lineage, key, record)
+            continue
         if lineage not in result:
             result.update({lineage: {}})
         if key not in result[lineage]:
@@ -327,28 +1158,58 @@ def sort_by_lineage(records, callback=None, interval=10000):
     return result
 
 
+def merge_lineages(result, partial):
+    """
+    Extend records sorted by lineage with a partial result, e.g., from
+    another MPI rank.  Merging the partial results of consecutive batches
+    in order gives the same result as sort_by_lineage() on all batches.
+
+    :param result:  dict or SpilledLineages, from sort_by_lineage()
+    :param partial:  dict, from sort_by_lineage()
+    :return:  dict or SpilledLineages, <result>
+    """
+    for lineage, variants in partial.items():
+        for key, records in variants.items():
+            if isinstance(result, SpilledLineages):
+                for record in records:
+                    result.add(lineage, key, record)
+            else:
+                result.setdefault(lineage, {}).setdefault(key, []).extend(records)
+    return result
+
+
 def convert_json(infile, provision):
     """
     Convert clusters JSON file from main branch format to EpiCov format.
     :param infile:  open file stream ('r') to clusters JSON
-    :param provision:  str, path to GISAID provision file
+    :param provision:  str, path to GISAID provision file; if a block-compressed
+                       provision, only blocks containing samples are read
     :return:  dict, revised clusters to serialize to new JSON file
     """
+    clusters = json.load(infile)
+    fields = ('covv_accession_id', 'covv_virus_name', 'covv_location',
+              'covv_collection_date', 'covv_gender', 'covv_patient_age',
+              'covv_patient_status')
+
     # first generate dictionary from provision keyed by accession
+    if is_cache(provision):
+        accessions = [sample[1] for cluster in clusters
+                      for samples in cluster['nodes'].values() for sample in samples]
+        records = ProvisionCache(provision).lookup(accessions, fields=fields).values()
+    else:
+        records = _iter_provision(provision)
+
     metadata = {}
-    with lzma.open(provision, 'rb') as handle:
-        for line in handle:
-            record = json.loads(line)
-            metadata.update({record['covv_accession_id']: {
-                'name': record['covv_virus_name'],
-                'location': record['covv_location'],
-                'coldate': record['covv_collection_date'],
-                'gender': record['covv_gender'],
-                'age': record['covv_patient_age'],
-                'status': record['covv_patient_status']
-            }})
+    for record in records:
+        metadata.update({record['covv_accession_id']: {
+            'name': record['covv_virus_name'],
+            'location': record['covv_location'],
+            'coldate': record['covv_collection_date'],
+            'gender': record['covv_gender'],
+            'age': record['covv_patient_age'],
+            'status': record['covv_patient_status']
+        }})
 
-    clusters = json.load(infile)
     for cluster in clusters:
         for variant, samples in cluster['nodes'].items():
             revised = []
@@ -366,6 +1227,13 @@ def convert_json(infile, provision):
     return clusters
 
 
+def _iter_provision(provision):
+    """ Decode every record in xz-compressed provision file """
+    with lzma.open(provision, 'rb') as handle:
+        for line in handle:
+            yield json.loads(line)
+
+
 def parse_args():
     """ Command line help text"""
     parser = argparse.ArgumentParser("")
@@ -401,12 +1269,25 @@ def parse_args():
         help='option, earliest possible sample collection date (ISO format, default '
         '2019-12-01)')
 
+    parser.add_argument(
+        '--nworkers',
+        type=int,
+        default=1,
+        help='option, number of processes to decode provision JSON (default 1)')
+
+    parser.add_argument(
+        '--parser',
+        type=str,
+        default='auto',
+        choices=['auto'] + list(PARSERS),
+        help="option, provision record parser (default 'auto' uses orjson if "
+             "installed, otherwise json; 'scan' is a pure-Python field scanner)")
+
     parser.add_argument(
         '--batchsize',
         type=int,
         default=500,
-        help='option, number of records to batch process with minimap2; limited by '
-        'buffer size for stdin redirection')
+        help='option, number of records to batch process with minimap2')
 
     parser.add_argument(
         '--ref',
@@ -462,7 +1343,8 @@ if __name__ == '__main__':
         args.infile = download_feed(args.url, args.user, args.password)
 
     loader = load_gisaid(args.infile, minlen=args.minlen, mindate=args.mindate,
-                         debug=args.debug)
+                         debug=args.debug, callback=cb.callback, nworkers=args.nworkers,
+                         parser=args.parser)
     batcher = batch_fasta(loader, size=args.batchsize)
     aligned = extract_features(
         batcher,
@@ -477,4 +1359,4 @@ if __name__ == '__main__':
     by_lineage = sort_by_lineage(filtered, callback=cb.callback)
 
     # serialize to JSON file
-    json.dump(by_lineage, args.outfile)
+    dump_json(by_lineage, args.outfile)
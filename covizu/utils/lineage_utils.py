@@ -0,0 +1,225 @@
+"""external-memory container for records sorted by lineage"""
+import os
+import json
+import pickle
+import shutil
+import tempfile
+from collections.abc import Mapping
+
+from covizu.utils.mutation_utils import format_key, parse_key
+from covizu.utils.seq_utils import PackedIntervals
+
+
+class SpilledLineages(Mapping):
+    """
+    Records sorted by lineage and serialized mutation set, in the same nested
+    layout as the dict returned by gisaid_utils.sort_by_lineage().  Once the
+    estimated size of records held in memory exceeds <budget> bytes, the
+    largest lineages are appended to per-lineage files on disk.
+
+    Lineages are loaded one at a time on access, so iterating over items()
+    keeps at most one spilled lineage in memory.  The first access to a
+    spilled lineage after records were added consolidates its chunks into a
+    single pickle, and the last lineage loaded is kept, so that repeated
+    passes over the lineages each read every file once.  Lineages are
+    iterated in order of first appearance, and records within a lineage in
+    order of insertion, so the result is the same as the in-memory dict.
+    """
+
+    def __init__(self, budget=2**30, spill_dir=None):
+        """
+        :param budget:  int, maximum estimated size of records in memory (bytes)
+        :param spill_dir:  str, directory in which to create a temporary
+                           directory for spilled lineages
+        """
+        self.budget = budget
+        self.tmpdir = tempfile.mkdtemp(prefix='by_lineage.', dir=spill_dir)
+        self.memory = {}  # lineage: {key: [records]}
+        self.nbytes = {}  # lineage: estimated size in memory
+        self.files = {}  # lineage: path to spill file
+        self.order = {}  # lineages in order of first appearance
+        self.chunks = {}  # lineage: number of pickles in spill file
+        self.last = (None, None)  # most recently loaded lineage and records
+        self.total = 0
+
+    def __getstate__(self):
+        # record lengths of spill files, so that records appended after a
+        # checkpoint can be discarded on resume
+        state = self.__dict__.copy()
+        state['last'] = (None, None)
+        state['sizes'] = {lineage: os.path.getsize(path)
+                          for lineage, path in self.files.items()}
+        return state
+
+    def __setstate__(self, state):
+        sizes = state.pop('sizes')
+        self.__dict__.update(state)
+        for lineage, path in self.files.items():
+            with open(path, 'r+b') as handle:
+                handle.truncate(sizes[lineage])
+        paths = set(self.files.values())
+        for filename in os.listdir(self.tmpdir):
+            path = os.path.join(self.tmpdir, filename)
+            if path not in paths:
+                os.remove(path)  # lineage first spilled after checkpoint
+
+    def __getitem__(self, lineage):
+        if lineage not in self.order:
+            raise KeyError(lineage)
+        if lineage not in self.files:
+            return self.memory[lineage]
+
+        if self.last[0] == lineage:
+            return self.last[1]
+        result = {}
+        with open(self.files[lineage], 'rb') as handle:
+            for _ in range(self.chunks[lineage]):
+                for key, records in pickle.load(handle).items():
+                    result.setdefault(key, []).extend(records)
+        if lineage in self.memory or self.chunks[lineage] > 1:
+            for key, records in self.memory.pop(lineage, {}).items():
+                result.setdefault(key, []).extend(records)
+            self.total -= self.nbytes.pop(lineage, 0)
+            self._consolidate(lineage, result)
+        self.last = (lineage, result)
+        return result
+
+    def _consolidate(self, lineage, result):
+        """ Replace chunks of a spilled lineage with a single pickle of <result> """
+        path = self.files[lineage]
+        with open(f'{path}.tmp', 'wb') as handle:
+            pickle.dump(result, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{path}.tmp', path)
+        self.chunks[lineage] = 1
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, lineage):
+        return lineage in self.order
+
+    def add(self, lineage, key, record):
+        """
+        Append a record to a lineage, spilling to disk if over budget
+
+        :param lineage:  str, Pango lineage
+        :param key:  bytes, serialized mutation set (diffs) of record
+        :param record:  dict, record without 'diffs' entry
+        """
+        self.order.setdefault(lineage, None)
+        if self.last[0] == lineage:
+            self.last = (None, None)
+        self.memory.setdefault(lineage, {}).setdefault(key, []).append(record)
+
+        size = len(key) + record_size(record)
+        self.nbytes[lineage] = self.nbytes.get(lineage, 0) + size
+        self.total += size
+        if self.total > self.budget:
+            self.spill()
+
+    def spill(self):
+        """ Write largest lineages to disk until memory use is under half of budget """
+        for lineage in sorted(self.nbytes, key=self.nbytes.get, reverse=True):
+            if self.total <= self.budget // 2:
+                break
+            if lineage not in self.files:
+                self.files[lineage] = os.path.join(self.tmpdir, f'{len(self.files)}.pickle')
+            with open(self.files[lineage], 'ab') as handle:
+                pickle.dump(self.memory.pop(lineage), handle,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            self.chunks[lineage] = self.chunks.get(lineage, 0) + 1
+            self.total -= self.nbytes.pop(lineage)
+
+    def close(self):
+        """ Remove spilled lineages from disk """
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+def record_size(record):
+    """
+    Estimated size of a record in memory, from the lengths of its fields,
+    without serializing it
+
+    :param record:  dict, record without 'diffs' entry
+    :return:  int, size in bytes
+    """
+    size = 0
+    for field, value in record.items():
+        if isinstance(value, PackedIntervals):
+            value = value.data
+        size += len(field) + (len(value) if isinstance(value, (str, bytes)) else 8)
+    return size
+
+
+class LineageView(Mapping):
+    """
+    Read-only view on a subset of lineages, preserving lazy access to
+    SpilledLineages.
+    """
+
+    def __init__(self, by_lineage, lineages):
+        """
+        :param by_lineage:  dict or SpilledLineages, from sort_by_lineage()
+        :param lineages:  list, lineages to include in view
+        """
+        self.by_lineage = by_lineage
+        self.lineages = {lineage: None for lineage in lineages}
+
+    def __getitem__(self, lineage):
+        if lineage not in self.lineages:
+            raise KeyError(lineage)
+        return self.by_lineage[lineage]
+
+    def __iter__(self):
+        return iter(self.lineages)
+
+    def __len__(self):
+        return len(self.lineages)
+
+    def __contains__(self, lineage):
+        return lineage in self.lineages
+
+
+def dump_json(by_lineage, handle):
+    """
+    Write records sorted by lineage to a JSON file one lineage at a time.
+    Mutation sets are written as comma-separated mutation codes, see
+    mutation_utils.format_key(), and missing sites as PackedIntervals deltas;
+    read back with load_json().
+
+    :param by_lineage:  dict or SpilledLineages, from sort_by_lineage()
+    :param handle:  file object open for writing
+    """
+    handle.write('{')
+    for i, (lineage, records) in enumerate(by_lineage.items()):
+        if i > 0:
+            handle.write(', ')
+        records = {format_key(key): variant for key, variant in records.items()}
+        handle.write(f'{json.dumps(lineage)}: {json.dumps(records, default=_to_json)}')
+    handle.write('}')
+
+
+def _to_json(obj):
+    """ Serialize missing sites of records, see json.dump() """
+    if isinstance(obj, PackedIntervals):
+        return obj.to_json()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def load_json(handle):
+    """
+    :param handle:  file object open for reading, written by dump_json()
+    :return:  dict, records keyed by lineage and mutation set, as returned
+              by sort_by_lineage()
+    """
+    by_lineage = {}
+    for lineage, records in json.load(handle).items():
+        for variant in records.values():
+            for record in variant:
+                if 'missing' in record:
+                    record['missing'] = PackedIntervals.from_json(record['missing'])
+        by_lineage[lineage] = {parse_key(key): variant for key, variant in records.items()}
+    return by_lineage
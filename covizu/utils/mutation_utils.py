@@ -0,0 +1,186 @@
+"""compact integer encoding of mutations (genetic differences from reference)"""
+import hashlib
+from functools import lru_cache
+
+import numpy as np
+
+
+TYPES = '~-+'  # substitution, deletion, insertion
+ALLELES = 'ACGTRYKMSWBDHVN'  # nucleotide codes of substitutions
+BASES = 'ACGT'  # nucleotides packed 2 bits each into insertion codes
+
+# bit layout of a mutation code, fits in a signed 64-bit integer:
+#   position (20 bits) | type (2 bits) | payload (41 bits)
+# payload is the allele code of a substitution, length of a deletion, or
+#   length (12 bits) | hashed flag (1 bit) | packed bases or hash (28 bits)
+# of an insertion, such that codes sort by position first
+POS_SHIFT = 43
+TYPE_SHIFT = 41
+PAYLOAD_MASK = (1 << TYPE_SHIFT) - 1
+INSERT_LENGTH_SHIFT = 29
+INSERT_HASHED = 1 << 28
+INSERT_VALUE_MASK = INSERT_HASHED - 1
+INLINE_MAX = 14  # longest insertion of ACGT packed into its code
+MAXPOS = 1 << (63 - POS_SHIFT)
+MAXINSERT = 1 << (TYPE_SHIFT - INSERT_LENGTH_SHIFT)
+
+_inserts = {}  # sequences of insertions encoded by hash, by code
+
+
+@lru_cache(maxsize=2**20)
+def _encode(typ, pos, alt):
+    if not 0 <= pos < MAXPOS:
+        raise ValueError(f"Position of mutation {(typ, pos, alt)!r} out of range")
+    code = (pos << POS_SHIFT) | (TYPES.index(typ) << TYPE_SHIFT)
+    if typ == '~':
+        return code | ALLELES.index(alt)
+    if typ == '-':
+        return code | alt
+
+    length = len(alt)
+    if length >= MAXINSERT:
+        raise ValueError(f"Insertion of {length} nt at {pos} is too long to encode")
+    code |= length << INSERT_LENGTH_SHIFT
+    if length <= INLINE_MAX and all(nt in BASES for nt in alt):
+        value = 0
+        for nt in alt:
+            value = (value << 2) | BASES.index(nt)
+        return code | value
+    digest = hashlib.blake2b(alt.encode('ascii'), digest_size=4).digest()
+    code |= INSERT_HASHED | (int.from_bytes(digest, 'big') & INSERT_VALUE_MASK)
+    _inserts[code] = alt
+    return code
+
+
+def encode_mutation(diff):
+    """
+    Encode a mutation as an integer
+
+    :param diff:  tuple, (type, position, alt) with type '~', '-' or '+', and
+                  alt the nucleotide, deletion length or inserted sequence
+    :return:  int, mutation code
+    """
+    typ, pos, alt = diff
+    return _encode(typ, int(pos), int(alt) if typ == '-' else alt)
+
+
+def decode_mutation(code):
+    """
+    Recover mutation from its integer code.  Insertions longer than INLINE_MAX,
+    or with ambiguous bases, are encoded by hash; their sequence is recovered
+    in the process that encoded them, and is otherwise replaced by 'N's of
+    the same length, which is sufficient for SC2Locator.parse_mutation() and
+    apply_features().
+
+    :param code:  int, returned by encode_mutation()
+    :return:  tuple, (type, position, alt)
+    """
+    code = int(code)
+    if code in _inserts:
+        return '+', code >> POS_SHIFT, _inserts[code]
+    return _decode(code)
+
+
+@lru_cache(maxsize=2**20)
+def _decode(code):
+    pos = code >> POS_SHIFT
+    typ = TYPES[(code >> TYPE_SHIFT) & 3]
+    payload = code & PAYLOAD_MASK
+    if typ == '~':
+        return typ, pos, ALLELES[payload]
+    if typ == '-':
+        return typ, pos, payload
+
+    length = payload >> INSERT_LENGTH_SHIFT
+    if payload & INSERT_HASHED:
+        return typ, pos, 'N' * length  # sequence not known to this process
+    value = payload & INSERT_VALUE_MASK
+    alt = ''.join(BASES[(value >> (2 * i)) & 3] for i in range(length - 1, -1, -1))
+    return typ, pos, alt
+
+
+def encode_mutations(diffs):
+    """
+    :param diffs:  list, (type, position, alt) tuples of a genome, or None
+    :return:  numpy.ndarray, sorted mutation codes (int64)
+    """
+    if not diffs:
+        return np.zeros(0, dtype=np.int64)
+    codes = np.fromiter(map(encode_mutation, diffs), dtype=np.int64, count=len(diffs))
+    codes.sort()
+    return codes
+
+
+def decode_mutations(codes):
+    """
+    :param codes:  iterable, mutation codes; or JSON-decoded diffs
+                   as lists, as stored by previous versions
+    :return:  list, (type, position, alt) tuples
+    """
+    return [tuple(code) if isinstance(code, list) else decode_mutation(code)
+            for code in codes]
+
+
+def dump_mutations(diffs):
+    """
+    Mutations of a genome for storage as JSON, e.g., in the SEQUENCES table.
+    Mutations are stored as codes, except insertions encoded by hash, which
+    are stored as [type, position, alt] lists so that their sequence is not
+    lost.  Read back with decode_mutations().
+
+    :param diffs:  list, (type, position, alt) tuples of a genome, or None
+    :return:  list, mutation codes (int) and lists, in order of code
+    """
+    result = []
+    coded = sorted(((encode_mutation(diff), diff) for diff in diffs or []),
+                   key=lambda pair: pair[0])
+    for code, (typ, pos, alt) in coded:
+        if typ == '+' and code & INSERT_HASHED:
+            result.append([typ, int(pos), alt])
+        else:
+            result.append(code)
+    return result
+
+
+def pack_key(diffs):
+    """
+    Serialize the mutation set of a genome to a compact, hashable key, e.g.,
+    to group genomes by sort_by_lineage().
+
+    :param diffs:  list, (type, position, alt) tuples of a genome, or None
+    :return:  bytes, sorted mutation codes
+    """
+    return encode_mutations(diffs).tobytes()
+
+
+def key_codes(key):
+    """
+    :param key:  bytes, returned by pack_key()
+    :return:  numpy.ndarray, read-only view of sorted mutation codes (int64)
+    """
+    return np.frombuffer(key, dtype=np.int64)
+
+
+def unpack_key(key):
+    """
+    :param key:  bytes, returned by pack_key()
+    :return:  list, (type, position, alt) tuples in order of code
+    """
+    return list(map(decode_mutation, key_codes(key).tolist()))
+
+
+def format_key(key):
+    """
+    :param key:  bytes, returned by pack_key()
+    :return:  str, comma-separated mutation codes, e.g., for JSON object keys
+    """
+    return ','.join(map(str, key_codes(key).tolist()))
+
+
+def parse_key(text):
+    """
+    :param text:  str, returned by format_key()
+    :return:  bytes, as returned by pack_key()
+    """
+    codes = [int(code) for code in text.split(',')] if text else []
+    return np.array(codes, dtype=np.int64).tobytes()
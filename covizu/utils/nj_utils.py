@@ -0,0 +1,261 @@
+"""in-process neighbor-joining, an alternative to RapidNJ for bootstrap trees"""
+import numpy as np
+from Bio.Phylo.BaseTree import Clade, Tree
+
+
+class NJTree:
+    """
+    Compact tree returned by neighbor_joining().  Nodes are numbered with
+    tips first (0 to ntips-1), followed by internal nodes in the order they
+    were joined, so every node is numbered before its parent and the last
+    node is the root.
+    """
+    __slots__ = ('parent', 'lengths', 'names')
+
+    def __init__(self, parent, lengths, names):
+        """
+        :param parent:  numpy.ndarray, index of parent by node, -1 for root
+        :param lengths:  numpy.ndarray, length of branch to parent by node
+        :param names:  list, tip labels
+        """
+        self.parent = parent
+        self.lengths = lengths
+        self.names = names
+
+    def __len__(self):
+        return len(self.parent)
+
+    @property
+    def ntips(self):
+        """ :return:  int, number of tips """
+        return len(self.names)
+
+    def children(self):
+        """ :return:  list, indices of child nodes by node """
+        result = [[] for _ in range(len(self))]
+        for node, parent in enumerate(self.parent.tolist()):
+            if parent >= 0:
+                result[parent].append(node)
+        return result
+
+    def terminals(self):
+        """ :yield:  str, float; label and branch length of each tip """
+        yield from zip(self.names, self.lengths[:self.ntips].tolist())
+
+    def splits(self, tip_index):
+        """
+        Tips descended from every internal node, as recorded by consensus()
+
+        :param tip_index:  dict, integer indices keyed by tip label
+        :yield:  list, sorted tip indices; and float, length of branch to
+                 parent (None for root)
+        """
+        members = [[tip_index[name]] for name in self.names]
+        lengths = self.lengths.tolist()
+        for node, kids in enumerate(self.children()[self.ntips:], self.ntips):
+            tips = sorted(tip for child in kids for tip in members[child])
+            members.append(tips)
+            yield tips, None if self.parent[node] < 0 else lengths[node]
+
+    def to_phylo(self):
+        """ :return:  Bio.Phylo.BaseTree.Tree, e.g., to write as Newick """
+        clades = [Clade(name=name, branch_length=length)
+                  for name, length in self.terminals()]
+        lengths = self.lengths.tolist()
+        for node, kids in enumerate(self.children()[self.ntips:], self.ntips):
+            length = None if self.parent[node] < 0 else lengths[node]
+            clades.append(Clade(branch_length=length, clades=[clades[k] for k in kids]))
+        return Tree(root=clades[-1], rooted=False)
+
+
+def _best_pair(dists, sums, rows):
+    """
+    Minimum of Q-matrix over the given rows of the distance matrix,
+    Q(i, j) = (r - 2) d(i, j) - u(i) - u(j), with u the row sums
+
+    :return:  int, int, float; row and column of minimum, and its value
+    """
+    nrows = len(sums)
+    qvals = (nrows - 2) * dists[rows].astype(np.float64)
+    qvals -= sums[rows, None]
+    qvals -= sums[None, :]
+    idx = int(qvals.argmin())
+    row, col = divmod(idx, nrows)
+    return int(rows[row]), col, float(qvals.flat[idx])
+
+
+def _join_lengths(dij, ui, uj, nrows):
+    """ :return:  float, float; non-negative branch lengths to nodes i and j """
+    left = 0.5 * dij + (ui - uj) / (2 * (nrows - 2))
+    left = min(max(left, 0.), dij)
+    return left, dij - left
+
+
+class _NearestCache:
+    """
+    Nearest columns of each row of the distance matrix, so that the search
+    for the minimum of the Q-matrix can visit rows in order of distance as
+    in RapidNJ, without keeping a sorted copy of the whole matrix.  Every
+    distance of row m not in its cache is at least thresh[m].
+    """
+
+    def __init__(self, mat, size):
+        self.size = size
+        self.cols = np.zeros((len(mat), size), dtype=np.int64)
+        self.dists = np.full((len(mat), size), np.inf, dtype=np.float32)
+        self.thresh = np.full(len(mat), np.inf, dtype=np.float32)
+        self.refresh(mat, np.arange(len(mat)))
+
+    def refresh(self, active, rows):
+        """ Rebuild cache of <rows> from the active distance matrix """
+        nrows = active.shape[1]
+        block = active[rows]
+        if nrows <= self.size:
+            cols = np.broadcast_to(np.arange(nrows), block.shape)
+            self.thresh[rows] = np.inf
+        else:
+            part = np.argpartition(block, self.size, axis=1)
+            cols = part[:, :self.size]
+            self.thresh[rows] = np.take_along_axis(block, part[:, self.size:(self.size + 1)],
+                                                   axis=1)[:, 0]
+        self.cols[rows] = 0
+        self.cols[rows, :cols.shape[1]] = cols
+        self.dists[rows] = np.inf
+        self.dists[rows, :cols.shape[1]] = np.take_along_axis(block, cols, axis=1)
+
+    def join(self, i, j, last, newrow):
+        """
+        Update caches after nodes in rows i and j are joined into a new node
+        in row i, and row <last> is moved into row j.
+        """
+        nrows = last
+        removed = (self.cols[:(last + 1)] == i) | (self.cols[:(last + 1)] == j)
+        self.dists[:(last + 1)][removed] = np.inf
+        if j != last:
+            self.cols[j], self.dists[j] = self.cols[last], self.dists[last]
+            self.thresh[j] = self.thresh[last]
+        cols = self.cols[:nrows]
+        cols[cols == last] = j
+
+        # insert distances to new node below threshold, evicting the largest
+        rows = np.flatnonzero(newrow[:nrows] < self.thresh[:nrows])
+        rows = rows[rows != i]
+        slots = self.dists[rows].argmax(axis=1)
+        evicted = self.dists[rows, slots]
+        self.thresh[rows] = np.minimum(self.thresh[rows], evicted)
+        self.dists[rows, slots] = newrow[rows]
+        self.cols[rows, slots] = i
+
+    def best_pair(self, sums):
+        """
+        :return:  numpy.ndarray, minimum of Q-matrix over cached columns by row;
+                  and column of minimum
+        """
+        nrows = len(sums)
+        qvals = (nrows - 2) * self.dists[:nrows].astype(np.float64)
+        qvals -= sums[:, None]
+        qvals -= sums[np.minimum(self.cols[:nrows], nrows - 1)]
+        slots = qvals.argmin(axis=1)
+        rows = np.arange(nrows)
+        return qvals[rows, slots], self.cols[rows, slots]
+
+
+def neighbor_joining(dists, names=None, chunk=32):
+    """
+    Reconstruct a tree from a distance matrix by neighbor-joining.  As in
+    RapidNJ (Simonsen et al. 2008), the search for the pair of nodes to join
+    is bounded:  Q(i, j) >= (r - 2) d(i, j) - u(i) - max(u), so distances of
+    row i larger than a threshold cannot improve on the smallest Q value
+    found.  Rather than sorting every row, we keep the <chunk> nearest
+    columns of each row, search those first and scan the full row only if
+    its threshold does not rule it out.  The <chunk> columns with largest
+    row sums u are searched exactly, to tighten max(u) for the others.
+    Negative branch lengths are set to zero, as with --no-negative-length in
+    RapidNJ, and the last three nodes are joined at the root.
+
+    :param dists:  numpy.ndarray, symmetric matrix of pairwise distances
+    :param names:  list, optional tip labels; defaults to row indices as str,
+                   as RapidNJ labels rows of PHYLIP input
+    :param chunk:  int, number of nearest columns to cache by row
+    :return:  NJTree
+    """
+    ntips = len(dists)
+    if ntips < 2:
+        raise ValueError("neighbor-joining requires at least two tips")
+    if names is None:
+        names = [str(i) for i in range(ntips)]
+
+    mat = np.array(dists, dtype=np.float32)  # single precision, as RapidNJ
+    sums = mat.sum(axis=1, dtype=np.float64)
+    np.fill_diagonal(mat, np.inf)
+    nearest = _NearestCache(mat, chunk)
+    nodes = np.arange(ntips)  # node of each row of <mat>
+
+    parent = np.full(max(2 * ntips - 2, ntips + 1), -1, dtype=np.int32)
+    lengths = np.full(len(parent), np.nan)
+    nxt = ntips
+    nrows = ntips
+    while nrows > 3:
+        active = mat[:nrows, :nrows]
+        usum = sums[:nrows]
+        qmin, qcol = nearest.best_pair(usum)
+        i = int(qmin.argmin())
+        j, best = int(qcol[i]), float(qmin[i])
+        umax = usum.max()
+        if chunk < nrows:
+            top = np.argpartition(usum, nrows - chunk - 1)
+            umax = usum[top[nrows - chunk - 1]]
+            i2, j2, best2 = _best_pair(active, usum, top[(nrows - chunk):])
+            if best2 < best:
+                i, j, best = i2, j2, best2
+
+        # scan rows not ruled out by their threshold
+        bound = (nrows - 2) * nearest.thresh[:nrows].astype(np.float64) - usum - umax
+        rows = np.flatnonzero(bound < best)
+        if rows.size:
+            i2, j2, best2 = _best_pair(active, usum, rows)
+            if best2 < best:
+                i, j = i2, j2
+            nearest.refresh(active, rows)
+        i, j = min(i, j), max(i, j)
+
+        # join nodes i and j, new node replaces row i
+        dij = float(active[i, j])
+        li, lj = _join_lengths(dij, usum[i], usum[j], nrows)
+        parent[nodes[i]] = parent[nodes[j]] = nxt
+        lengths[nodes[i]], lengths[nodes[j]] = li, lj
+
+        row_i = active[i].astype(np.float64)
+        row_j = active[j].astype(np.float64)
+        newrow = 0.5 * (row_i + row_j - dij)
+        newrow[[i, j]] = np.inf
+        usum -= 0.5 * (row_i + row_j + dij)
+        usum[i] = newrow[np.isfinite(newrow)].sum()
+        active[i, :] = newrow
+        active[:, i] = newrow
+        nodes[i] = nxt
+        nxt += 1
+
+        # remove row j, moving last row into its place
+        last = nrows - 1
+        if j != last:
+            active[j, :] = active[last, :]
+            active[:, j] = active[:, last]
+            active[j, j] = np.inf
+            usum[j], nodes[j] = usum[last], nodes[last]
+            newrow[j] = newrow[last]
+        nrows -= 1
+        nearest.join(i, j, last, newrow.astype(np.float32))
+        nearest.refresh(mat[:nrows, :nrows], np.array([i]))
+
+    # join remaining nodes at root
+    if nrows == 3:
+        d01, d02, d12 = (float(mat[0, 1]), float(mat[0, 2]), float(mat[1, 2]))
+        rootlen = [0.5 * (d01 + d02 - d12), 0.5 * (d01 + d12 - d02),
+                   0.5 * (d02 + d12 - d01)]
+    else:
+        rootlen = [0.5 * float(mat[0, 1])] * 2
+    for row in range(nrows):
+        parent[nodes[row]] = nxt
+        lengths[nodes[row]] = max(rootlen[row], 0.)
+    return NJTree(parent[:(nxt + 1)], lengths[:(nxt + 1)], names)
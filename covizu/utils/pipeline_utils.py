@@ -0,0 +1,133 @@
+"""concurrent pipeline stages connected by bounded queues"""
+import queue
+import threading
+import time
+
+
+_local = threading.local()  # stage running in the current thread, if any
+
+_END = object()  # marks end of stream
+
+
+class _Error:
+    """ Carries an exception raised in a stage thread to its consumer """
+    def __init__(self, err):
+        self.err = err
+
+
+class _Marker:
+    """ Deferred function call that travels downstream in stream order """
+    def __init__(self, func):
+        self.func = func
+
+
+def defer(func):
+    """
+    Call <func> once every item yielded so far by the current stage has been
+    consumed at the end of the pipeline, e.g., to save a checkpoint.  Outside
+    of a stage thread, <func> is called immediately.
+
+    :param func:  function, called without arguments
+    """
+    stage = getattr(_local, 'stage', None)
+    if stage is None:
+        func()
+    else:
+        stage.put(_Marker(func))
+
+
+class Stage:
+    """
+    Run a generator in its own thread, passing items to the consumer through
+    a bounded queue.  When the queue is full the generator is paused
+    (backpressure); when it is empty the consumer waits.  Stages are chained
+    by constructing the next generator on a Stage object, e.g.,
+
+        batches = Stage('decode', batch_fasta(load_gisaid(path)))
+        records = Stage('align', extract_features(batches, ref_file))
+        by_lineage = sort_by_lineage(records)
+
+    so that decoding, alignment and post-processing overlap, while items
+    remain in input order.  The thread starts on first iteration.
+    """
+
+    def __init__(self, name, items, maxsize=100):
+        """
+        :param name:  str, label for utilisation report
+        :param items:  iterable, typically a generator consuming an upstream Stage
+        :param maxsize:  int, maximum number of items in queue
+        """
+        self.name = name
+        self.items = items
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.stopped = threading.Event()
+        self.thread = None
+        self.nitems = 0
+        self.elapsed = 0.
+        self.wait_input = 0.  # time blocked on upstream stage
+        self.wait_output = 0.  # time blocked on full queue
+
+    def put(self, item):
+        """ Put item on queue, timing the wait if queue is full """
+        start = time.perf_counter()
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.wait_output += time.perf_counter() - start
+
+    def _run(self):
+        _local.stage = self
+        start = time.perf_counter()
+        try:
+            for item in self.items:
+                self.nitems += 1
+                self.put(item)
+                if self.stopped.is_set():
+                    break
+            self.put(_END)
+        except Exception as err:  # pylint: disable=broad-except
+            self.put(_Error(err))
+        finally:
+            self.elapsed = time.perf_counter() - start
+
+    def __iter__(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self.thread.start()
+
+        consumer = getattr(_local, 'stage', None)
+        try:
+            while True:
+                start = time.perf_counter()
+                item = self.queue.get()
+                if consumer is not None:
+                    consumer.wait_input += time.perf_counter() - start
+
+                if item is _END:
+                    break
+                if isinstance(item, _Error):
+                    raise item.err
+                if isinstance(item, _Marker):
+                    # all preceding items have been consumed
+                    defer(item.func)
+                    continue
+                yield item
+        finally:
+            # stop producer if consumer exits early
+            self.stopped.set()
+
+    def utilisation(self):
+        """ :return:  float, fraction of stage run time not spent waiting """
+        if self.elapsed == 0:
+            return 0.
+        busy = self.elapsed - self.wait_input - self.wait_output
+        return max(0., busy / self.elapsed)
+
+    def report(self):
+        """ :return:  str, summary of stage utilisation """
+        return (f"stage {self.name}: {self.nitems} items in {self.elapsed:.1f}s, "
+                f"{self.utilisation():.0%} busy, {self.wait_input:.1f}s waiting for input, "
+                f"{self.wait_output:.1f}s waiting for output")
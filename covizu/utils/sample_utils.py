@@ -0,0 +1,80 @@
+"""compact table of sample metadata indexed by integer IDs"""
+import sys
+from array import array
+
+
+class SampleRegistry:
+    """
+    Interned, array-backed table of genome samples.  Each sample is assigned
+    an integer ID in order of registration.  Locations and collection dates
+    are dictionary-encoded, so that many samples share one string object.
+
+    Passing sample IDs through recode_features(), annotate_tree() and
+    serialize_tree() replaces the 'name|location|accession|date' label
+    strings that were otherwise built and split for every sample.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.accessions = []
+        self.location_codes = array('L')
+        self.date_codes = array('L')
+        self.locations = []  # dictionary of unique values, indexed by code
+        self.dates = []
+        self._location_index = {}
+        self._date_index = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def _encode(value, values, index):
+        code = index.get(value, None)
+        if code is None:
+            code = len(values)
+            index[value] = code
+            values.append(sys.intern(value))
+        return code
+
+    def add(self, name, location, accession, coldate):
+        """
+        Register a sample
+
+        :param name:  str, virus name
+        :param location:  str, sample location
+        :param accession:  str, GISAID accession number
+        :param coldate:  str, sample collection date (ISO format)
+        :return:  int, sample ID
+        """
+        self.names.append(name)
+        self.accessions.append(accession)
+        self.location_codes.append(
+            self._encode(location, self.locations, self._location_index))
+        self.date_codes.append(self._encode(coldate, self.dates, self._date_index))
+        return len(self.names) - 1
+
+    def add_record(self, record):
+        """
+        Register a sample from a GISAID record
+
+        :param record:  dict, from sort_by_lineage()
+        :return:  int, sample ID
+        """
+        return self.add(record['covv_virus_name'], record['covv_location'],
+                        record['covv_accession_id'], record['covv_collection_date'])
+
+    def date(self, sid):
+        """ :return:  str, collection date of sample """
+        return self.dates[self.date_codes[sid]]
+
+    def row(self, sid):
+        """
+        :return:  list, [coldate, accession, location, name] of sample, in the
+                  same order as label.split('|')[::-1]
+        """
+        return [self.dates[self.date_codes[sid]], self.accessions[sid],
+                self.locations[self.location_codes[sid]], self.names[sid]]
+
+    def label(self, sid):
+        """ :return:  str, sample label 'name|location|accession|date' """
+        return '|'.join(self.row(sid)[::-1])
@@ -1,8 +1,15 @@
 """utils for seq"""
 from datetime import date
+from array import array
 import bisect
+from itertools import islice
+import hashlib
+import json
+import os
+import tempfile
 import pkg_resources
 
+import numpy as np
 from scipy.stats import poisson
 from scipy.optimize import root
 
@@ -80,6 +87,110 @@ def convert_fasta(handle):
     return result
 
 
+class PackedIntervals:
+    """
+    Closed-open intervals of missing data in a genome, packed into int32
+    deltas: the start of each interval relative to the end of the previous
+    interval, followed by its length.  Replaces lists of (left, right)
+    tuples, over which it iterates and to which it compares equal, at a
+    fraction of the memory.  Immutable, so it can be shared by records.
+    """
+
+    __slots__ = ('data', )
+
+    def __init__(self, data=b''):
+        """
+        :param data:  bytes, int32 (delta, length) pairs
+        """
+        self.data = data
+
+    @classmethod
+    def pack(cls, intervals):
+        """
+        :param intervals:  iterable, (left, right) tuples in ascending order
+        :return:  PackedIntervals; <intervals> if already packed
+        """
+        if isinstance(intervals, cls):
+            return intervals
+        deltas = array('i')
+        end = 0
+        for left, right in intervals:
+            deltas.append(left - end)
+            deltas.append(right - left)
+            end = right
+        return cls(deltas.tobytes())
+
+    @classmethod
+    def from_json(cls, value):
+        """
+        :param value:  list, deltas from to_json(); or [left, right] lists, as
+                       stored by previous versions
+        :return:  PackedIntervals
+        """
+        if value and isinstance(value[0], list):
+            return cls.pack(value)
+        return cls(array('i', value).tobytes())
+
+    def to_json(self):
+        """ :return:  list, int deltas and lengths """
+        return self.deltas().tolist()
+
+    def deltas(self):
+        """ :return:  memoryview, int32 deltas and lengths """
+        return memoryview(self.data).cast('i')
+
+    def __iter__(self):
+        end = 0
+        deltas = self.deltas()
+        for i in range(0, len(deltas), 2):
+            left = end + deltas[i]
+            end = left + deltas[i + 1]
+            yield left, end
+
+    def __len__(self):
+        return len(self.data) // 8
+
+    def __eq__(self, other):
+        if isinstance(other, PackedIntervals):
+            return self.data == other.data
+        try:
+            return list(self) == [tuple(interval) for interval in other]
+        except TypeError:
+            return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'PackedIntervals({list(self)!r})'
+
+    def total(self):
+        """ :return:  int, total length of intervals """
+        return sum(self.deltas()[1::2])
+
+    def overlap(self, left, right):
+        """
+        :param left:  int, start of closed-open interval
+        :param right:  int, end of interval
+        :return:  int, number of missing sites in interval
+        """
+        result = 0
+        for start, end in self:
+            if start >= right:
+                break
+            result += max(0, min(end, right) - max(start, left))
+        return result
+
+    def mask(self, buffer, char=b'N'):
+        """
+        Overwrite missing sites of an aligned sequence in place
+
+        :param buffer:  bytearray, aligned sequence
+        :param char:  bytes, single character to write at missing sites
+        """
+        for left, right in self:
+            buffer[left:right] = char * (right - left)
+
+
 def total_missing(row):
     """ Calculate the total number of missing sites from closed-open interval annotations """
     res = 0
@@ -88,6 +199,8 @@ def total_missing(row):
     else:
         _, _, missing = row
 
+    if isinstance(missing, PackedIntervals):
+        return missing.total()
     for left, right in missing:
         res += right - left
     return res
@@ -99,23 +212,23 @@ def apply_features(diffs, missing, refseq):
     missing data vector.
 
     :param row:  list, entry from features list returned by import_json()
+    :param missing:  PackedIntervals, or list of (left, right) tuples
     :param refseq:  str, reference genome
     :return:  str, aligned genome
     """
-    result = refseq
+    result = bytearray(refseq, 'ascii')
 
     # apply missing intervals
-    for left, right in missing:
-        result = f"{result[:left]}{'N' * (right - left)}{result[right:]}"
+    PackedIntervals.pack(missing).mask(result)
 
     # apply substitutions and deletions (skip insertions)
     for dtype, pos, diff in diffs:
         if dtype == '~':
-            result = f'{result[:pos]}{diff}{result[pos + 1:]}'
+            result[pos:(pos + 1)] = diff.encode('ascii')
         elif dtype == '-':
-            result = f"{result[:pos]}{'-' * diff}{result[pos + diff:]}"
+            result[pos:(pos + diff)] = b'-' * diff
 
-    return result
+    return result.decode('ascii')
 
 
 def fromisoformat(date_time):
@@ -127,18 +240,31 @@ def fromisoformat(date_time):
     return date(year, month, day)
 
 
+# directory for persistent caches, e.g., of QPois transition points; caches
+# are only kept in memory unless COVIZU_CACHE is set
+CACHE_DIR = os.environ.get('COVIZU_CACHE', None)
+
+
 class QPois:
     """
     Cache the quantile transition points for Poisson distribution for a given
     rate <L> and varying time <t>, s.t. \\exp(-Lt)\\sum_{i=0}^{k} (Lt)^i/i! = Q.
+
+    Transition points are computed once per (quantile, rate, maxtime), and
+    kept in memory and in a JSON file under <cache_dir>, so that later
+    instances, also in other processes, skip the root-finding.
     """
 
-    def __init__(self, quantile, rate, maxtime, origin='2019-12-01'):
+    _tables = {}  # in-memory cache of transition points, shared by instances
+
+    def __init__(self, quantile, rate, maxtime, origin='2019-12-01', cache_dir=CACHE_DIR):
         """
         :param quantile:  float, cut distribution at q and 1-q
         :param rate:  float, molecular clock rate (genome / day)
         :param maxtime:  int, maximum number of days to cache
         :param origin:  str, x-intercept of trend in ISO format
+        :param cache_dir:  str, directory to persist transition points;
+                           if None, points are only cached in memory
         """
         if quantile <= 0 or quantile >= 1:
             print("ERROR: QPois quantile argument must be on closed interval (0,1).")
@@ -147,8 +273,46 @@ class QPois:
         self.rate = rate
         self.maxtime = maxtime
         self.origin = fromisoformat(origin)
+        self._days = {}  # days since origin, keyed by ISO date
+
+        key = (self.upperq, self.rate, self.maxtime)
+        if key not in self._tables:
+            self._tables[key] = self.load_timepoints(cache_dir)
+        self.timepoints_upper, self.timepoints_lower = self._tables[key]
+        self.array_upper = np.array(self.timepoints_upper)
+        self.array_lower = np.array(self.timepoints_lower)
 
-        self.timepoints_upper, self.timepoints_lower = self.compute_timepoints()
+    def load_timepoints(self, cache_dir):
+        """
+        Read transition points from cache file, or compute and write them
+
+        :param cache_dir:  str, directory of cache files, or None
+        :return:  list, list; upper and lower transition points
+        """
+        if cache_dir is None:
+            return self.compute_timepoints()
+
+        key = json.dumps([self.upperq, self.rate, self.maxtime])
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).hexdigest()
+        path = os.path.join(cache_dir, f'qpois-{digest}.json')
+        try:
+            with open(path, encoding='utf-8') as handle:
+                cached = json.load(handle)
+            if cached['key'] == key:
+                return cached['upper'], cached['lower']
+        except (OSError, ValueError, KeyError):
+            pass  # missing or unreadable cache file
+
+        upper, lower = self.compute_timepoints()
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmpfile = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as handle:
+                json.dump({'key': key, 'upper': upper, 'lower': lower}, handle)
+            os.replace(tmpfile, path)
+        except OSError:
+            pass  # cache directory is not writable
+        return upper, lower
 
     def objfunc(self, in_x, in_k, in_q):
         """ Use root-finding to find transition point for Poisson CDF """
@@ -188,27 +352,55 @@ class QPois:
         """ Retrieve quantile count, given time """
         return bisect.bisect(timepoints, time)
 
+    def days(self, coldate):
+        """
+        :param coldate:  str, date in ISO format; or datetime.date
+        :return:  int, days since origin
+        """
+        if not isinstance(coldate, str):
+            return (coldate - self.origin).days
+        days = self._days.get(coldate, None)
+        if days is None:
+            days = (fromisoformat(coldate) - self.origin).days
+            self._days[coldate] = days
+        return days
+
     def is_outlier(self, coldate, ndiffs):
         """check if number of differences is an outlier"""
         if self.lowerq == 0:
             return False
 
-        if isinstance(coldate, str):
-            coldate = fromisoformat(coldate)
-        date_time = (coldate - self.origin).days
+        date_time = self.days(coldate)
         qmax = self.lookup(date_time, self.timepoints_upper)
         qmin = self.lookup(date_time, self.timepoints_lower)
         if ndiffs > qmax or ndiffs <= qmin:
             return True
         return False
 
+    def is_outlier_array(self, days, ndiffs):
+        """
+        Classify a batch of genomes at once, as is_outlier()
+
+        :param days:  array-like, days since origin (see days())
+        :param ndiffs:  array-like, numbers of differences from reference
+        :return:  numpy.ndarray, boolean; True for outliers
+        """
+        days = np.asarray(days)
+        ndiffs = np.asarray(ndiffs)
+        if self.lowerq == 0:
+            return np.zeros(ndiffs.shape, dtype=bool)
+        qmax = np.searchsorted(self.array_upper, days, side='right')
+        qmin = np.searchsorted(self.array_lower, days, side='right')
+        return (ndiffs > qmax) | (ndiffs <= qmin)
+
 
 def filter_outliers(
         iterable,
         origin='2019-12-01',
         rate=0.0655,
         cutoff=0.005,
-        maxtime=1e3):
+        maxtime=1e3,
+        batchsize=1000):
     """
     Exclude genomes that contain an excessive number of genetic differences
     from the reference, assuming that the mean number of differences increases
@@ -222,18 +414,21 @@ def filter_outliers(
     :param cutoff:  float, use 1-cutoff to compute quantile of Poisson
                     distribution, defaults to 0.005
     :param maxtime:  int, maximum number of days to cache Poisson quantiles
+    :param batchsize:  int, number of genomes to classify at once
     :yield:  tuples from generator that pass filter
     """
     poisson_product = QPois(quantile=1 - cutoff, rate=rate, maxtime=maxtime, origin=origin)
-    for qname, diffs, missing in iterable:
-        coldate = qname.split('|')[-1]
-        if coldate.count('-') != 2:
-            continue
-        ndiffs = len(diffs)
-        if poisson_product.is_outlier(coldate, ndiffs):
-            # reject genome with too many differences given date
-            continue
-        yield qname, diffs, missing
+    iterable = iter(iterable)
+    while True:
+        rows = list(islice(iterable, batchsize))
+        if not rows:
+            break
+        # skip genomes with incomplete sample collection dates
+        batch = [row for row in rows if row[0].split('|')[-1].count('-') == 2]
+        days = [poisson_product.days(qname.split('|')[-1]) for qname, _, _ in batch]
+        outliers = poisson_product.is_outlier_array(days, [len(diffs) for _, diffs, _ in batch])
+        # reject genomes with too many differences given date
+        yield from (row for row, outlier in zip(batch, outliers.tolist()) if not outlier)
 
 
 def load_vcf(
@@ -263,6 +458,73 @@ def load_vcf(
     return mask
 
 
+class ProblematicMask:
+    """
+    Problematic sites from load_vcf(), compiled into a bitmap of masked
+    substitutions indexed by reference position, with one bit per
+    nucleotide.  Used by filter_problematic() to drop masked substitutions
+    and features with uncalled bases, without a dict lookup per mutation.
+    """
+
+    codes = {'A': 1, 'C': 2, 'G': 4, 'T': 8}
+
+    def __init__(self, mask):
+        """
+        :param mask:  dict, returned by load_vcf()
+        """
+        self.mask = mask
+        self.bits = bytearray(max(mask, default=-1) + 1)
+        for pos, site in mask.items():
+            for nucleotide in site['alt']:
+                self.bits[pos] |= self.codes.get(nucleotide, 0)
+
+    @classmethod
+    def from_vcf(cls, vcf_file):
+        """ :param vcf_file:  str, path to VCF file """
+        return cls(load_vcf(vcf_file))
+
+    def _masked(self, pos, alt):
+        """ Substitution against mask for alleles other than single nucleotides """
+        site = self.mask.get(int(pos), None)
+        return site is not None and alt in site['alt']
+
+    def filter_diffs(self, diffs):
+        """
+        Exclude substitutions at problematic sites, and substitutions and
+        insertions with uncalled bases.
+
+        :param diffs:  list, (type, position, alt) tuples of a genome
+        :return:  list, retained features as tuples
+        """
+        bits, codes, size = self.bits, self.codes, len(self.bits)
+        result = []
+        for diff in diffs:
+            typ, pos, alt = diff
+            if typ == '~':
+                code = codes.get(alt, None)
+                if code is None:
+                    if 'N' in alt or self._masked(pos, alt):
+                        continue
+                elif pos < size and bits[pos] & code:
+                    continue
+            elif typ != '-' and 'N' in alt:
+                continue
+            result.append(tuple(diff))
+        return result
+
+    def filter_batch(self, batch):
+        """
+        Apply filter_diffs() to a batch of genomes
+
+        :param batch:  list, diffs of each genome
+        :return:  list, int; filtered diffs of each genome, and total number
+                  of features excluded
+        """
+        filtered = [self.filter_diffs(diffs) for diffs in batch]
+        nsites = sum(map(len, batch)) - sum(map(len, filtered))
+        return filtered, nsites
+
+
 class SC2Locator:
     """SC2locator docstring"""
     def __init__(
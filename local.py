@@ -12,8 +12,11 @@ import requests
 from Bio import Phylo
 
 import covizu
-from covizu.utils import seq_utils, gisaid_utils
+from covizu import minimap2
+from covizu.utils import seq_utils, gisaid_utils, pipeline_utils
 from covizu.utils.progress_utils import Callback
+from covizu.utils.db_utils import FeatureStore
+from covizu.utils.lineage_utils import dump_json
 from covizu.utils.batch_utils import (unpack_records, build_timetree, parse_alias,
                                       make_beadplots, get_mutations)
 from covizu.utils.seq_utils import SC2Locator
@@ -72,6 +75,26 @@ def parse_args():
         type=int,
         default=500,
         help='number of records to batch process with minimap2')
+    parser.add_argument(
+        '--sort-budget',
+        type=int,
+        default=0,
+        help='memory budget (MB) for records sorted by lineage, above which '
+             'lineages are spilled to disk under --outdir (default 0, keep all '
+             'records in memory)')
+    parser.add_argument(
+        '--dedup',
+        action='store_true',
+        help='align each distinct genome sequence only once, copying '
+             'features to records with identical sequences.  Duplicates within '
+             'a batch are output after their first copy, so records are not in '
+             'input order')
+    parser.add_argument(
+        '--dedup-size',
+        type=int,
+        default=100000,
+        help='maximum number of aligned sequences kept for --dedup, '
+             'least recently seen are forgotten first (default 100000)')
     parser.add_argument(
         '--max-variants',
         type=int,
@@ -87,8 +110,35 @@ def parse_args():
         help="path to FASTA file with reference genome")
     parser.add_argument('--mmbin', type=str, default='minimap2',
                         help="path to minimap2 binary executable")
+    parser.add_argument('--feature-store', type=str, default=None,
+                        help="path to SQLite file to store and retrieve features "
+                             "for previously aligned sequences")
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help="path to write checkpoints of feature extraction; "
+                             "defaults to <outdir>/checkpoint.pickle with --resume")
+    parser.add_argument('--checkpoint-interval', type=int, default=10,
+                        help="number of minimap2 batches between checkpoints "
+                             "(default 10)")
+    parser.add_argument('--resume', action='store_true',
+                        help="resume feature extraction from last checkpoint of "
+                             "an interrupted run on the same input file")
     parser.add_argument('-mmt', "--mmthreads", type=int, default=8,
                         help="number of threads for minimap2.")
+    parser.add_argument('--mmworkers', type=int, default=1,
+                        help="number of worker threads aligning batches "
+                             "in-process with a shared minimap2 index (requires "
+                             "mappy); if 1 (default), --mmbin is run for each batch")
+    parser.add_argument('--fast-diffs', action='store_true',
+                        help="call differences of genomes near-identical to the "
+                             "reference directly, aligning only the remaining "
+                             "genomes with minimap2")
+    parser.add_argument('--fused-filter', action='store_true',
+                        help="exclude problematic sites, and genomes with excess "
+                             "divergence or missing sites, while decoding minimap2 "
+                             "output; saved features exclude problematic sites")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="run decoding, alignment and filtering of genomes "
+                             "concurrently in separate threads")
 
     parser.add_argument('--misstol', type=int, default=300,
                         help="maximum tolerated number of missing bases per "
@@ -127,9 +177,21 @@ def parse_args():
 
     parser.add_argument('--binpath', type=str, default='rapidnj',
                         help='path to RapidNJ binary executable')
+    parser.add_argument('--nj-backend', type=str, default='rapidnj',
+                        choices=['rapidnj', 'builtin'],
+                        help='reconstruct bootstrap trees with RapidNJ, or with '
+                             'built-in neighbor-joining without a subprocess')
+    parser.add_argument('--nj-stream', action='store_true',
+                        help='stream distance matrices to RapidNJ through a pipe '
+                             'instead of temporary files, if RapidNJ can read them '
+                             'from /dev/stdin')
+    parser.add_argument('--nj-workers', type=int, default=1,
+                        help='if >1, number of local processes to reconstruct '
+                             'bootstrap trees, in place of MPI')
     parser.add_argument('--mincount', type=int, default=500,
                         help='minimum number of variants in lineage '
-                             'above which MPI processing will be used.')
+                             'above which its replicates are split across local '
+                             'workers (--nj-workers); MPI jobs schedule by cost.')
     parser.add_argument('--machine_file', type=str, default='mfile',
                         help='path to machine file for MPI.')
     parser.add_argument("-n", "--nboot", type=int, default=100,
@@ -159,8 +221,17 @@ def stream_local(
         lineage_file,
         local_regions,
         mindata,
-        callback=None):
-    """ Convert local FASTA file to feed-like object - replaces load_gisaid() """
+        callback=None,
+        start=0,
+        progress=None):
+    """
+    Convert local FASTA file to feed-like object - replaces load_gisaid()
+
+    :param start:  int, index of first FASTA record to process, e.g., to
+                   resume from a checkpoint
+    :param progress:  dict, optional; 'offset' is set to the index of the
+                      FASTA record following each yielded record
+    """
     if not mindata:
         mindate = '2019-12-01'
         minlen = 29000
@@ -183,7 +254,9 @@ def stream_local(
 
     with open(path, 'r', encoding='utf-8') as local_handle:
         rejects = {'short': 0, 'baddate': 0, 'nonhuman': 0}
-        for header, seq in seq_utils.iter_fasta(local_handle):
+        for index, (header, seq) in enumerate(seq_utils.iter_fasta(local_handle)):
+            if index < start:
+                continue
             if len(seq) < minlen:
                 rejects['short'] += 1
                 continue  # sequence is too short
@@ -215,6 +288,8 @@ def stream_local(
                 'covv_collection_date': coldate,
                 'covv_lineage': local_lineage,
                 'covv_location': country if region is None else f"{region} / {country}"}
+            if progress is not None:
+                progress['offset'] = index + 1
             yield record
 
         if callback:
@@ -224,26 +299,80 @@ def stream_local(
 
 def process_local(local_args, local_regions, callback=None):
     """ Analyze genome sequences from local FASTA file """
+    store = None
+    if local_args.feature_store:
+        store = FeatureStore(local_args.feature_store)
+
+    ckpt_file, state = gisaid_utils.open_checkpoint(local_args, callback=callback)
+    progress = {'offset': state['offset']}
+    dedup = gisaid_utils.SequenceDedup(
+        maxsize=local_args.dedup_size) if local_args.dedup else None
     loader = stream_local(
         local_args.infile,
         local_args.pangolineages,
         local_regions,
         (local_args.minlen,
         local_args.mindate),
-        callback=callback)
-    batcher = gisaid_utils.batch_fasta(loader, size=local_args.batchsize)
+        callback=callback,
+        start=state['offset'],
+        progress=progress)
+    batcher = gisaid_utils.batch_fasta(
+        loader, size=local_args.batchsize, store=store, dedup=dedup)
+    checkpoint = None
+    if ckpt_file:
+        checkpoint = gisaid_utils.Checkpointer(
+            progress, state, ckpt_file,
+            interval=local_args.checkpoint_interval, callback=callback)
+        batcher = checkpoint.track(batcher)
+    stages = []
+    if local_args.pipeline:
+        batcher = pipeline_utils.Stage('decode', batcher, maxsize=2)
+        stages.append(batcher)
+    pool = None
+    if local_args.mmworkers > 1:
+        pool = minimap2.Minimap2Pool(
+            local_args.ref, nthread=local_args.mmthreads,
+            nworkers=local_args.mmworkers, minlen=local_args.minlen)
+    caller = minimap2.AnchoredCaller(local_args.ref) if local_args.fast_diffs else None
+    record_filter = gisaid_utils.RecordFilter(
+        vcf_file=local_args.vcf, cutoff=local_args.poisson_cutoff,
+        fused=local_args.fused_filter)
     aligned = gisaid_utils.extract_features(
         batcher,
         ref_file=local_args.ref,
         binpath=local_args.mmbin,
         nthread=local_args.mmthreads,
-        minlen=local_args.minlen)
-    filtered = gisaid_utils.filter_problematic(
-        aligned,
-        vcf_file=local_args.vcf,
-        cutoff=local_args.poisson_cutoff,
-        callback=callback)
-    return gisaid_utils.sort_by_lineage(filtered, callback=callback)
+        minlen=local_args.minlen,
+        store=store,
+        dedup=dedup,
+        pool=pool,
+        checkpoint=checkpoint,
+        caller=caller,
+        record_filter=record_filter)
+    if stages:
+        aligned = pipeline_utils.Stage('align', aligned, maxsize=1000)
+        stages.append(aligned)
+    by_lineage = gisaid_utils.sort_by_lineage(
+        aligned, callback=callback, result=state['by_lineage'])
+    if callback:
+        record_filter.report(callback)
+    if stages and callback:
+        for stage in stages:
+            callback(stage.report())
+    if pool:
+        pool.close()
+        if callback:
+            callback(pool.summary())
+    if caller and callback:
+        callback(caller.summary())
+    if dedup and callback:
+        callback(f"Skipped alignment of {dedup.ndups} of {dedup.nrecords} genomes "
+                 f"with duplicate sequences ({dedup.ratio():.1%})")
+    if store:
+        store.close()
+    if ckpt_file and os.path.exists(ckpt_file):
+        os.remove(ckpt_file)  # run completed
+    return by_lineage
 
 
 if __name__ == "__main__":
@@ -295,7 +424,7 @@ if __name__ == "__main__":
     by_lineage = process_local(args, regions, cb.callback)
     with open(args.bylineage, 'w', encoding='utf-8') as handle:
         # export to file to process large lineages with MPI
-        json.dump(by_lineage, handle)
+        dump_json(by_lineage, handle)
 
     # reconstruct time-scaled tree
     timetree, residuals = build_timetree(by_lineage, args, cb.callback)
@@ -354,4 +483,6 @@ if __name__ == "__main__":
             }
         json.dump(val, handle)
 
+    if hasattr(by_lineage, 'close'):
+        by_lineage.close()  # remove lineages spilled to disk
     cb.callback("All done!")
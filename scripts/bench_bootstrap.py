@@ -0,0 +1,153 @@
+"""
+Benchmark of distance matrix calculation in covizu.clustering.bootstrap().
+Reports the time and throughput (MB/s) to write the PHYLIP matrix of one
+replicate, and the time to compute distances alone.  Compares the sparse
+incidence matrix engine and bulk formatter (write_distances) with the
+previous double loop over symmetric differences of feature sets, on
+synthetic variants descended from one another.  With --binpath, also times
+a RapidNJ replicate with the matrix streamed through a pipe, and written to
+a temporary file.  With --builtin, times in-process neighbor-joining of a
+replicate from the same matrix.  The previous loop is only
+run up to --legacy-max variants; above that, its time is extrapolated from
+the largest measured size, as it scales with the square of the number of
+variants.
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from covizu.clustering import distance_blocks, incidence_matrix, rapidnj, write_distances
+from covizu.utils.nj_utils import neighbor_joining
+
+
+def simulate(nvariants, seed=1):
+    """
+    Simulate feature vectors of variants, each derived from a random earlier
+    variant with 1-3 new features and occasional reversions.
+
+    :param nvariants:  int, number of variants
+    :return:  list, sets of feature indices; int, size of feature union
+    """
+    random.seed(seed)
+    indexed = [set(range(20))]  # features of lineage root
+    nfeat = 20
+    for _ in range(nvariants - 1):
+        fvec = set(random.choice(indexed))
+        if fvec and random.random() < 0.1:
+            fvec.discard(random.choice(list(fvec)))
+        for _ in range(random.randint(1, 3)):
+            fvec.add(nfeat)
+            nfeat += 1
+        indexed.append(fvec)
+    return indexed, nfeat
+
+
+class Sink:
+    """ Discards written data, counting bytes """
+    def __init__(self):
+        self.nbytes = 0
+
+    def write(self, data):
+        self.nbytes += len(data)
+        return len(data)
+
+
+def legacy_weights(nfeat):
+    """ Previous sampling of feature weights """
+    sample = [int(nfeat * random.random()) for _ in range(nfeat)]
+    return {y: sample.count(y) for y in sample}
+
+
+def legacy_distances(handle, idxed, weights):
+    """ Previous double loop of bootstrap() """
+    num_vec = len(idxed)
+    handle.write(f'{num_vec:>5}\n')
+    for i in range(num_vec):
+        handle.write(f'{i}')
+        for j in range(num_vec):
+            if i == j:
+                handle.write(f' {0:>2}')
+            else:
+                sym_diff = idxed[i] ^ idxed[j]  # symmetric difference
+                difference = sum(weights.get(y, 0) for y in sym_diff)
+                handle.write(f' {difference:>2}')
+        handle.write('\n')
+
+
+def parse_args():
+    """ Command-line interface """
+    parser = argparse.ArgumentParser(
+        description="Benchmark distance matrix calculation of bootstrap()")
+    parser.add_argument('-n', '--nvariants', type=int, nargs='+',
+                        default=[1000, 5000, 10000],
+                        help="numbers of variants to benchmark")
+    parser.add_argument('--legacy-max', type=int, default=1000,
+                        help="largest number of variants to run previous loop")
+    parser.add_argument('--binpath', type=str, default=None,
+                        help="path to RapidNJ binary executable, to time replicates")
+    parser.add_argument('--builtin', action='store_true',
+                        help="time replicates with in-process neighbor-joining")
+    return parser.parse_args()
+
+
+def rate(nbytes, seconds):
+    """ :return:  str, throughput in MB/s """
+    return f"{nbytes / seconds / 1e6:.1f} MB/s"
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    legacy = None  # (number of variants, seconds) of largest legacy run
+    for nvariants in args.nvariants:
+        indexed, nfeat = simulate(nvariants)
+
+        start = time.perf_counter()
+        weights = np.bincount([int(nfeat * random.random()) for _ in range(nfeat)],
+                              minlength=nfeat)
+        t_weights = time.perf_counter() - start
+        sink = Sink()
+        start = time.perf_counter()
+        write_distances(sink, indexed, weights)
+        t_new = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in distance_blocks(incidence_matrix(indexed, nfeat), weights):
+            pass
+        t_dist = time.perf_counter() - start  # excluding output formatting
+        print(f"{nvariants:>6} variants, {nfeat} features, {sink.nbytes / 1e6:.1f} MB matrix")
+
+        if nvariants <= args.legacy_max:
+            start = time.perf_counter()
+            old_weights = legacy_weights(nfeat)
+            t_old_weights = time.perf_counter() - start
+            old_sink = Sink()
+            start = time.perf_counter()
+            legacy_distances(old_sink, indexed, old_weights)
+            t_old = time.perf_counter() - start
+            legacy = (nvariants, t_old)
+            print(f"  previous loop: {t_old:8.2f} s, {rate(old_sink.nbytes, t_old)}, "
+                  f"weights {t_old_weights * 1e3:.1f} ms")
+        elif legacy:
+            t_old = legacy[1] * (nvariants / legacy[0]) ** 2
+            print(f"  previous loop: {t_old:8.2f} s (est.), {rate(sink.nbytes, t_old)}")
+
+        print(f"  sparse engine: {t_new:8.2f} s, {rate(sink.nbytes, t_new)}, "
+              f"distances alone {t_dist:.2f} s, weights {t_weights * 1e3:.1f} ms")
+
+        if args.binpath:
+            for label, stream in [('pipe', True), ('file', False)]:
+                start = time.perf_counter()
+                rapidnj(indexed, weights, binpath=args.binpath, stream=stream)
+                elapsed = time.perf_counter() - start
+                print(f"  RapidNJ {label}: {elapsed:8.2f} s per replicate, "
+                      f"{rate(sink.nbytes, elapsed)}")
+
+        if args.builtin:
+            start = time.perf_counter()
+            dists = np.empty((nvariants, nvariants), dtype=np.float32)
+            for first, block in distance_blocks(incidence_matrix(indexed, nfeat), weights):
+                dists[first:(first + len(block))] = block
+            neighbor_joining(dists)
+            elapsed = time.perf_counter() - start
+            print(f"  built-in NJ: {elapsed:8.2f} s per replicate")
@@ -0,0 +1,172 @@
+"""
+Micro-benchmark of CIGAR decoding in covizu.minimap2.  Compares the shared
+CIGAR engine (align_cigar, cigar_diffs) with the previous per-function CIGAR
+walks, and the fused encode-and-filter (cigar_filtered) with cigar_diffs
+followed by problematic site and missing data filters, on synthetic
+alignments of 30 kb genomes.
+"""
+import argparse
+import random
+import re
+import time
+
+from covizu.minimap2 import align_cigar, cigar_diffs, cigar_filtered
+from covizu.utils.seq_utils import ProblematicMask, total_missing
+
+
+def legacy_align(sequence, rpos, cigar, reflen):
+    """ Previous stream_fasta() CIGAR walk, with string concatenation """
+    if not re.match(r'^((\d+)([MIDNSHPX=]))*$', cigar):
+        raise RuntimeError(f'Invalid CIGAR string: {cigar!r}.')
+    tokens = re.findall(r'  (\d+)([MIDNSHPX=])', cigar, re.VERBOSE)
+    aligned = '-' * rpos
+    left = 0
+    for length, operation in tokens:
+        length = int(length)
+        if operation in 'M=X':
+            aligned += sequence[left:(left + length)]
+            left += length
+        elif operation == 'D':
+            aligned += '-' * length
+        elif operation in 'SI':
+            left += length  # soft clip
+    aligned += '-' * (reflen - len(aligned))
+    return aligned
+
+
+def legacy_diffs(sequence, rpos, cigar, reflen, alphabet='ACGT'):
+    """ Previous encode_diffs() CIGAR walk """
+    if not re.match(r'^((\d+)([MIDNSHPX=]))*$', cigar):
+        raise RuntimeError(f'Invalid CIGAR string: {cigar!r}.')
+    differences = []
+    missing_data = []
+    pos = [0, rpos]
+    if pos[1] > 0:
+        missing_data.append(tuple([0, pos[1]]))
+    for length, operator in re.findall(r'  (\d+)([MIDNSHPX=])', cigar, re.VERBOSE):
+        length = int(length)
+        substr = sequence[pos[0]:(pos[0] + length)]
+        if operator == 'X':
+            if 'N' in substr:
+                missing_data.append(tuple([pos[1], pos[1] + length]))
+            else:
+                for i, nucleotide in enumerate(substr):
+                    if nucleotide in alphabet:
+                        differences.append(tuple(['~', pos[1] + i, nucleotide]))
+                    else:
+                        missing_data.append(tuple([pos[1] + i, pos[1] + i + 1]))
+            pos[0] += length
+            pos[1] += length
+        elif operator == 'S':
+            pos[0] += length
+        elif operator == 'I':
+            differences.append(tuple(['+', pos[1], substr]))
+            pos[0] += length
+        elif operator == 'D':
+            differences.append(tuple(['-', pos[1], length]))
+            pos[1] += length
+        elif operator == '=':
+            pos[0] += length
+            pos[1] += length
+    if pos[1] < reflen:
+        missing_data.append(tuple([pos[1], reflen]))
+    return differences, missing_data
+
+
+def separate_filter(sequence, rpos, cigar, reflen, mask):
+    """ cigar_diffs() followed by the filters of filter_problematic() """
+    diffs, missing = cigar_diffs(sequence, rpos, cigar, reflen)
+    filtered = mask.filter_diffs(diffs)
+    return filtered, missing, len(diffs) - len(filtered), total_missing(('', diffs, missing))
+
+
+def make_alignments(nrecords, reflen=29903, nops=100, seed=1):
+    """
+    Generate synthetic query sequences and CIGARs with <nops> mismatches,
+    indels and N-runs per genome.
+    """
+    random.seed(seed)
+    records = []
+    for _ in range(nrecords):
+        rpos = random.randint(0, 50)
+        cigar, seq, pos = [], [], rpos
+        while pos < reflen - 200:
+            run = random.randint(1, 2 * (reflen - rpos) // nops)
+            run = min(run, reflen - 200 - pos)
+            cigar.append(f'{run}=')
+            seq.append(''.join(random.choice('ACGT') for _ in range(run)))
+            pos += run
+            kind = random.random()
+            if kind < 0.7:
+                cigar.append('1X')
+                seq.append(random.choice('ACGT'))
+                pos += 1
+            elif kind < 0.8:
+                cigar.append('3D')
+                pos += 3
+            elif kind < 0.9:
+                cigar.append('6I')
+                seq.append('ACGTAC')
+            else:
+                cigar.append('20X')
+                seq.append('N' * 20)
+                pos += 20
+        records.append((''.join(seq), rpos, ''.join(cigar)))
+    return records
+
+
+def bench(func, records, reflen, reps):
+    """ :return:  float, fastest time over <reps> trials """
+    best = None
+    for _ in range(reps):
+        start = time.perf_counter()
+        for sequence, rpos, cigar in records:
+            func(sequence, rpos, cigar, reflen)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def parse_args():
+    """ Command-line interface """
+    parser = argparse.ArgumentParser(description="Benchmark CIGAR decoding")
+    parser.add_argument('-n', '--nrecords', type=int, default=500,
+                        help="number of synthetic alignments per trial")
+    parser.add_argument('--nops', type=int, default=100,
+                        help="approximate number of mutations per genome")
+    parser.add_argument('--reps', type=int, default=5,
+                        help="number of trials per function, reports the fastest")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    reflen = 29903
+    records = make_alignments(args.nrecords, reflen=reflen, nops=args.nops)
+    for sequence, rpos, cigar in records:
+        assert align_cigar(sequence, rpos, cigar, reflen) == \
+            legacy_align(sequence, rpos, cigar, reflen)
+        assert cigar_diffs(sequence, rpos, cigar, reflen) == \
+            legacy_diffs(sequence, rpos, cigar, reflen)
+
+    # mask about 1 in 50 sites, as in problematic_sites_sarsCov2.vcf
+    mask = ProblematicMask({pos: {'ref': 'N', 'alt': 'A,C,G,T', 'info': ''}
+                            for pos in range(0, reflen, 50)})
+    for sequence, rpos, cigar in records:
+        assert cigar_filtered(sequence, rpos, cigar, reflen, mask) == \
+            separate_filter(sequence, rpos, cigar, reflen, mask)
+
+    def fused(sequence, rpos, cigar, reflen):
+        return cigar_filtered(sequence, rpos, cigar, reflen, mask)
+
+    def separate(sequence, rpos, cigar, reflen):
+        return separate_filter(sequence, rpos, cigar, reflen, mask)
+
+    for label, new, old in [('aligned', align_cigar, legacy_align),
+                            ('diffs', cigar_diffs, legacy_diffs),
+                            ('filtered', fused, separate)]:
+        t_new = bench(new, records, reflen, args.reps)
+        t_old = bench(old, records, reflen, args.reps)
+        print(f"{label:>8}: {t_old / len(records) * 1e6:7.1f} us -> "
+              f"{t_new / len(records) * 1e6:7.1f} us per genome "
+              f"({t_old / t_new:.1f}x)")
@@ -0,0 +1,65 @@
+"""
+Micro-benchmark of provision record parsers in covizu.utils.gisaid_utils.
+Reports the cost of parsing one million provision lines, extrapolated from
+a synthetic sample of GISAID-like records.
+"""
+import argparse
+import json
+import random
+import time
+
+from covizu.utils.gisaid_utils import PARSERS, orjson
+
+
+FIELDS = ("covv_accession_id", "covv_virus_name", "covv_lineage",
+          "covv_collection_date", "covv_location", "sequence")
+
+
+def make_lines(nrecords, seqlen=29903, metalen=2000, seed=1):
+    """ Generate synthetic provision lines with large unused metadata fields """
+    random.seed(seed)
+    lines = []
+    for i in range(nrecords):
+        seq = ''.join(random.choice('ACGT') for _ in range(seqlen))
+        record = {
+            'covv_accession_id': f'EPI_ISL_{i}',
+            'covv_virus_name': f'hCoV-19/Canada/Qc-{i}/2020',
+            'covv_lineage': 'B.1.1.7',
+            'covv_collection_date': '2021-01-18',
+            'covv_location': 'North America / Canada / Quebec',
+            'covv_subm_lab': 'x' * metalen,
+            'covv_comment': {'notes': ['y' * (metalen // 10)] * 10},
+            'sequence': '\n'.join(seq[j:j + 60] for j in range(0, seqlen, 60))
+        }
+        lines.append(json.dumps(record).encode('utf-8'))
+    return lines
+
+
+def parse_args():
+    """ Command-line interface """
+    parser = argparse.ArgumentParser(description="Benchmark provision record parsers")
+    parser.add_argument('-n', '--nrecords', type=int, default=200,
+                        help="number of synthetic records to parse per trial")
+    parser.add_argument('--reps', type=int, default=5,
+                        help="number of trials per parser, reports the fastest")
+    parser.add_argument('--metalen', type=int, default=2000,
+                        help="size of unused metadata per record (characters)")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    lines = make_lines(args.nrecords, metalen=args.metalen)
+    for name, parse in PARSERS.items():
+        if name == 'orjson' and orjson is None:
+            print(f"{name:>8}: not installed")
+            continue
+        best = None
+        for _ in range(args.reps):
+            start = time.perf_counter()
+            for line in lines:
+                parse(line, FIELDS)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        per_million = best / len(lines) * 1e6
+        print(f"{name:>8}: {per_million:8.1f} s per million records")
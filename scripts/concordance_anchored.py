@@ -0,0 +1,130 @@
+"""
+Concordance of covizu.minimap2.AnchoredCaller with encode_diffs() on
+minimap2 output.  Genomes are read from a FASTA file, or simulated from the
+reference with substitutions, ambiguous bases, runs of N, indels and
+incomplete ends.  Reports the fraction of genomes called without minimap2,
+the number of called genomes whose diffs or missing intervals differ from
+minimap2, and the time taken by each method.
+"""
+import argparse
+import random
+import time
+
+from covizu.minimap2 import (AnchoredCaller, Minimap2Pool, minimap2, encode_diffs,
+                             mappy)
+from covizu.utils.seq_utils import convert_fasta
+
+
+def simulate(refseq, nrecords, seed=1):
+    """
+    Simulate genomes descended from the reference
+
+    :param refseq:  str, reference genome
+    :param nrecords:  int, number of genomes
+    :return:  list, (header, sequence) tuples
+    """
+    random.seed(seed)
+    records = []
+    for i in range(nrecords):
+        seq = list(refseq)
+        for _ in range(random.randint(0, 60)):
+            pos = random.randrange(len(seq))
+            seq[pos] = random.choice('ACGT')
+        for _ in range(random.choice([0, 0, 1, 2, 5])):
+            pos = random.randrange(len(seq))
+            seq[pos] = random.choice('RYKMSWN')
+        for _ in range(random.choice([0, 1, 3, 6])):
+            pos = random.randrange(len(seq))
+            length = random.choice([1, 5, 20, 100, 250, 400, 1000])
+            seq[pos:(pos + length)] = ['N'] * len(seq[pos:(pos + length)])
+        # indels, applied from right to left to keep positions valid
+        for pos in sorted((random.randrange(100, len(seq) - 100)
+                           for _ in range(random.choice([0, 0, 1, 2, 3]))), reverse=True):
+            length = random.choice([1, 2, 3, 6, 9, 12, 30, 60])
+            if random.random() < 0.7:
+                del seq[pos:(pos + length)]
+            else:
+                seq[pos:pos] = random.choices('ACGT', k=length)
+        seq = ''.join(seq)
+        left, right = random.choice([0, 0, 20, 54]), random.choice([0, 0, 30, 70])
+        seq = seq[left:(len(seq) - right)]
+        if random.random() < 0.2:
+            seq = 'N' * random.randint(1, 100) + seq
+        if random.random() < 0.1:
+            seq += 'A' * random.randint(1, 40)
+        records.append((f'sim{i}', seq))
+    return records
+
+
+def parse_args():
+    """ Command-line interface """
+    parser = argparse.ArgumentParser(
+        description="Concordance of anchored diff caller with minimap2")
+    parser.add_argument('--fasta', type=argparse.FileType('r'), default=None,
+                        help="FASTA file of genomes; otherwise simulated")
+    parser.add_argument('-n', '--nrecords', type=int, default=500,
+                        help="number of genomes to simulate")
+    parser.add_argument('--seed', type=int, default=1,
+                        help="random seed for simulation")
+    parser.add_argument('--ref', type=str, default='covizu/data/NC_045512.fa',
+                        help="path to FASTA file with reference genome")
+    parser.add_argument('--mmbin', type=str, default=None,
+                        help="path to minimap2 binary executable; defaults to "
+                             "aligning in-process with mappy")
+    parser.add_argument('--minlen', type=int, default=29000,
+                        help="minimum genome length")
+    parser.add_argument('--show', type=int, default=5,
+                        help="number of discordant genomes to print")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with open(args.ref, encoding='utf-8') as handle:
+        refseq = convert_fasta(handle)[0][1]
+    if args.fasta:
+        records = convert_fasta(args.fasta)
+    else:
+        records = simulate(refseq, args.nrecords, seed=args.seed)
+    records = [(h.split()[0], s) for h, s in records if len(s) >= args.minlen]
+    fasta = ''.join(f'>{h}\n{s}\n' for h, s in records)
+
+    start = time.perf_counter()
+    if args.mmbin:
+        mm2 = list(minimap2(fasta, args.ref, stream=True, path=args.mmbin,
+                            minlen=args.minlen))
+    elif mappy is not None:
+        with Minimap2Pool(args.ref, nworkers=1, minlen=args.minlen) as pool:
+            mm2 = pool.align(fasta)
+    else:
+        raise SystemExit("requires --mmbin or mappy")
+    expected = {qname: (diffs, missing) for qname, diffs, missing in
+                encode_diffs(mm2, reflen=len(refseq))}
+    t_minimap2 = time.perf_counter() - start
+
+    caller = AnchoredCaller(args.ref)
+    start = time.perf_counter()
+    called = {h: caller.call(s) for h, s in records}
+    t_called = time.perf_counter() - start
+
+    ncalled = ndiscordant = nunmapped = 0
+    for qname, result in called.items():
+        if result is None:
+            continue
+        ncalled += 1
+        if qname not in expected:
+            nunmapped += 1
+        elif result != expected[qname]:
+            ndiscordant += 1
+            if ndiscordant <= args.show:
+                exp_diffs, exp_missing = expected[qname]
+                print(f"{qname}:\n  minimap2 {exp_diffs} {exp_missing}\n"
+                      f"  anchored {result[0]} {result[1]}")
+
+    total = len(records)
+    print(f"genomes: {total}, called without minimap2: {ncalled} "
+          f"({ncalled / total:.1%})")
+    print(f"concordant: {ncalled - ndiscordant - nunmapped}, discordant: {ndiscordant}, "
+          f"unmapped by minimap2: {nunmapped}")
+    print(f"minimap2: {t_minimap2 / total * 1e3:.2f} ms per genome; "
+          f"anchored caller: {t_called / total * 1e3:.2f} ms per genome")
@@ -0,0 +1,69 @@
+"""
+Simulated makespan of bootstrap tree reconstruction across MPI ranks.
+Compares the previous static schedule, with minor lineages assigned to
+ranks by li % nprocs and each major lineage run as its own job, to the
+dynamic work units of clustering.TreeScheduler.  Replicate cost is taken
+as variants^2, with lineage sizes drawn from a heavy-tailed distribution.
+The start-up of each mpirun and loading of recoded.json are not included,
+and the head rank of the scheduler does not reconstruct trees.
+"""
+import argparse
+import heapq
+import random
+
+from covizu.clustering import schedule_units
+
+
+def static_makespan(sizes, nboot, nprocs, mincount):
+    """ :return:  float, makespan of previous flat + per-lineage deep jobs """
+    minor = sorted((n for n in sizes if n < mincount), reverse=True)
+    loads = [0.] * nprocs
+    for li, nvar in enumerate(minor):
+        loads[li % nprocs] += nvar ** 2 * nboot
+    makespan = max(loads)
+    for nvar in sizes:
+        if nvar >= mincount:
+            # deep mode: replicates round-robin over ranks, one job per lineage
+            makespan += -(-nboot // nprocs) * nvar ** 2
+    return makespan
+
+
+def dynamic_makespan(units, nworkers):
+    """ :return:  float, makespan of units handed to idle workers in order """
+    idle = [0.] * nworkers
+    for cost, _, _, _ in units:
+        heapq.heappush(idle, heapq.heappop(idle) + cost)
+    return max(idle)
+
+
+def parse_args():
+    """ Command-line interface """
+    parser = argparse.ArgumentParser(description="Simulate MPI tree scheduling")
+    parser.add_argument('--nlineages', type=int, default=2000,
+                        help="number of lineages")
+    parser.add_argument('--nprocs', type=int, nargs='+', default=[8, 32, 64],
+                        help="numbers of MPI ranks")
+    parser.add_argument('--nboot', type=int, default=100,
+                        help="number of bootstrap replicates per lineage")
+    parser.add_argument('--mincount', type=int, default=500,
+                        help="number of variants above which lineages run in deep mode")
+    parser.add_argument('--seed', type=int, default=1,
+                        help="random seed")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    random.seed(args.seed)
+    sizes = [min(10000, max(2, int(random.paretovariate(1.1) * 5)))
+             for _ in range(args.nlineages)]
+    recoded = {str(i): {'indexed': [None] * n} for i, n in enumerate(sizes)}
+    total = sum(n ** 2 for n in sizes) * args.nboot
+    for nprocs in args.nprocs:
+        static = static_makespan(sizes, args.nboot, nprocs, args.mincount)
+        units = schedule_units(recoded, list(recoded), args.nboot, nprocs - 1)
+        dynamic = dynamic_makespan(units, nprocs - 1)
+        print(f"{nprocs:>3} ranks: static {static / total:.3f}, "
+              f"dynamic {dynamic / total:.3f} of serial time "
+              f"({static / dynamic:.1f}x, {len(units)} units, "
+              f"{total / (dynamic * (nprocs - 1)):.0%} worker utilisation)")
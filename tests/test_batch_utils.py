@@ -1,6 +1,7 @@
 import unittest
 from argparse import Namespace
 from covizu.utils.batch_utils import beadplot_serial, get_mutations
+from covizu.utils.mutation_utils import pack_key
 
 # Build TimeTree - Tests in test_timetree.py
 
@@ -21,8 +22,9 @@ class TestBeadplotSerial(unittest.TestCase):
 
         lineage = 'B.1.1.171'
         features = {
-            ('~|240|T,~|1436|T,~|3036|T,~|3713|T,~|5883|T,~|14407|T,'
-             '~|20543|T,~|23402|G,~|28880|A,~|28881|A,~|28882|C'): [
+            pack_key([('~', 240, 'T'), ('~', 1436, 'T'), ('~', 3036, 'T'), ('~', 3713, 'T'),
+                      ('~', 5883, 'T'), ('~', 14407, 'T'), ('~', 20543, 'T'), ('~', 23402, 'G'),
+                      ('~', 28880, 'A'), ('~', 28881, 'A'), ('~', 28882, 'C')]): [
                 {
                     'covv_virus_name': 'hCoV-19/Canada/Qc-L00240569/2020',
                     'covv_accession_id': 'EPI_ISL_465679',
@@ -66,7 +68,7 @@ class TestGetMutations(unittest.TestCase):
     def test_get_mutations(self):
         by_lineage = \
             {'B.1.1.171':
-             {'~|240|T,~|1436|T':
+             {pack_key([('~', 240, 'T'), ('~', 1436, 'T')]):
               [{'covv_virus_name': '',
                   'covv_accession_id': '',
                   'covv_collection_date': '',
@@ -79,7 +81,7 @@ class TestGetMutations(unittest.TestCase):
                 }]
               },
              'B.1.265':
-             {'~|240|T,~|1436|T':
+             {pack_key([('~', 240, 'T'), ('~', 1436, 'T')]):
               [{'covv_virus_name': '',
                   'covv_accession_id': '',
                   'covv_collection_date': '',
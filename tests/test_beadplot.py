@@ -1,6 +1,7 @@
 import unittest
 from io import StringIO
 from covizu import beadplot
+from covizu.utils.sample_utils import SampleRegistry
 from Bio import Phylo
 
 
@@ -151,6 +152,23 @@ class TestIssues(unittest.TestCase):
         # this raised an exception
         tree = beadplot.annotate_tree(tree, labels)
 
+
+class TestSerializeTree(unittest.TestCase):
+    def test_registry(self):
+        labels = {'0': ['hCoV-19/USA/WI-UW-306/2020|USA|EPI_ISL_436600|2020-04-14',
+                        'hCoV-19/USA/WI-UW-278/2020|USA|EPI_ISL_436572|2020-04-03'],
+                  '1': ['hCoV-19/USA/WI-UW-310/2020|USA|EPI_ISL_436604|2020-04-15'],
+                  '2': ['hCoV-19/USA/WI-UW-314/2020|USA|EPI_ISL_436608|2020-04-16']}
+        registry = SampleRegistry()
+        ids = {k: [registry.add(*label.split('|')) for label in v]
+               for k, v in labels.items()}
+        nwk = "(0:1.0,(1:1.0,2:1.0)0.9:1.0):0.0;"
+        expected = beadplot.serialize_tree(
+            beadplot.annotate_tree(phylo_from_str(nwk), labels))
+        result = beadplot.serialize_tree(
+            beadplot.annotate_tree(phylo_from_str(nwk), ids), registry=registry)
+        self.assertEqual(expected, result)
+
 if __name__ == '__main__':
     unittest.main()
 
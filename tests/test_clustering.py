@@ -1,6 +1,17 @@
 import os
+import random
+import stat
+import sys
+import tempfile
 import unittest
+from argparse import Namespace
+from collections import deque
+from io import BytesIO, StringIO
+import numpy as np
 from covizu import clustering
+from covizu.utils.sample_utils import SampleRegistry
+from covizu.utils.mutation_utils import pack_key
+from covizu.utils.nj_utils import NJTree
 from Bio import Phylo as phy
 from Bio.Phylo.BaseTree import Clade
 
@@ -36,3 +47,234 @@ class Test_Consensus(unittest.TestCase):
         for ind, clade in enumerate(self.expected):
             self.assertEqual(clade.branch_length, out_tree[ind].branch_length)
             self.assertEqual(clade.confidence, out_tree[ind].confidence)
+
+
+class TestRecodeFeatures(unittest.TestCase):
+    def setUp(self):
+        self.records = {
+            pack_key([('~', 100, 'T')]): [
+                {'covv_virus_name': 'hCoV-19/Canada/Qc-1/2020', 'covv_location': 'Canada',
+                 'covv_accession_id': 'EPI_ISL_1', 'covv_collection_date': '2020-03-27'},
+                {'covv_virus_name': 'hCoV-19/Canada/Qc-2/2020', 'covv_location': 'Canada',
+                 'covv_accession_id': 'EPI_ISL_2', 'covv_collection_date': '2020-04-02'}],
+            pack_key([('~', 100, 'T'), ('-', 28, 1)]): [
+                {'covv_virus_name': 'hCoV-19/USA/WI-3/2020', 'covv_location': 'USA',
+                 'covv_accession_id': 'EPI_ISL_3', 'covv_collection_date': '2020-03-30'}]
+        }
+
+    def test_registry(self):
+        registry = SampleRegistry()
+        union, labels, indexed = clustering.recode_features(self.records)
+        union2, ids, indexed2 = clustering.recode_features(self.records, registry=registry)
+        self.assertEqual(union, union2)
+        self.assertEqual(indexed, indexed2)
+        self.assertEqual(labels, {k: [registry.label(i) for i in v] for k, v in ids.items()})
+        self.assertEqual(['2020-03-30', 'EPI_ISL_3', 'USA', 'hCoV-19/USA/WI-3/2020'],
+                         registry.row(2))
+        self.assertEqual(['Canada', 'USA'], registry.locations)
+
+
+class TestDistances(unittest.TestCase):
+    def test_write_distances(self):
+        random.seed(1)
+        nfeat = 60
+        indexed = [set(random.sample(range(nfeat), random.randint(0, 20)))
+                   for _ in range(600)]  # spans more than one block
+        sample = [int(nfeat * random.random()) for _ in range(nfeat)]
+        weights = {y: sample.count(y) for y in sample}
+
+        # distances by previous double loop of bootstrap()
+        expected = [f'{len(indexed):>5}\n']
+        for i, fvec in enumerate(indexed):
+            row = [sum(weights.get(y, 0) for y in fvec ^ other) for other in indexed]
+            expected.append(f'{i}' + ''.join(f' {d:>2}' for d in row) + '\n')
+
+        handle = BytesIO()
+        nbytes = clustering.write_distances(
+            handle, indexed, [weights.get(y, 0) for y in range(nfeat)])
+        self.assertEqual(''.join(expected).encode('ascii'), handle.getvalue())
+        self.assertEqual(len(handle.getvalue()), nbytes)
+
+    def test_format_block(self):
+        dists = [[0, 7, 10, 123], [7, 0, 99, 1000], [10, 99, 0, 5]]
+        expected = ''.join(f'{i}' + ''.join(f' {d:>2}' for d in row) + '\n'
+                           for i, row in enumerate(dists, 12))
+        self.assertEqual(expected.encode('ascii'), clustering.format_block(dists, 12))
+
+    def test_bootstrap_stream(self):
+        # stand-in for RapidNJ, returns star tree of rows in matrix file
+        script = (f"#!{sys.executable}\n"
+                  "import sys\n"
+                  "with open(sys.argv[1]) as handle:\n"
+                  "    n = int(handle.readline())\n"
+                  "    rows = [line.split() for line in handle]\n"
+                  "assert len(rows) == n and all(len(row) == n + 1 for row in rows)\n"
+                  "print('(' + ','.join(f'{row[0]}:1' for row in rows) + ');')\n")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            binpath = os.path.join(tmpdir, 'rapidnj')
+            with open(binpath, 'w', encoding='utf-8') as handle:
+                handle.write(script)
+            os.chmod(binpath, stat.S_IRWXU)
+            indexed = [{0, 1}, {0, 2}, {1, 2, 3}, set()]
+            for stream in (True, False):
+                tree = clustering.bootstrap({i: i for i in range(4)}, indexed,
+                                            binpath=binpath, stream=stream)
+                self.assertEqual(['0', '1', '2', '3'],
+                                 [tip.name for tip in tree.get_terminals()])
+
+            # streaming is opt-in, and probed once by the caller
+            args = Namespace(binpath=binpath, nj_backend='rapidnj', nj_stream=False)
+            self.assertFalse(clustering.stream_rapidnj(args))
+            args.nj_stream = True
+            self.assertTrue(clustering.stream_rapidnj(args))
+            with open(binpath, 'w', encoding='utf-8') as handle:
+                handle.write(f"#!{sys.executable}\nimport sys\nsys.exit(1)\n")
+            messages = []
+            self.assertFalse(clustering.stream_rapidnj(
+                args, callback=lambda msg, level='INFO': messages.append(level)))
+            self.assertEqual(['WARN'], messages)
+
+    def test_bootstrap_builtin(self):
+        indexed = [{0, 1}, {0, 2}, {1, 2, 3}, set(), {3}]
+        tree = clustering.bootstrap({i: i for i in range(4)}, indexed, backend='builtin')
+        self.assertEqual(['0', '1', '2', '3', '4'], [name for name, _ in tree.terminals()])
+        self.assertEqual(8, len(tree))
+
+
+class TestPoolTrees(unittest.TestCase):
+    def setUp(self):
+        random.seed(2)
+        self.recoded = {}
+        for lineage, nvar in [('A', 1), ('B', 12), ('C.1', 30), ('C/2', 5)]:
+            indexed = [sorted(random.sample(range(40), random.randint(0, 10)))
+                       for _ in range(nvar)]
+            self.recoded[lineage] = {'union': {str(i): i for i in range(40)},
+                                     'labels': {str(i): [f'{lineage}-{i}'] for i in range(nvar)},
+                                     'indexed': indexed}
+
+    def test_shared_lineages(self):
+        shared = clustering.SharedLineages(self.recoded)
+        try:
+            for lineage, rdata in self.recoded.items():
+                expected = clustering.incidence_matrix(rdata['indexed'], 40)
+                self.assertEqual(0, (shared.incidence(lineage) != expected).nnz)
+        finally:
+            shared.close()
+
+    def test_pool_trees(self):
+        recoded = {k: v for k, v in self.recoded.items() if k != 'A'}
+        result = dict(clustering.pool_trees(recoded, nboot=5, nworkers=2,
+                                            backend='builtin', deep=['C.1']))
+        self.assertEqual(set(recoded), set(result))
+        for lineage, trees in result.items():
+            self.assertEqual(5, len(trees))
+            self.assertTrue(all(isinstance(tree, NJTree) for tree in trees))
+            self.assertEqual(len(recoded[lineage]['indexed']), trees[0].ntips)
+        # replicates in different worker processes are not identical
+        lengths = {tuple(tree.lengths[:-1].round(6)) for tree in result['C.1']}
+        self.assertGreater(len(lengths), 1)
+
+    def test_write_trees(self):
+        args = Namespace(nboot=3, nj_workers=2, binpath='rapidnj', nj_backend='builtin')
+        with tempfile.TemporaryDirectory() as outdir:
+            clustering.write_trees(self.recoded, list(self.recoded), outdir, args,
+                                   deep=['C.1'])
+            for lineage, rdata in self.recoded.items():
+                path = os.path.join(outdir, lineage.replace('/', '_') + '.nwk')
+                trees = list(phy.parse(path, 'newick'))
+                self.assertEqual(1 if lineage == 'A' else 3, len(trees))
+                self.assertEqual(len(rdata['indexed']), len(trees[0].get_terminals()))
+
+class FakeComm:
+    """ Records messages sent, and replies from a list """
+    def __init__(self, replies, size=3, rank=0):
+        self.replies = deque(replies)
+        self.sent = []
+        self.size = size
+        self.rank = rank
+
+    def Get_size(self):
+        return self.size
+
+    def Get_rank(self):
+        return self.rank
+
+    def send(self, message, dest):
+        self.sent.append((dest, message))
+
+    def recv(self, source):
+        return self.replies.popleft()
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.recoded = {'A': {'indexed': [[0]] * 10}, 'B': {'indexed': [[1]] * 2},
+                        'C': {'indexed': [[2]] * 3}}
+
+    def test_schedule_units(self):
+        units = clustering.schedule_units(self.recoded, ['A', 'B', 'C'], nboot=10,
+                                          nworkers=2)
+        # largest lineage is split into ranges of replicates, largest units first
+        self.assertEqual([(200, 'A', 0, 2), (200, 'A', 2, 2)] +
+                         [(100, 'A', i, 1) for i in range(4, 10)] +
+                         [(90, 'C', 0, 10), (40, 'B', 0, 10)], units)
+        for lineage in self.recoded:
+            ranges = sorted((first, nreps) for _, lin, first, nreps in units if lin == lineage)
+            self.assertEqual(10, sum(nreps for _, nreps in ranges))
+            self.assertEqual([0] + list(np.cumsum([n for _, n in ranges]))[:-1],
+                             [first for first, _ in ranges])
+
+    def test_head(self):
+        units = [(4, 'A', 0, 2), (4, 'A', 2, 2), (2, 'B/1', 0, 4)]
+        replies = [('ready', 1), ('ready', 2),
+                   ('result', 2, 'A', 2, ['(c,d);', '(a,c);'], 1.0),
+                   ('result', 1, 'A', 0, ['(a,b);', '(b,c);'], 2.0),
+                   ('result', 2, 'B/1', 0, ['(x,y);'] * 4, 1.5)]
+        messages = []
+        with tempfile.TemporaryDirectory() as outdir:
+            scheduler = clustering.TreeScheduler(
+                FakeComm(replies), units, 4, outdir,
+                callback=lambda msg, level='INFO': messages.append(msg))
+            scheduler.run()
+            self.assertEqual([(1, ('A', 0, 2)), (2, ('A', 2, 2)), (2, ('B/1', 0, 4)),
+                              (1, None), (2, None)], scheduler.comm.sent)
+            with open(os.path.join(outdir, 'A.nwk'), encoding='utf-8') as handle:
+                self.assertEqual('(a,b);\n(b,c);\n(c,d);\n(a,c);\n', handle.read())
+            self.assertTrue(os.path.exists(os.path.join(outdir, 'B_1.nwk')))
+        self.assertEqual({1: 1, 2: 2}, {r: st['units'] for r, st in scheduler.stats.items()})
+        self.assertTrue(messages[-3].startswith('rank 1: 1 units, 2.0s busy'))
+        self.assertIn('3 units in', messages[-1])
+
+    def test_worker(self):
+        recoded = {'B': {'union': {str(i): i for i in range(4)},
+                         'indexed': [[0, 1], [0, 2], [1, 2, 3], [], [3]]}}
+        comm = FakeComm([('B', 3, 2), None], rank=2)
+        clustering.schedule_worker(comm, recoded, backend='builtin')
+        self.assertEqual((0, ('ready', 2)), comm.sent[0])
+        dest, (tag, rank, lineage, first, trees, busy) = comm.sent[1]
+        self.assertEqual((0, 'result', 2, 'B', 3), (dest, tag, rank, lineage, first))
+        self.assertEqual(2, len(trees))
+        self.assertEqual(5, len(phy.read(StringIO(trees[0]), 'newick').get_terminals()))
+        self.assertGreaterEqual(busy, 0)
+        self.assertEqual(2, len(comm.sent))
+
+    def test_head_local(self):
+        # without worker ranks, the head rank processes all units itself
+        recoded = {'B': {'union': {str(i): i for i in range(4)},
+                         'indexed': [[0, 1], [0, 2], [1, 2, 3], [], [3]]},
+                   'C': {'union': {str(i): i for i in range(4)},
+                         'indexed': [[0], [1], [2]]}}
+        units = clustering.schedule_units(recoded, ['B', 'C'], nboot=4, nworkers=0)
+        messages = []
+        with tempfile.TemporaryDirectory() as outdir:
+            scheduler = clustering.TreeScheduler(
+                FakeComm([], size=1), units, 4, outdir,
+                callback=lambda msg, level='INFO': messages.append(msg))
+            scheduler.run_local(recoded, backend='builtin')
+            self.assertEqual([], scheduler.comm.sent)
+            for lineage, rdata in recoded.items():
+                trees = list(phy.parse(os.path.join(outdir, f'{lineage}.nwk'), 'newick'))
+                self.assertEqual(4, len(trees))
+                self.assertEqual(len(rdata['indexed']), len(trees[0].get_terminals()))
+        self.assertEqual(len(units), scheduler.stats[0]['units'])
+        self.assertIn(f'{len(units)} units in', messages[-1])
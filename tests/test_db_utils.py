@@ -0,0 +1,63 @@
+import unittest
+import os
+import json
+from tempfile import TemporaryDirectory
+from covizu.utils.db_utils import FeatureStore
+from covizu.utils.gisaid_utils import batch_fasta
+from covizu.utils.mutation_utils import encode_mutation
+
+
+class TestFeatureStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'features.db')
+        self.record = {'covv_virus_name': 'hCoV-19/Canada/Qc-L00240569/2020',
+                       'covv_accession_id': 'EPI_ISL_465679',
+                       'covv_collection_date': '2020-03-27',
+                       'covv_lineage': 'B.1.1.171',
+                       'covv_location': 'North America / Canada',
+                       'diffs': [('-', 28, 1), ('~', 30, 'C')],
+                       'missing': [(0, 6), (75, 29903)]}
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_insert_lookup(self):
+        with FeatureStore(self.path) as store:
+            self.assertIsNone(store.lookup('EPI_ISL_465679'))
+            store.insert(self.record)
+
+        # reopen to check that inserts persist
+        with FeatureStore(self.path) as store:
+            self.assertEqual(1, len(store))
+            self.assertIn('EPI_ISL_465679', store)
+            row = store.lookup('EPI_ISL_465679')
+            # diffs are stored as mutation codes
+            self.assertEqual(json.dumps([encode_mutation(('-', 28, 1)),
+                                         encode_mutation(('~', 30, 'C'))]), row['diffs'])
+            # missing sites are stored as packed (delta, length) pairs
+            self.assertEqual('[0, 6, 69, 29828]', row['missing'])
+
+    def test_batch_fasta(self):
+        with FeatureStore(self.path) as store:
+            store.insert(self.record)
+            gen = [
+                {'covv_virus_name': 'hCoV-19/Canada/Qc-L00240569/2020',
+                 'covv_accession_id': 'EPI_ISL_465679',
+                 'sequence': 'ACGT'},
+                {'covv_virus_name': 'hCoV-19/Canada/Qc-L00240594/2020',
+                 'covv_accession_id': 'EPI_ISL_465680',
+                 'sequence': 'ACGT'}
+            ]
+            result = list(batch_fasta(gen, size=2, store=store))
+
+        stdin, batch = result[0]
+        self.assertEqual('>hCoV-19/Canada/Qc-L00240594/2020__accession__EPI_ISL_465680\n'
+                         'ACGT\n', stdin)
+        self.assertEqual(self.record['diffs'], batch[0]['diffs'])
+        self.assertEqual(self.record['missing'], batch[0]['missing'])
+        self.assertNotIn('diffs', batch[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+import os
+import copy
+from argparse import Namespace
+from collections import deque
+from tempfile import TemporaryDirectory
+from covizu.features import FeatureCollector, BatchExchange, worker
+from covizu.utils.gisaid_utils import sort_by_lineage
+
+
+class FakeComm:
+    """ Records messages sent to head rank, and replies from a list """
+    def __init__(self, replies):
+        self.replies = deque(replies)
+        self.sent = []
+
+    def send(self, message, dest):
+        self.sent.append((dest, message))
+
+    def recv(self, source):
+        return self.replies.popleft()
+
+
+class TestBatchExchange(unittest.TestCase):
+    def setUp(self):
+        self.records = [{'covv_accession_id': f'EPI_ISL_{i}', 'covv_lineage': 'B.1',
+                         'diffs': [('~', 100 + i, 'T')], 'missing': [(0, 5)]}
+                        for i in range(4)]
+
+    def test_exchange(self):
+        comm = FakeComm([(7, ('fasta7', ['r7'])), (9, ('fasta9', ['r9'])), None])
+        collector = FeatureCollector()
+        exchange = BatchExchange(comm, collector=collector)
+        batches = exchange.batches()
+        self.assertEqual(('fasta7', ['r7']), next(batches))
+        self.assertEqual(('fasta9', ['r9']), next(batches))  # read ahead
+
+        # records of first batch
+        collector.insert(self.records[0])
+        self.records[0]['diffs'].append(('-', 5, 1))  # copies are kept
+        exchange.records.extend(self.records[:2])
+        expected = sort_by_lineage([dict(r, diffs=list(r['diffs'])) for r in self.records[:2]])
+        exchange.batch_done()
+        self.assertEqual((0, ('result', 7, expected, [
+            {'covv_accession_id': 'EPI_ISL_0', 'covv_lineage': 'B.1',
+             'diffs': [('~', 100, 'T')], 'missing': [(0, 5)]}])), comm.sent[-1])
+
+        exchange.batch_done()  # all records of second batch were filtered
+        self.assertEqual((0, ('result', 9, {}, [])), comm.sent[-1])
+        self.assertEqual([], list(batches))
+        self.assertEqual(3, sum(message == ('ready', ) for _, message in comm.sent))
+
+
+class TestWorker(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        vcf_file = os.path.join(self.tmpdir.name, 'problematic.vcf')
+        with open(vcf_file, 'w', encoding='utf-8') as handle:
+            handle.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+            handle.write('NC_045512.2\t31\t.\tA\tC\t.\tmask\t.\n')
+        self.args = Namespace(
+            feature_store=None, mmworkers=1, fast_diffs=False, fused_filter=False,
+            vcf=vcf_file, poisson_cutoff=0.005, ref='covizu/data/NC_045512.fa',
+            mmbin='minimap2', mmthreads=1, minlen=29000)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_worker(self):
+        # records that pass filtering are returned with their own batch
+        replies, expected = [], {}
+        for index in range(5):
+            batch = []
+            for i in range(300):
+                # features were retrieved from store, so minimap2 is not run
+                ndiffs = 0 if i % 3 == 0 else 5
+                batch.append({
+                    'covv_accession_id': f'EPI_ISL_{index}_{i}', 'covv_lineage': 'B.1',
+                    'covv_collection_date': '2020-03-27',
+                    'diffs': [('~', 31, 'C')] + [('~', 100 + j, 'T') for j in range(ndiffs)],
+                    'missing': [(0, 5)]})
+            replies.append((index, ('', batch)))
+            expected[index] = 200
+        replies.append(None)
+
+        for fused_filter in (False, True):
+            self.args.fused_filter = fused_filter
+            comm = FakeComm(copy.deepcopy(replies))  # records are modified in place
+            worker(self.args, comm)
+            result = {}
+            for _, message in comm.sent:
+                if message[0] == 'result':
+                    _, index, partial, _ = message
+                    result[index] = sum(len(records) for variants in partial.values()
+                                        for records in variants.values())
+                    self.assertTrue(all(
+                        record['covv_accession_id'].startswith(f'EPI_ISL_{index}_')
+                        for variants in partial.values() for records in variants.values()
+                        for record in records))
+            self.assertEqual(expected, result)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,25 @@
 import unittest
-from covizu.utils.gisaid_utils import load_gisaid, batch_fasta, extract_features, sort_by_lineage
+import os
+import lzma
+import json
+import copy
+import random
+from argparse import Namespace
+from tempfile import TemporaryDirectory
+from unittest import mock
+from io import StringIO
+from covizu.minimap2 import Minimap2Pool, AnchoredCaller, mappy
+from covizu.utils.gisaid_utils import (load_gisaid, batch_fasta, extract_features,
+                                      sort_by_lineage, parse_json, parse_scan,
+                                      convert_provision, ProvisionCache, convert_json,
+                                      get_parser, is_current,
+                                      save_checkpoint, load_checkpoint,
+                                      Checkpointer, SequenceDedup, merge_lineages,
+                                      filter_problematic, RecordFilter, new_by_lineage)
+from covizu.utils.db_utils import FeatureStore
+from covizu.utils.lineage_utils import SpilledLineages
+from covizu.utils.mutation_utils import pack_key
+from covizu.utils.seq_utils import total_missing
 
 
 def callback(message):
@@ -28,6 +48,236 @@ class TestLoadGISAID(unittest.TestCase):
         self.assertEqual(self.expected_rejects, result)
 
 
+def write_provision(path, nrecords=50):
+    """ Write a small synthetic provision file for testing """
+    with lzma.open(path, 'wt', encoding='utf-8') as handle:
+        for i in range(nrecords):
+            record = {
+                'covv_accession_id': f'EPI_ISL_{i}',
+                'covv_virus_name': f'hCoV-19/{"canine" if i % 7 == 0 else "Canada"}/Qc-{i}/2020',
+                'covv_lineage': 'B.1',
+                'covv_collection_date': '2020-03-27' if i % 5 else '2020-03',
+                'covv_location': 'North America / Canada / Quebec',
+                'covv_gender': 'unknown',
+                'covv_patient_age': 'unknown',
+                'covv_patient_status': 'unknown',
+                'sequence': 'ACGT' * (10 + i % 3) + '\nACGT',
+                'covv_subm_lab': 'x' * 100
+            }
+            handle.write(json.dumps(record) + '\n')
+
+
+class TestLoadGISAIDParallel(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'provision.json.xz')
+        write_provision(self.path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_parallel_matches_serial(self):
+        expected = list(load_gisaid(self.path, minlen=45))
+        result = list(load_gisaid(self.path, minlen=45, nworkers=2, chunksize=7))
+        self.assertEqual(expected, result)
+        self.assertTrue(len(result) > 0)
+
+
+class TestParsers(unittest.TestCase):
+    def setUp(self):
+        self.fields = ("covv_accession_id", "covv_virus_name", "covv_location", "sequence")
+        self.line = json.dumps({
+            'covv_subm_lab': 'value mentions "covv_location" key',
+            'covv_location': 'North America / "Canada" \\',
+            'covv_accession_id': 'EPI_ISL_465679',
+            'covv_location_details': 'ignore me',
+            'sequence': 'ACGT\nACGT\n',
+            'covv_virus_name': 'hCoV-19/Canada/Qc-L00240569/2020 '
+        }, indent=None, separators=(', ', ' : ')).encode('utf-8')
+
+    def test_parse_json(self):
+        result = parse_json(self.line, self.fields)
+        self.assertEqual('ACGTACGT', result['sequence'])
+        self.assertEqual(list(self.fields), list(result.keys()))
+
+    def test_parse_scan(self):
+        expected = parse_json(self.line, self.fields)
+        result = parse_scan(self.line, self.fields)
+        self.assertEqual(expected, result)
+
+    def test_parse_scan_missing_field(self):
+        with self.assertRaises(KeyError):
+            parse_scan(self.line, ('covv_lineage', ))
+
+    def test_get_parser(self):
+        # field scanner is only used on request
+        with mock.patch('covizu.utils.gisaid_utils.orjson', None):
+            self.assertIs(parse_json, get_parser('auto'))
+        self.assertIs(parse_scan, get_parser('scan'))
+
+    def test_load_gisaid_parsers(self):
+        with TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'provision.json.xz')
+            write_provision(path)
+            expected = list(load_gisaid(path, minlen=45, parser='json'))
+            result = list(load_gisaid(path, minlen=45, parser='scan'))
+        self.assertEqual(expected, result)
+
+
+class TestProvisionCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'provision.json.xz')
+        write_provision(self.path)
+        self.cache = convert_provision(self.path, blocksize=8)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_convert_provision(self):
+        with lzma.open(self.path, 'rb') as handle:
+            expected = handle.read().splitlines()
+        pcache = ProvisionCache(self.cache)
+        self.assertEqual(7, len(pcache))
+        self.assertEqual(expected, list(pcache.iter_lines()))
+        # still readable as a single xz file
+        with lzma.open(self.cache, 'rb') as handle:
+            self.assertEqual(expected, handle.read().splitlines())
+
+    def test_is_current(self):
+        # a provision overwritten in place invalidates its cache
+        self.assertTrue(is_current(self.cache, self.path))
+        write_provision(self.path, nrecords=51)
+        self.assertFalse(is_current(self.cache, self.path))
+        self.assertFalse(is_current(self.cache + '.missing', self.path))
+
+    def test_lookup(self):
+        result = ProvisionCache(self.cache).lookup(
+            ['EPI_ISL_3', 'EPI_ISL_42', 'EPI_ISL_999'], fields=('covv_accession_id', ))
+        self.assertEqual({'EPI_ISL_3': {'covv_accession_id': 'EPI_ISL_3'},
+                          'EPI_ISL_42': {'covv_accession_id': 'EPI_ISL_42'}}, result)
+
+    def test_load_gisaid_parallel_cache(self):
+        expected = list(load_gisaid(self.path, minlen=45))
+        result = list(load_gisaid(self.cache, minlen=45, nworkers=2))
+        self.assertEqual(expected, result)
+
+    def test_convert_json(self):
+        clusters = json.dumps([{'nodes': {'EPI_ISL_1': [
+            ['2020-03-27', 'EPI_ISL_1', 'Canada', 'hCoV-19/Canada/Qc-1/2020'],
+            ['2020-03-27', 'EPI_ISL_33', 'Canada', 'hCoV-19/Canada/Qc-33/2020']]}}])
+        expected = convert_json(StringIO(clusters), self.path)
+        result = convert_json(StringIO(clusters), self.cache)
+        self.assertEqual(expected, result)
+        self.assertEqual(7, len(result[0]['nodes']['EPI_ISL_1'][0]))
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'provision.json.xz')
+        self.ckpt = os.path.join(self.tmpdir.name, 'checkpoint.pickle')
+        write_provision(self.path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def run_pipeline(self, state, nworkers=1, stop=None):
+        """ Collect accessions by batch, optionally interrupted mid-batch """
+        progress = {'offset': state['offset']}
+        loader = load_gisaid(self.path, minlen=45, nworkers=nworkers, chunksize=4,
+                             start=state['offset'], progress=progress)
+        checkpoint = Checkpointer(progress, state, self.ckpt, interval=2)
+        for count, (_, batch) in enumerate(checkpoint.track(batch_fasta(loader, size=3))):
+            for record in batch:
+                state['by_lineage']['B.1'].append(record['covv_accession_id'])
+                if count == stop:
+                    return  # simulate crash
+            checkpoint.batch_done()
+
+    def test_save_load(self):
+        self.assertIsNone(load_checkpoint(self.ckpt))
+        save_checkpoint(self.ckpt, {'offset': 3, 'by_lineage': {'B.1': [1, 2]}})
+        self.assertEqual({'offset': 3, 'by_lineage': {'B.1': [1, 2]}},
+                         load_checkpoint(self.ckpt))
+        self.assertFalse(os.path.exists(self.ckpt + '.tmp'))
+
+    def test_resume(self):
+        for nworkers in (1, 2):
+            expected = {'offset': 0, 'by_lineage': {'B.1': []}}
+            self.run_pipeline(expected, nworkers=nworkers)
+
+            self.run_pipeline({'offset': 0, 'by_lineage': {'B.1': []}},
+                              nworkers=nworkers, stop=5)
+            state = load_checkpoint(self.ckpt)
+            self.assertEqual(12, len(state['by_lineage']['B.1']))  # 4 batches
+            self.run_pipeline(state, nworkers=nworkers)
+            self.assertEqual(expected['by_lineage'], state['by_lineage'])
+
+    def run_filtered(self, state, store, fused=None, stop=None):
+        """
+        Collect accessions of filtered records, optionally interrupted after
+        <stop> records.  Features are read from <store>, so minimap2 is not run.
+        If <fused> is None, records are filtered by filter_problematic().
+        """
+        progress = {'offset': state['offset']}
+        loader = load_gisaid(self.path, minlen=45, chunksize=4, start=state['offset'],
+                             progress=progress)
+        checkpoint = Checkpointer(progress, state, self.ckpt, interval=2)
+        batcher = checkpoint.track(batch_fasta(loader, size=3, store=store))
+        record_filter = None if fused is None else RecordFilter(vcf_file=self.vcf, fused=fused)
+        records = extract_features(batcher, 'covizu/data/NC_045512.fa',
+                                   checkpoint=checkpoint, record_filter=record_filter)
+        if record_filter is None:
+            records = filter_problematic(records, vcf_file=self.vcf)
+        for count, record in enumerate(records):
+            if count == stop:
+                return  # simulate crash
+            state['by_lineage']['B.1'].append(record['covv_accession_id'])
+
+    def test_resume_filter(self):
+        # no retained records are held back when a batch is checkpointed
+        self.vcf = os.path.join(self.tmpdir.name, 'problematic.vcf')
+        with open(self.vcf, 'w', encoding='utf-8') as handle:
+            handle.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+            handle.write('NC_045512.2\t31\t.\tA\tC\t.\tmask\t.\n')
+        with FeatureStore(os.path.join(self.tmpdir.name, 'features.db')) as store:
+            for i in range(50):
+                # no differences, outlier, or retained
+                ndiffs = 0 if i % 3 == 0 else 30 if i % 4 == 0 else 5
+                store.insert({
+                    'covv_accession_id': f'EPI_ISL_{i}', 'covv_virus_name': f'Qc-{i}',
+                    'covv_lineage': 'B.1', 'covv_collection_date': '2020-03-27',
+                    'covv_location': 'North America / Canada / Quebec',
+                    'diffs': [('~', 31, 'C')] + [('~', 100 + j, 'T') for j in range(ndiffs)],
+                    'missing': [(0, 5)]})
+            store.commit()
+
+            for fused in (None, False, True):
+                expected = {'offset': 0, 'by_lineage': {'B.1': []}}
+                self.run_filtered(expected, store, fused=fused)
+                self.assertTrue(0 < len(expected['by_lineage']['B.1']) < 23)
+
+                self.run_filtered({'offset': 0, 'by_lineage': {'B.1': []}}, store,
+                                  fused=fused, stop=7)
+                state = load_checkpoint(self.ckpt)
+                self.assertTrue(0 < len(state['by_lineage']['B.1']) <= 7)
+                self.run_filtered(state, store, fused=fused)
+                self.assertEqual(expected['by_lineage'], state['by_lineage'])
+                os.remove(self.ckpt)
+
+
+class TestNewByLineage(unittest.TestCase):
+    def test_sort_budget(self):
+        # --sort-budget is given in MB
+        with TemporaryDirectory() as tmpdir:
+            result = new_by_lineage(Namespace(sort_budget=512, outdir=tmpdir))
+            self.assertIsInstance(result, SpilledLineages)
+            self.assertEqual(512 * 2**20, result.budget)
+            result.close()
+            self.assertEqual({}, new_by_lineage(Namespace(sort_budget=0, outdir=tmpdir)))
+
+
 class TestBatchFasta(unittest.TestCase):
     def setUp(self):
         self.expected = \
@@ -73,6 +323,58 @@ class TestBatchFasta(unittest.TestCase):
         self.assertEqual(self.expected, result)
 
 
+class TestSequenceDedup(unittest.TestCase):
+    def setUp(self):
+        self.records = [
+            {'covv_virus_name': f'hCoV-19/Canada/Qc-{i}/2020',
+             'covv_accession_id': f'EPI_ISL_{i}', 'covv_lineage': 'B.1',
+             'sequence': seq}
+            for i, seq in enumerate(['ACGT', 'ACGA', 'ACGT', 'ACGT', 'ACGA'])]
+
+    def test_batch_fasta(self):
+        dedup = SequenceDedup()
+        result = list(batch_fasta(self.records, size=2, dedup=dedup))
+        self.assertEqual('>hCoV-19/Canada/Qc-0/2020__accession__EPI_ISL_0\nACGT\n'
+                         '>hCoV-19/Canada/Qc-1/2020__accession__EPI_ISL_1\nACGA\n',
+                         result[0][0])
+        self.assertEqual('', result[1][0])
+        self.assertEqual(3, dedup.ndups)
+        self.assertEqual(0.6, dedup.ratio())
+
+    def test_extract_features_copies(self):
+        # sequences aligned in a previous batch do not invoke minimap2
+        dedup = SequenceDedup()
+        dedup.remember(dedup.digest('ACGT'), [('~', 30, 'C')], [(0, 6)])
+        batcher = batch_fasta(self.records[2:4], size=2, dedup=dedup)
+        result = list(extract_features(batcher, 'covizu/data/NC_045512.fa', dedup=dedup))
+        self.assertEqual(['EPI_ISL_2', 'EPI_ISL_3'],
+                         [r['covv_accession_id'] for r in result])
+        for record in result:
+            self.assertEqual([('~', 30, 'C')], record['diffs'])
+        self.assertIsNot(result[0]['diffs'], result[1]['diffs'])
+        self.assertEqual({}, dedup.copies)
+        self.assertEqual({}, dedup.pending)
+
+    def test_maxsize(self):
+        # least recently seen sequences are evicted, unless awaited by a copy
+        dedup = SequenceDedup(maxsize=2)
+        for i, seq in enumerate(['AAAA', 'CCCC']):
+            self.assertTrue(dedup.add(f'q{i}', dedup.digest(seq)))
+            dedup.aligned(f'q{i}', [], [])
+        self.assertFalse(dedup.add('q2', dedup.digest('AAAA')))  # awaiting copy
+        self.assertTrue(dedup.add('q3', dedup.digest('GGGG')))
+        dedup.aligned('q3', [], [])
+        self.assertEqual([dedup.digest(seq) for seq in ['AAAA', 'GGGG']],
+                         list(dedup.features))
+        self.assertEqual({}, dedup.first)
+        dedup.copy(dedup.copies.pop('q2'))
+        self.assertTrue(dedup.add('q4', dedup.digest('TTTT')))
+        dedup.aligned('q4', [], [])
+        self.assertEqual([dedup.digest(seq) for seq in ['GGGG', 'TTTT']],
+                         list(dedup.features))
+        self.assertTrue(dedup.add('q5', dedup.digest('CCCC')))  # realigned
+
+
 class TestExtractFeatures(unittest.TestCase):
     def setUp(self):
         self.batcher = \
@@ -140,15 +442,101 @@ class TestExtractFeatures(unittest.TestCase):
                 minlen=40))
         self.assertEqual(self.expected, result)
 
+    def labelled(self):
+        """ label queries as batch_fasta() does """
+        batcher = []
+        for fasta, batch in self.batcher:
+            for record in batch:
+                name = record['covv_virus_name']
+                fasta = fasta.replace(
+                    f'>{name}\n', f">{name}__accession__{record['covv_accession_id']}\n")
+            batcher.append((fasta, batch))
+        return batcher
+
+    @unittest.skipIf(mappy is None, "requires mappy")
+    def test_extract_features_pool(self):
+        with Minimap2Pool('covizu/data/NC_045512.fa', nworkers=2, minlen=40) as pool:
+            result = list(extract_features(self.labelled(), 'covizu/data/NC_045512.fa',
+                                           pool=pool))
+        self.assertEqual(self.expected, result)
+
+    @unittest.skipIf(mappy is None, "requires mappy")
+    def test_extract_features_caller(self):
+        caller = AnchoredCaller('covizu/data/NC_045512.fa')
+        with Minimap2Pool('covizu/data/NC_045512.fa', nworkers=2, minlen=40) as pool:
+            result = list(extract_features(self.labelled(), 'covizu/data/NC_045512.fa',
+                                           minlen=40, pool=pool, caller=caller))
+        # genomes called without alignment precede the rest of their batch
+        def key(record):
+            return record['covv_accession_id']
+        self.assertEqual(sorted(self.expected, key=key), sorted(result, key=key))
+        self.assertEqual(3, caller.ncalled + caller.nfallback)
+
+    @unittest.skipIf(mappy is None, "requires mappy")
+    def test_extract_features_filter(self):
+        with TemporaryDirectory() as tmpdir:
+            vcf_file = os.path.join(tmpdir, 'problematic.vcf')
+            with open(vcf_file, 'w', encoding='utf-8') as handle:
+                handle.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+                handle.write('NC_045512.2\t31\t.\tA\tC\t.\tmask\t.\n')
+            params = {'vcf_file': vcf_file, 'rate': 0.01, 'misstol': 30000}
+            with Minimap2Pool('covizu/data/NC_045512.fa', nworkers=2, minlen=40) as pool:
+                batcher = copy.deepcopy(self.labelled())  # records are modified in place
+                expected = list(filter_problematic(
+                    extract_features(batcher, 'covizu/data/NC_045512.fa', pool=pool),
+                    **params))
+                record_filter = RecordFilter(**params)
+                result = list(extract_features(self.labelled(), 'covizu/data/NC_045512.fa',
+                                               pool=pool, record_filter=record_filter))
+        self.assertEqual(expected, result)
+        self.assertEqual([('~', 32, 'A')], result[1]['diffs'])
+        self.assertEqual(1, record_filter.n_sites)
+
 
 # Test Filter Problematic
 
 
+class TestRecordFilter(unittest.TestCase):
+    def test_apply_batch(self):
+        # classifying a batch at once gives the same result as one at a time
+        random.seed(1)
+        records = [{'covv_accession_id': f'EPI_ISL_{i}',
+                    'covv_collection_date': f'2021-{random.randint(1, 12):02d}-01',
+                    'diffs': [('~', random.choice([31, 100, 200]), 'C')
+                              for _ in range(random.randint(0, 50))],
+                    'missing': [(0, random.choice([10, 500]))]}
+                   for i in range(100)]
+        with TemporaryDirectory() as tmpdir:
+            vcf_file = os.path.join(tmpdir, 'problematic.vcf')
+            with open(vcf_file, 'w', encoding='utf-8') as handle:
+                handle.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+                handle.write('NC_045512.2\t31\t.\tA\tC\t.\tmask\t.\n')
+            record_filter = RecordFilter(vcf_file=vcf_file)
+
+        def keep(record):
+            """ previous test of one record at a time with QPois.is_outlier() """
+            record['diffs'] = record_filter.mask.filter_diffs(record['diffs'])
+            if not record['diffs']:
+                return False
+            if record_filter.poisson.is_outlier(record['covv_collection_date'],
+                                                len(record['diffs'])):
+                return False
+            return total_missing(record) <= record_filter.misstol
+
+        expected = [r for r in copy.deepcopy(records) if keep(r)]
+        result = record_filter.apply_batch([(r, None) for r in records])
+        self.assertEqual(expected, result)
+        self.assertTrue(0 < len(result) < len(records))
+        self.assertEqual(len(records) - len(result) - sum(not r['diffs'] for r in records),
+                         record_filter.n_outlier + record_filter.n_ambig)
+        self.assertTrue(record_filter.n_outlier > 0 and record_filter.n_ambig > 0)
+
+
 class TestSortByLineage(unittest.TestCase):
     def setUp(self):
         self.expected = \
             {'B.1.1.171':
-                {'-|28|1':
+                {pack_key([('-', 28, 1)]):
                     [{'covv_virus_name': 'hCoV-19/Canada/Qc-L00240569/2020',
                       'covv_accession_id': 'EPI_ISL_465679',
                       'covv_collection_date': '2020-03-27',
@@ -157,14 +545,14 @@ class TestSortByLineage(unittest.TestCase):
                       }]
                  },
              'B.1.265':
-                {'~|30|C,~|32|A':
+                {pack_key([('~', 30, 'C'), ('~', 32, 'A')]):
                     [{'covv_virus_name': 'hCoV-19/Canada/Qc-L00240594/2020',
                       'covv_accession_id': 'EPI_ISL_465680',
                       'covv_collection_date': '2020-03-27',
                       'covv_lineage': 'B.1.265',
                       'missing': [(75, 29903)]}]},
              'B.1.2':
-                {'+|13|A':
+                {pack_key([('+', 13, 'A')]):
                     [{'covv_virus_name': 'hCoV-19/Canada/Qc-L00240624/2020',
                       'covv_accession_id': 'EPI_ISL_465681',
                       'covv_collection_date': '2020-03-27',
@@ -204,6 +592,32 @@ class TestSortByLineage(unittest.TestCase):
         self.assertEqual(self.expected, results)
 
 
+class TestMergeLineages(unittest.TestCase):
+    @staticmethod
+    def make_records(start, stop):
+        return [{'covv_accession_id': f'EPI_ISL_{i}',
+                 'covv_lineage': ['B.1', 'A.2', 'B.1.1'][i % 3 if i < 12 else 0],
+                 'diffs': [('~', 100 + i % 2, 'T')], 'missing': []}
+                for i in range(start, stop)]
+
+    def test_merge_lineages(self):
+        # merging partial results in order is the same as sorting all records
+        expected = sort_by_lineage(self.make_records(0, 30))
+        result = {}
+        for start in range(0, 30, 7):
+            merge_lineages(result, sort_by_lineage(self.make_records(start, min(start + 7, 30))))
+        self.assertEqual(expected, result)
+        self.assertEqual(list(expected), list(result))
+
+        with TemporaryDirectory() as tmpdir:
+            spilled = SpilledLineages(budget=500, spill_dir=tmpdir)
+            for start in range(0, 30, 7):
+                merge_lineages(spilled, sort_by_lineage(
+                    self.make_records(start, min(start + 7, 30))))
+            self.assertEqual(expected, dict(spilled.items()))
+            spilled.close()
+
+
 # Test Convert JSON
 
 
@@ -0,0 +1,87 @@
+import unittest
+import json
+import pickle
+from io import StringIO
+from tempfile import TemporaryDirectory
+from covizu.utils.gisaid_utils import sort_by_lineage
+from covizu.utils.lineage_utils import SpilledLineages, LineageView, dump_json, load_json
+
+
+def make_records(n=60):
+    return [{'covv_virus_name': f'hCoV-19/Canada/Qc-{i}/2020',
+             'covv_accession_id': f'EPI_ISL_{i}',
+             'covv_lineage': ['B.1', 'B.1.1', 'A.2'][i % 3],
+             'diffs': [('~', 100 + i % 4, 'T'), ('-', 28, 1)],
+             'missing': [(0, 6)]}
+            for i in range(n)]
+
+
+class TestSpilledLineages(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.expected = sort_by_lineage(make_records())
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_sort_by_lineage(self):
+        spilled = SpilledLineages(budget=2000, spill_dir=self.tmpdir.name)
+        result = sort_by_lineage(make_records(), result=spilled)
+        self.assertTrue(len(spilled.files) > 0)
+        self.assertEqual(list(self.expected), list(result))
+        self.assertEqual(self.expected, dict(result.items()))
+        self.assertIn('A.2', result)
+        self.assertNotIn('C.1', result)
+        spilled.close()
+
+    def test_pickle(self):
+        # records spilled after pickling are discarded on unpickling
+        spilled = SpilledLineages(budget=2000, spill_dir=self.tmpdir.name)
+        sort_by_lineage(make_records()[:30], result=spilled)
+        state = pickle.dumps(spilled)
+        sort_by_lineage(make_records()[30:45], result=spilled)
+        spilled = pickle.loads(state)
+        sort_by_lineage(make_records()[30:], result=spilled)
+        self.assertEqual(self.expected, dict(spilled.items()))
+
+    def test_consolidate(self):
+        # spilled lineages are rewritten as one pickle on first access
+        spilled = SpilledLineages(budget=500, spill_dir=self.tmpdir.name)
+        sort_by_lineage(make_records(), result=spilled)
+        self.assertTrue(max(spilled.chunks.values()) > 1)
+        self.assertEqual(self.expected, dict(spilled.items()))
+        self.assertEqual({1}, set(spilled.chunks.values()))
+        self.assertEqual({}, spilled.memory)
+        self.assertIs(spilled['A.2'], spilled['A.2'])  # last lineage is kept
+        self.assertEqual(self.expected, dict(spilled.items()))
+        # records added after access are not missed
+        sort_by_lineage(make_records()[:3], result=spilled)
+        self.assertEqual(sort_by_lineage(make_records() + make_records()[:3]),
+                         dict(spilled.items()))
+        spilled.close()
+
+    def test_view(self):
+        spilled = SpilledLineages(budget=2000, spill_dir=self.tmpdir.name)
+        sort_by_lineage(make_records(), result=spilled)
+        view = LineageView(spilled, ['A.2', 'B.1'])
+        self.assertEqual(['A.2', 'B.1'], list(view))
+        self.assertNotIn('B.1.1', view)
+        self.assertEqual(self.expected['B.1'], view['B.1'])
+
+    def test_dump_json(self):
+        spilled = SpilledLineages(budget=2000, spill_dir=self.tmpdir.name)
+        sort_by_lineage(make_records(), result=spilled)
+        handle = StringIO()
+        dump_json(spilled, handle)
+        handle.seek(0)
+        result = load_json(handle)
+        self.assertEqual(list(self.expected), list(result))
+        for lineage, records in self.expected.items():
+            # tuples of missing intervals are read back as lists
+            self.assertEqual(json.loads(json.dumps(list(records.values()))),
+                             list(result[lineage].values()))
+            self.assertEqual(list(records), list(result[lineage]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,261 @@
+import unittest
+import os
+import json
+from io import StringIO, BytesIO
+import sys
+import stat
+import random
+from tempfile import TemporaryDirectory
+from covizu.minimap2 import (minimap2, Minimap2Pool, mappy, parse_cigar, align_cigar,
+                             cigar_diffs, cigar_filtered, encode_diffs, stream_fasta, write_features,
+                             read_features, AnchoredCaller)
+from covizu.utils.seq_utils import convert_fasta, total_missing, ProblematicMask
+
+
+# stands in for minimap2: reports every query as a full-length match
+FAKE_MINIMAP2 = """#!{python}
+import sys
+print('@HD\\tVN:1.6')
+qname, seq = None, []
+def emit():
+    if qname is not None:
+        s = ''.join(seq)
+        print(f'{{qname}}\\t0\\tref\\t1\\t60\\t{{len(s)}}=\\t*\\t0\\t0\\t{{s}}')
+for line in sys.stdin:
+    if line.startswith('>'):
+        emit()
+        qname, seq = line[1:].strip(), []
+    else:
+        seq.append(line.strip())
+emit()
+"""
+
+
+class TestCigar(unittest.TestCase):
+    def test_parse_cigar(self):
+        self.assertEqual([(3, 'S'), (10, '='), (1, 'X'), (2, 'D')], parse_cigar('3S10=1X2D'))
+        self.assertEqual([], parse_cigar(''))
+        for cigar in ('10=1Y', '=10', '10= 1X', '10'):
+            with self.assertRaises(RuntimeError):
+                parse_cigar(cigar)
+
+    def test_align_cigar(self):
+        # soft clip, insertion and deletion
+        result = align_cigar('NNACGTTTAC', 2, '2S3=1X2I2D2=', reflen=14)
+        self.assertEqual('--ACGT--AC----', result)
+        self.assertEqual('--ACGT--AC', align_cigar('NNACGTTTAC', 2, '2S3=1X2I2D2='))
+
+    def test_cigar_diffs(self):
+        diffs, missing = cigar_diffs('ACGTTTACNNNRAT', 2, '3=1X2I2D2=3X1X2=', reflen=20)
+        self.assertEqual([('~', 5, 'T'), ('+', 6, 'TT'), ('-', 6, 2)], diffs)
+        self.assertEqual([(0, 2), (10, 13), (13, 14), (16, 20)], missing)
+        with self.assertRaises(RuntimeError):
+            cigar_diffs('ACGT', 0, '4M', reflen=4)
+
+    def test_cigar_filtered(self):
+        mask = ProblematicMask({5: {'ref': 'G', 'alt': 'T', 'info': ''}})
+        diffs, missing, nmasked, nmissing = cigar_filtered(
+            'ACGTNTACNNNRAT', 2, '3=1X2I2D2=3X1X2=', reflen=20, mask=mask)
+        self.assertEqual([('-', 6, 2)], diffs)
+        self.assertEqual([(0, 2), (10, 13), (13, 14), (16, 20)], missing)
+        self.assertEqual(2, nmasked)  # masked substitution, insertion with N
+        self.assertEqual(10, nmissing)
+
+        # same result as cigar_diffs() followed by filter_problematic()
+        random.seed(1)
+        mask = ProblematicMask({pos: {'ref': 'A', 'alt': 'C,T', 'info': ''}
+                                for pos in range(0, 200, 7)})
+        for _ in range(100):
+            ops = random.choices(['5=', '1X', '2X', '2I', '3D', '1S'], k=30)
+            cigar = ''.join(ops)
+            qlen = sum(int(op[:-1]) for op in ops if op[-1] in '=XIS')
+            sequence = ''.join(random.choices('ACGTACGTNR', k=qlen))
+            diffs, missing = cigar_diffs(sequence, 3, cigar, reflen=200)
+            expected = mask.filter_diffs(diffs)
+            result = cigar_filtered(sequence, 3, cigar, reflen=200, mask=mask)
+            self.assertEqual((expected, missing, len(diffs) - len(expected),
+                              total_missing(('', diffs, missing))), result)
+
+    def test_stream(self):
+        mm2 = [('q1', 1, '2=1X', 'ACG'), ('q2', 0, '1S2=', 'TAC')]
+        self.assertEqual([('q1', '-ACG-'), ('q2', 'AC---')], list(stream_fasta(mm2, reflen=5)))
+        self.assertEqual([('q1', [('~', 3, 'G')], [(0, 1), (4, 5)]),
+                          ('q2', [], [(2, 5)])], list(encode_diffs(mm2, reflen=5)))
+
+
+class TestWriteFeatures(unittest.TestCase):
+    def setUp(self):
+        self.records = [('q1', [('~', 3, 'G'), ('+', 5, 'TT')], [(0, 1)]),
+                        ('q2', [], [(2, 5)]),
+                        ('q3', [('-', 7, 3)], [])]
+
+    def test_json(self):
+        # same output as serializing the whole list at once
+        handle = StringIO()
+        self.assertEqual(3, write_features(iter(self.records), handle))
+        expected = json.dumps([{'name': q, 'diffs': d, 'missing': m}
+                               for q, d, m in self.records]).replace('},', '},\n')
+        self.assertEqual(expected, handle.getvalue())
+        handle.seek(0)
+        self.assertEqual(self.records, list(read_features(handle, fmt='json')))
+
+    def test_ndjson(self):
+        handle = StringIO()
+
+        def encoded():
+            for i, record in enumerate(self.records):
+                # previous records already written
+                self.assertEqual(i, handle.getvalue().count('\n'))
+                yield record
+        write_features(encoded(), handle, fmt='ndjson')
+        handle.seek(0)
+        self.assertEqual(self.records, list(read_features(handle, fmt='ndjson')))
+
+    def test_pickle(self):
+        handle = BytesIO()
+        write_features(iter(self.records), handle, fmt='pickle')
+        handle.seek(0)
+        self.assertEqual(self.records, list(read_features(handle, fmt='pickle')))
+        with self.assertRaises(ValueError):
+            write_features(iter(self.records), handle, fmt='csv')
+
+
+class TestMinimap2Stream(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.binpath = os.path.join(self.tmpdir.name, 'minimap2')
+        with open(self.binpath, 'w', encoding='utf-8') as handle:
+            handle.write(FAKE_MINIMAP2.format(python=sys.executable))
+        os.chmod(self.binpath, os.stat(self.binpath).st_mode | stat.S_IEXEC)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_stream(self):
+        # output exceeds pipe buffers while input is still being written
+        fasta = ''.join(f'>seq{i}\n{"ACGT" * 250}\n' for i in range(2000))
+        result = list(minimap2(fasta, 'ref.fa', stream=True, path=self.binpath, minlen=0))
+        self.assertEqual(2000, len(result))
+        self.assertEqual(('seq1999', 0, '1000=', 'ACGT' * 250), result[-1])
+
+    def test_stream_chunks(self):
+        chunks = (f'>seq{i}\nACGT\n' for i in range(10))
+        result = list(minimap2(chunks, 'ref.fa', stream=True, path=self.binpath, minlen=0))
+        self.assertEqual([f'seq{i}' for i in range(10)], [r[0] for r in result])
+
+    def test_stream_early_exit(self):
+        fasta = ''.join(f'>seq{i}\n{"ACGT" * 250}\n' for i in range(2000))
+        mm2 = minimap2(fasta, 'ref.fa', stream=True, path=self.binpath, minlen=0)
+        self.assertEqual('seq0', next(mm2)[0])
+        mm2.close()  # should not hang on feeder thread
+
+
+@unittest.skipIf(mappy is None, "requires mappy")
+class TestMinimap2Pool(unittest.TestCase):
+    def setUp(self):
+        self.ref = 'covizu/data/NC_045512.fa'
+        with open(self.ref, encoding='utf-8') as handle:
+            self.refseq = convert_fasta(handle)[0][1]
+
+    def test_map(self):
+        query = self.refseq[100:5000] + 'A' + self.refseq[5001:9000]
+        batches = [(''.join(f'>seq{b}_{i}\n{query}\n' for i in range(5)), b)
+                   for b in range(7)]
+        batches.insert(3, ('', 'empty'))
+        with Minimap2Pool(self.ref, nworkers=3, minlen=0) as pool:
+            result = list(pool.map(batches))
+        self.assertEqual([0, 1, 2, 'empty', 3, 4, 5, 6], [data for data, _ in result])
+        self.assertIsNone(result[3][1])
+        self.assertEqual([f'seq6_{i}' for i in range(5)], [r[0] for r in result[-1][1]])
+        self.assertEqual(7, len(pool.latencies))
+
+        _, rpos, cigar, _ = result[0][1][0]
+        self.assertEqual(100, rpos)
+        expected = '4900=1X3999=' if self.refseq[5000] != 'A' else '8900='
+        self.assertEqual(expected, cigar)
+
+    def test_reverse_strand(self):
+        query = 'NNNN' + self.refseq[200:8000]
+        rc = mappy.revcomp(query)
+        with Minimap2Pool(self.ref, nworkers=1, minlen=0) as pool:
+            (qname, rpos, cigar, sequence), = pool.align(f'>rc test\n{rc}\n')
+        self.assertEqual('rc', qname)
+        self.assertEqual(query, sequence)
+        self.assertEqual(200, rpos)
+        self.assertEqual('4S7800=', cigar)
+
+
+class TestAnchoredCaller(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.ref = 'covizu/data/NC_045512.fa'
+        cls.caller = AnchoredCaller(cls.ref)
+        cls.refseq = cls.caller.refseq
+        cls.reflen = len(cls.refseq)
+
+    def mutate(self, pos, alt):
+        return self.refseq[:pos] + alt + self.refseq[(pos + 1):]
+
+    def test_substitutions(self):
+        alt = 'T' if self.refseq[4000] != 'T' else 'G'
+        query = self.mutate(4000, alt)
+        query = query[:3000] + 'R' + query[3001:6000] + 'NNNNN' + query[6005:]
+        self.assertEqual(([('~', 4000, alt)], [(3000, 3001), (6000, 6005)]),
+                         self.caller.call(query))
+        self.assertEqual(([], []), self.caller.call(self.refseq))
+
+    def test_ends(self):
+        # runs of N and bases beyond reference are clipped
+        query = 'N' * 50 + self.refseq[100:] + 'A' * 30
+        self.assertEqual(([], [(0, 100)]), self.caller.call(query))
+        query = 'ACGTTGCA' + self.refseq[:-60] + 'N' * 10
+        self.assertEqual(([], [(29843, 29903)]), self.caller.call(query))
+
+    def test_indels(self):
+        # indels in repeats are placed leftmost, as by minimap2
+        i = self.refseq.find('AAAA', 5000)
+        query = self.refseq[:(i + 1)] + self.refseq[(i + 2):]
+        self.assertEqual(([('-', i, 1)], []), self.caller.call(query))
+        query = self.refseq[:(i + 1)] + 'A' + self.refseq[(i + 1):]
+        self.assertEqual(([('+', i, 'A')], []), self.caller.call(query))
+        query = self.refseq[:21764] + self.refseq[21770:]
+        self.assertEqual(([('-', 21764, 6)], []), self.caller.call(query))
+
+    def test_fallback(self):
+        self.assertIsNone(self.caller.call(mappy.revcomp(self.refseq) if mappy else
+                                           self.refseq[::-1]))
+        # minimap2 clips alignment at long runs of N
+        self.assertIsNone(self.caller.call(self.refseq[:3000] + 'N' * 1000 +
+                                           self.refseq[4000:]))
+        # deletion too large
+        self.assertIsNone(self.caller.call(self.refseq[:9000] + self.refseq[9100:]))
+        # substitution close to deletion
+        query = self.mutate(9010, 'T' if self.refseq[9010] != 'T' else 'G')
+        self.assertIsNone(self.caller.call(query[:9000] + query[9006:]))
+
+    def test_call_fasta(self):
+        fasta = (f'>exact\n{self.refseq}\n>short\nACGT\n'
+                 f'>rearranged desc\n{self.refseq[15000:] + self.refseq[:15000]}\n')
+        remaining, called = self.caller.call_fasta(fasta, minlen=100)
+        self.assertEqual([('exact', [], [])], called)
+        self.assertTrue(remaining.startswith('>rearranged desc\n'))
+
+    @unittest.skipIf(mappy is None, "requires mappy")
+    def test_concordance(self):
+        queries = []
+        for i in range(20):
+            pos = 1000 + 1400 * i
+            query = self.mutate(pos, 'T' if self.refseq[pos] != 'T' else 'G')
+            query = query[:(pos + 500)] + 'N' * (10 * i) + query[(pos + 500 + 10 * i):]
+            if i % 3 == 0:
+                query = query[:(pos - 300)] + query[(pos - 300 + i % 7 + 1):]
+            queries.append(query[(i * 5):])
+        fasta = ''.join(f'>q{i}\n{q}\n' for i, q in enumerate(queries))
+        with Minimap2Pool(self.ref, nworkers=1, minlen=0) as pool:
+            expected = list(encode_diffs(pool.align(fasta), reflen=self.reflen))
+        for qname, diffs, missing in expected:
+            self.assertEqual((diffs, missing), self.caller.call(queries[int(qname[1:])]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+import json
+from unittest import mock
+from covizu.utils.mutation_utils import (encode_mutation, decode_mutation, encode_mutations,
+                                         decode_mutations, dump_mutations, pack_key, key_codes,
+                                         unpack_key)
+
+
+class TestMutationCodes(unittest.TestCase):
+    def setUp(self):
+        self.diffs = [('~', 23402, 'G'), ('-', 28, 3), ('+', 13, 'A'), ('~', 0, 'Y'),
+                      ('+', 100, 'ACGTACGTACGTAC'), ('-', 21990, 1000)]
+
+    def test_round_trip(self):
+        for diff in self.diffs:
+            self.assertEqual(diff, decode_mutation(encode_mutation(diff)))
+        self.assertEqual(encode_mutation(('-', '28', '3')), encode_mutation(('-', 28, 3)))
+
+    def test_long_insertion(self):
+        # encoded by hash, sequence is kept by encoding process
+        for alt in ('ACGTACGTACGTACG', 'ARGT'):
+            code = encode_mutation(('+', 500, alt))
+            self.assertEqual(('+', 500, alt), decode_mutation(code))
+        self.assertNotEqual(encode_mutation(('+', 500, 'ACGTACGTACGTACG')),
+                            encode_mutation(('+', 500, 'ACGTACGTACGTACC')))
+        with self.assertRaises(ValueError):
+            encode_mutation(('+', 500, 'A' * 5000))
+
+    def test_order(self):
+        # codes sort by position
+        codes = encode_mutations(self.diffs)
+        self.assertEqual(sorted(d[1] for d in self.diffs),
+                         [decode_mutation(c)[1] for c in codes])
+        self.assertEqual(0, len(encode_mutations([])))
+
+    def test_key(self):
+        key = pack_key(self.diffs)
+        self.assertEqual(key, pack_key(list(reversed(self.diffs))))
+        self.assertEqual(8 * len(self.diffs), len(key))
+        self.assertEqual(sorted(self.diffs, key=encode_mutation), unpack_key(key))
+        self.assertEqual(encode_mutations(self.diffs).tolist(), key_codes(key).tolist())
+        self.assertEqual([], unpack_key(pack_key(None)))
+
+    def test_decode_mutations(self):
+        # stored as codes, or as lists by previous versions
+        codes = encode_mutations(self.diffs[:2]).tolist()
+        self.assertEqual([('-', 28, 3), ('~', 23402, 'G')], decode_mutations(codes))
+        self.assertEqual([('-', 28, 3)], decode_mutations([['-', 28, 3]]))
+
+    def test_dump_mutations(self):
+        # sequences of insertions encoded by hash are stored with their codes
+        diffs = self.diffs + [('+', 500, 'ACGTACGTACGTACGT')]
+        stored = json.dumps(dump_mutations(diffs))
+        expected = sorted(diffs, key=encode_mutation)
+        with mock.patch.dict('covizu.utils.mutation_utils._inserts', clear=True):
+            self.assertEqual(expected, decode_mutations(json.loads(stored)))
+        self.assertEqual(encode_mutations(diffs).tolist(),
+                         encode_mutations(decode_mutations(json.loads(stored))).tolist())
+        self.assertEqual([], dump_mutations(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
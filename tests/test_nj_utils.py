@@ -0,0 +1,90 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from io import StringIO
+
+import numpy as np
+from Bio import Phylo
+
+from covizu import clustering
+from covizu.utils.nj_utils import NJTree, neighbor_joining
+
+basepath = os.path.dirname(os.path.abspath(__file__))
+
+
+def patristic(tree):
+    """ :return:  list, tip names; numpy.ndarray, distances between tips """
+    names = [tip.name for tip in tree.get_terminals()]
+    dists = np.array([[tree.distance(a, b) if a != b else 0. for b in names]
+                      for a in names])
+    return names, dists
+
+
+def bipartitions(tree, names):
+    """ Unrooted splits of tree, as sets of tip names excluding the first tip """
+    if isinstance(tree, NJTree):
+        tree = tree.to_phylo()
+    result = set()
+    for node in tree.get_nonterminals():
+        tips = {tip.name for tip in node.get_terminals()}
+        if names[0] in tips:
+            tips = set(names) - tips
+        if 1 < len(tips) < len(names) - 1:
+            result.add(frozenset(tips))
+    return result
+
+
+class TestNeighborJoining(unittest.TestCase):
+    def setUp(self):
+        self.trees = [Phylo.read(os.path.join(basepath, f'test_tree{i}.nwk'), 'newick')
+                      for i in (1, 2)]
+
+    def test_additive(self):
+        # neighbor-joining recovers trees from their patristic distances
+        for tree in self.trees:
+            names, dists = patristic(tree)
+            result = neighbor_joining(dists, names=names)
+            self.assertEqual(bipartitions(tree, names), bipartitions(result, names))
+            expected = {tip.name: tip.branch_length for tip in tree.get_terminals()}
+            for name, length in result.terminals():
+                self.assertAlmostEqual(expected[name], length, places=5)
+            self.assertEqual(2 * len(names) - 2, len(result))
+            self.assertTrue((result.parent[:-1] > np.arange(len(result) - 1)).all())
+
+    @unittest.skipIf(shutil.which('rapidnj') is None, "requires RapidNJ")
+    def test_rapidnj(self):
+        for tree in self.trees:
+            names, dists = patristic(tree)
+            with tempfile.NamedTemporaryFile('w', suffix='.phy') as handle:
+                handle.write(f'{len(names):>5}\n')
+                for name, row in zip(names, dists):
+                    handle.write(name + ''.join(f' {d:.6f}' for d in row) + '\n')
+                handle.flush()
+                stdout = subprocess.check_output(
+                    ['rapidnj', handle.name, '-i', 'pd', '--no-negative-length'],
+                    stderr=subprocess.DEVNULL)
+            expected = Phylo.read(StringIO(stdout.decode('utf-8')), 'newick')
+            result = neighbor_joining(dists, names=names)
+            self.assertEqual(bipartitions(expected, names), bipartitions(result, names))
+
+    def test_consensus(self):
+        # consensus of compact trees matches consensus of their Bio.Phylo trees
+        rng = np.random.default_rng(1)
+        points = rng.integers(0, 2, size=(12, 30))
+        njtrees = []
+        for _ in range(5):
+            weights = rng.integers(0, 3, size=30)
+            dists = (points[:, None, :] != points[None, :, :]) @ weights
+            njtrees.append(neighbor_joining(dists))
+        expected = clustering.consensus(iter([t.to_phylo() for t in njtrees]))
+        result = clustering.consensus(iter(njtrees))
+        self.assertEqual(bipartitions(expected, [str(i) for i in range(12)]),
+                         bipartitions(result, [str(i) for i in range(12)]))
+        self.assertAlmostEqual(expected.total_branch_length(),
+                               result.total_branch_length())
+
+
+if __name__ == '__main__':
+    unittest.main()
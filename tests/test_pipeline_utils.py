@@ -0,0 +1,66 @@
+import unittest
+import time
+from covizu.utils.pipeline_utils import Stage, defer
+
+
+def produce(n, log=None):
+    for i in range(n):
+        yield i
+        if log is not None and i % 10 == 9:
+            defer(lambda i=i: log.append(i))
+
+
+def square(items):
+    for i in items:
+        yield i * i
+
+
+class TestStage(unittest.TestCase):
+    def test_order(self):
+        first = Stage('first', produce(500), maxsize=3)
+        second = Stage('second', square(first), maxsize=3)
+        self.assertEqual([i * i for i in range(500)], list(second))
+        self.assertEqual(500, second.nitems)
+
+    def test_error(self):
+        def fail():
+            yield 1
+            raise ValueError('bad record')
+        stage = Stage('square', square(Stage('fail', fail())))
+        with self.assertRaises(ValueError):
+            list(stage)
+
+    def test_defer(self):
+        # deferred calls run only after preceding items reach the consumer
+        log = []
+        consumed = []
+        stage = Stage('second', square(Stage('first', produce(50, log), maxsize=2)),
+                      maxsize=2)
+        for item in stage:
+            consumed.append(item)
+            for i in log:
+                self.assertTrue(len(consumed) > i)
+        self.assertEqual([9, 19, 29, 39, 49], log)
+
+    def test_early_exit(self):
+        stage = Stage('first', produce(10**6), maxsize=2)
+        for item in stage:
+            if item == 5:
+                break
+        stage.thread.join(timeout=5)
+        self.assertFalse(stage.thread.is_alive())
+
+    def test_report(self):
+        def slow(items):
+            for i in items:
+                time.sleep(0.01)
+                yield i
+        first = Stage('first', produce(20), maxsize=2)
+        second = Stage('second', slow(first))
+        list(second)
+        self.assertGreater(second.utilisation(), first.utilisation())
+        self.assertIn('stage second: 20 items', second.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
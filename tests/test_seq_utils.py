@@ -1,6 +1,12 @@
 import unittest
 from io import StringIO
-from covizu.utils.seq_utils import iter_fasta, convert_fasta, total_missing, QPois, apply_features
+import random
+import os
+import pickle
+from tempfile import TemporaryDirectory
+from unittest import mock
+from covizu.utils.seq_utils import (iter_fasta, convert_fasta, total_missing, QPois, apply_features,
+                                    ProblematicMask, PackedIntervals, filter_outliers)
 
 
 class TestIterFasta(unittest.TestCase):
@@ -92,6 +98,45 @@ class TestTotalMissing(unittest.TestCase):
         res = total_missing(row)
         self.assertEqual(84, res)
 
+    def test_packed_missing(self):
+        row = {'missing': PackedIntervals.pack([(0,6), (5203,5222), (29844,29903)])}
+        self.assertEqual(84, total_missing(row))
+
+
+class TestPackedIntervals(unittest.TestCase):
+    def setUp(self):
+        self.intervals = [(0, 6), (10, 14), (25, 29), (29, 30), (100, 29903)]
+        self.packed = PackedIntervals.pack(self.intervals)
+
+    def test_pack(self):
+        self.assertEqual(self.intervals, list(self.packed))
+        self.assertEqual(self.packed, self.intervals)
+        self.assertEqual(self.intervals, self.packed)
+        self.assertEqual(5, len(self.packed))
+        self.assertEqual(8 * len(self.intervals), len(self.packed.data))
+        self.assertIs(self.packed, PackedIntervals.pack(self.packed))
+        self.assertEqual([], list(PackedIntervals.pack([])))
+        self.assertNotEqual(self.packed, self.intervals[1:])
+
+    def test_json(self):
+        self.assertEqual([0, 6, 4, 4, 11, 4, 0, 1, 70, 29803], self.packed.to_json())
+        self.assertEqual(self.packed, PackedIntervals.from_json(self.packed.to_json()))
+        # as stored by previous versions
+        self.assertEqual(self.packed, PackedIntervals.from_json([list(i) for i in self.intervals]))
+        self.assertEqual(self.packed, pickle.loads(pickle.dumps(self.packed)))
+
+    def test_total_overlap(self):
+        self.assertEqual(sum(r - l for l, r in self.intervals), self.packed.total())
+        self.assertEqual(0, PackedIntervals().total())
+        for left, right in [(0, 100), (5, 11), (14, 25), (28, 200), (30000, 30010)]:
+            expected = sum(1 for l, r in self.intervals for i in range(l, r) if left <= i < right)
+            self.assertEqual(expected, self.packed.overlap(left, right))
+
+    def test_mask(self):
+        buffer = bytearray(b'A' * 40)
+        PackedIntervals.pack([(0, 3), (38, 40)]).mask(buffer)
+        self.assertEqual(b'NNN' + b'A' * 35 + b'NN', buffer)
+
 
 class TestApplyFeatures(unittest.TestCase):
     def setUp(self):
@@ -104,6 +149,48 @@ class TestApplyFeatures(unittest.TestCase):
         refseq = "ATTAAAGGTTTATACCTTCCCAGGTAACAAACCAACCAAC"
         result = apply_features(diffs, missing, refseq)
         self.assertEqual(self.expected, result)
+        result = apply_features(diffs, PackedIntervals.pack(missing), refseq)
+        self.assertEqual(self.expected, result)
+
+
+class TestProblematicMask(unittest.TestCase):
+    def setUp(self):
+        self.mask = {
+            186: {'ref': 'C', 'alt': 'T', 'info': ''},
+            634: {'ref': 'T', 'alt': 'A,G', 'info': ''},
+            1000: {'ref': 'A', 'alt': 'G', 'info': ''}
+        }
+
+    def filter_dict(self, diffs):
+        """ previous implementation in filter_problematic() """
+        result = []
+        for typ, pos, alt in diffs:
+            if typ == '~' and int(pos) in self.mask and alt in self.mask[pos]['alt']:
+                continue
+            if typ != '-' and 'N' in alt:
+                continue
+            result.append(tuple([typ, pos, alt]))
+        return result
+
+    def test_filter_diffs(self):
+        pmask = ProblematicMask(self.mask)
+        diffs = [('~', 186, 'T'), ('~', 186, 'G'), ('~', 634, 'G'), ('~', 634, 'C'),
+                 ['~', 1000, 'G'], ('~', 2000, 'A'), ('+', 634, 'ANT'), ('+', 634, 'AGT'),
+                 ('-', 186, 3), ('~', 1000, 'N')]
+        self.assertEqual([('~', 186, 'G'), ('~', 634, 'C'), ('~', 2000, 'A'),
+                          ('+', 634, 'AGT'), ('-', 186, 3)], pmask.filter_diffs(diffs))
+
+    def test_filter_batch(self):
+        random.seed(1)
+        batch = [[(random.choice('~~~+-'), random.choice([186, 634, 1000, 1500, 5000]),
+                   random.choice(['A', 'C', 'G', 'T', 'N', 'AG', 'NA']))
+                  for _ in range(random.randint(0, 20))] for _ in range(100)]
+        batch = [[(t, p, len(a) if t == '-' else a if t == '+' else a[0]) for t, p, a in diffs]
+                 for diffs in batch]
+        filtered, nsites = ProblematicMask(self.mask).filter_batch(batch)
+        expected = [self.filter_dict(diffs) for diffs in batch]
+        self.assertEqual(expected, filtered)
+        self.assertEqual(sum(map(len, batch)) - sum(map(len, expected)), nsites)
 
 
 class TestQPois(unittest.TestCase):
@@ -128,6 +215,44 @@ class TestQPois(unittest.TestCase):
         result = self.poisson_expected.is_outlier(coldate, ndiffs)
         self.assertEqual(result, True)
 
+    def test_is_outlier_array(self):
+        random.seed(1)
+        coldates = [f'2021-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}'
+                    for _ in range(200)]
+        ndiffs = [random.randint(0, 60) for _ in range(200)]
+        days = [self.poisson_expected.days(coldate) for coldate in coldates]
+        result = self.poisson_expected.is_outlier_array(days, ndiffs)
+        expected = [self.poisson_expected.is_outlier(c, n) for c, n in zip(coldates, ndiffs)]
+        self.assertEqual(expected, result.tolist())
+
+    def test_filter_outliers(self):
+        random.seed(1)
+        rows = [(f'hCoV-19/Canada/Qc-{i}/2021|EPI_ISL_{i}|2021-{random.randint(1, 12):02d}-'
+                 f'{random.randint(1, 28):02d}', [('~', 100, 'T')] * random.randint(0, 60), [])
+                for i in range(200)]
+        rows.append(('hCoV-19/Canada/Qc-200/2021|EPI_ISL_200|2021', [], []))  # no day
+        expected = [row for row in rows[:-1] if not self.poisson_expected.is_outlier(
+            row[0].split('|')[-1], len(row[1]))]
+        self.assertEqual(expected, list(filter_outliers(iter(rows), batchsize=7)))
+
+        # a batch without any complete dates does not end the stream
+        rows = [(f'hCoV-19/Canada/Qc-{i}/2020|EPI_ISL_{i}|2020-01', [], []) for i in range(7)]
+        self.assertEqual(expected, list(filter_outliers(iter(rows + expected), batchsize=7)))
+
+    def test_cache(self):
+        with TemporaryDirectory() as tmpdir:
+            QPois._tables.clear()
+            first = QPois(quantile=0.99, rate=0.05, maxtime=500, cache_dir=tmpdir)
+            self.assertEqual(1, len(os.listdir(tmpdir)))
+
+            # timepoints are read from file by a new process
+            QPois._tables.clear()
+            with mock.patch.object(QPois, 'compute_timepoints') as compute:
+                second = QPois(quantile=0.99, rate=0.05, maxtime=500, cache_dir=tmpdir)
+            compute.assert_not_called()
+            self.assertEqual(first.timepoints_upper, second.timepoints_upper)
+            self.assertEqual(first.timepoints_lower, second.timepoints_lower)
+
 # Load VCF
 
 # Filter Problematic
@@ -1,5 +1,6 @@
 import unittest
 from covizu.treetime import retrieve_genomes
+from covizu.utils.mutation_utils import pack_key
 
 # Parse Nexus File - Nexus to Newick
 
@@ -31,7 +32,7 @@ class TestRetrieveGenome(unittest.TestCase):
 
     def test_retrieve_genome(self):
         by_lineage = {'B.1.1.171':
-                {'-|28|1': [
+                {pack_key([('-', 28, 1)]): [
                     {
                         'covv_virus_name': 'hCoV-19/Canada/Qc-L00240569/2020',
                         'covv_accession_id': 'EPI_ISL_465679', 'covv_collection_date':'2020-03-27',
@@ -41,7 +42,7 @@ class TestRetrieveGenome(unittest.TestCase):
                     }
                 ]},
                 'B.1.265':
-                    {'~|30|C,~|32|A':[
+                    {pack_key([('~', 30, 'C'), ('~', 32, 'A')]):[
                         {
                             'covv_virus_name': 'hCoV-19/Canada/Qc-L00240594/2020',
                             'covv_accession_id': 'EPI_ISL_465680',
@@ -52,7 +53,7 @@ class TestRetrieveGenome(unittest.TestCase):
                         }
                     ]},
                 'B.1.2':
-                    {'+|13|A': [
+                    {pack_key([('+', 13, 'A')]): [
                         {
                             'covv_virus_name': 'hCoV-19/Canada/Qc-L00240624/2020',
                             'covv_accession_id': 'EPI_ISL_465681',